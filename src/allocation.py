@@ -0,0 +1,183 @@
+"""
+Per-model device and CPU plugin settings. Each of the four models can run on its own device (including
+MULTI and HETERO devices, e.g. MULTI:CPU,GPU) with its own number of CPU throughput streams, inference threads,
+and thread binding mode. The settings are given as 'MODEL.SETTING=VALUE' strings (e.g. face-detection.threads=4)
+or as a dictionary of settings by model (e.g. the model_config entry of a YAML profile).
+
+The 'auto' number of threads makes the allocator split the available CPU cores between the models
+in proportion to their measured cost (the inference time per input).
+"""
+from generic_model import GenericModel
+from recording import STAGES
+import logging
+import math
+import time
+import os
+
+
+# The models are named after their pipeline stages
+MODELS = STAGES
+
+
+def parse_threads(value):
+    """
+    Converts the number of threads to an integer unless it's 'auto'.
+    """
+    if str(value).lower() == 'auto':
+        return 'auto'
+    return int(value)
+
+
+def parse_bind(value):
+    """
+    Converts the thread binding mode to the CPU plugin value: YES, NO, or NUMA. YAML turns YES and NO
+    into booleans, so they are accepted as well.
+    """
+    if isinstance(value, bool):
+        return 'YES' if value else 'NO'
+    value = str(value).upper()
+    if value not in ('YES', 'NO', 'NUMA'):
+        raise Exception('Unknown thread binding mode: ' + value)
+    return value
+
+
+# The settings and the functions which convert their values
+SETTINGS = {
+    'device': str,
+    'streams': int,
+    'threads': parse_threads,
+    'bind': parse_bind
+}
+
+
+def parse_model_config(model_config):
+    """
+    Parses the per-model settings given as a list of 'MODEL.SETTING=VALUE' strings or a dictionary
+    of settings by model. Returns a dictionary of settings by model.
+    """
+    if isinstance(model_config, dict):
+        items = [ (model, setting, value) for model, settings in model_config.items()
+                  for setting, value in (settings or {}).items() ]
+    else:
+        items = []
+        for item in model_config or []:
+            key, sep, value = item.partition('=')
+            model, dot, setting = key.partition('.')
+            if not sep or not dot:
+                raise Exception('Expected MODEL.SETTING=VALUE: ' + item)
+            items.append((model, setting, value))
+
+    settings = {}
+    for model, setting, value in items:
+        if model not in MODELS:
+            raise Exception('Unknown model: ' + model)
+        if setting not in SETTINGS:
+            raise Exception('Unknown model setting: ' + setting)
+        settings.setdefault(model, {})[setting] = SETTINGS[setting](value)
+    return settings
+
+
+def resolve_settings(model_config, defaults):
+    """
+    Returns the settings of every model: the defaults (a dictionary of all settings) overridden by the
+    per-model settings. The CPU settings are checked to apply to the CPU device only.
+    """
+    settings = {}
+    for model in MODELS:
+        settings[model] = dict(defaults, **model_config.get(model, {}))
+        model_settings = settings[model]
+        if model_settings['device'].upper() != 'CPU':
+            overridden = [ setting for setting in ('streams', 'threads', 'bind')
+                           if setting in model_config.get(model, {}) ]
+            if overridden:
+                raise Exception(f'The {", ".join(overridden)} settings of {model} require the CPU device')
+            model_settings.update(streams=0, threads=0, bind=None)
+    return settings
+
+
+def get_model_args(model_settings):
+    """
+    Returns the device and the plugin config arguments of GenericModel for the resolved model settings.
+    """
+    config = None
+    if model_settings['device'].upper() == 'CPU':
+        config = GenericModel.make_cpu_config(model_settings['streams'], model_settings['threads'],
+                                              model_settings['bind']) or None
+    return dict(device=model_settings['device'], config=config)
+
+
+def measure_cost(model, runs=20):
+    """
+    Measures the inference time of the loaded model per input (in seconds). The inference request
+    is run directly with its current inputs, so the scheduling overhead is not counted.
+    """
+    request = model.exe_network.requests[0]
+    request.infer()     # the first run may include lazy initialization
+    t = time.perf_counter()
+    for _ in range(runs):
+        request.infer()
+    return (time.perf_counter() - t) / runs / model.batch_size
+
+
+def get_available_cores():
+    """
+    Returns the number of CPU cores the process can run on.
+    """
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def allocate_threads(costs, cores):
+    """
+    Splits the cores between the models in proportion to their costs (a dictionary by model).
+    Every model gets at least one thread. Returns a dictionary of the numbers of threads by model.
+    """
+    total = sum(costs.values())
+    ideal = { model : cores * cost / total if total > 0 else cores / len(costs) for model, cost in costs.items() }
+    threads = { model : max(1, math.floor(share)) for model, share in ideal.items() }
+
+    # The cores left after rounding down go to the models which lost the most
+    while sum(threads.values()) < cores:
+        model = max(threads, key=lambda model: ideal[model] - threads[model])
+        threads[model] += 1
+    # The minimum of one thread per model may exceed the cores, so the extra threads are taken back
+    while sum(threads.values()) > cores and any(n > 1 for n in threads.values()):
+        model = min((model for model in threads if threads[model] > 1), key=lambda model: ideal[model] - threads[model])
+        threads[model] -= 1
+    return threads
+
+
+def allocate(settings, model_classes, model_args, runs=20):
+    """
+    Replaces the 'auto' numbers of threads in the resolved settings (modified in place) with the cores
+    allocated to the models. The cores not taken by the models with fixed numbers of threads are split
+    in proportion to the costs measured with the default numbers of threads. The models on the CPU
+    with the plugin default number of threads (zero) may take any of the cores, so they are left out
+    of the budget with a warning. The model classes and the common model arguments are dictionaries
+    by model, only the models in them are taken into account. Returns the dictionary of the measured costs.
+    """
+    auto_models = [ model for model in model_classes if settings[model]['threads'] == 'auto' ]
+    if not auto_models:
+        return {}
+
+    costs = {}
+    for model in auto_models:
+        model_settings = dict(settings[model], threads=0)
+        # The calibration instances are temporary, so they aren't exported to the network cache
+        instance = model_classes[model](**dict(model_args[model], cache=None), **get_model_args(model_settings))
+        costs[model] = measure_cost(instance, runs)
+        del instance
+
+    fixed_models = [ model for model in model_classes if model not in auto_models ]
+    default_models = [ model for model in fixed_models
+                       if settings[model]['device'].upper() == 'CPU' and settings[model]['threads'] == 0 ]
+    if default_models:
+        logging.warning(f'The number of threads of {", ".join(default_models)} is left to the plugin, so the cores '
+                        f'split between {", ".join(auto_models)} may be shared with their threads')
+    fixed_threads = sum(settings[model]['threads'] for model in fixed_models)
+    threads = allocate_threads(costs, max(len(auto_models), get_available_cores() - fixed_threads))
+    for model in auto_models:
+        settings[model]['threads'] = threads[model]
+        if settings[model]['bind'] is None:
+            # Every model would bind its threads to the same first cores
+            settings[model]['bind'] = 'NO'
+    return costs
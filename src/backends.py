@@ -0,0 +1,476 @@
+"""
+Inference backends of GenericModel. A backend reads networks, checks and loads them to devices, and creates
+executable networks whose inference requests follow the OpenVINO request API (infer, async_infer,
+completion callbacks, input and output arrays, performance counters).
+
+OpenVINOBackend runs the models by means of the OpenVINO inference engine. SyntheticBackend runs no models
+at all: its requests return correctly shaped fake outputs of the four models after a random delay and fail
+at a specified rate, so the pipeline can be run and benchmarked without OpenVINO and the model files.
+"""
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from openvino.inference_engine import IENetwork, IECore
+except ImportError:
+    IENetwork = IECore = None
+import numpy as np
+import threading
+import time
+import os
+
+
+class Backend:
+    """
+    The interface of inference backends.
+    """
+
+    def add_extension(self, extension_path, device_name):
+        """
+        Loads the extension library of the device.
+        """
+        raise NotImplementedError
+
+
+    def read_network(self, model_xml, model_bin):
+        """
+        Reads the network from the model files. The network provides the inputs and outputs dictionaries
+        (whose values have the shape attribute), the layers dictionary, and the settable batch_size.
+        """
+        raise NotImplementedError
+
+
+    def query_network(self, network, device_name):
+        """
+        Returns the dictionary of the network's layers supported by the device.
+        """
+        raise NotImplementedError
+
+
+    def load_network(self, network, device_name, config, num_requests):
+        """
+        Loads the network to the device with the plugin config. Returns the executable network
+        with the specified number of inference requests.
+        """
+        raise NotImplementedError
+
+
+    def import_network(self, model_file, device_name, config, num_requests):
+        """
+        Imports the executable network exported to the file (see NetworkCache).
+        """
+        raise NotImplementedError
+
+
+class OpenVINOBackend(Backend):
+    """
+    Runs the models by means of the OpenVINO inference engine.
+    """
+
+    def __init__(self):
+        """
+        Creates the inference engine core.
+        """
+        if IECore is None:
+            raise Exception('OpenVINO is not available')
+        self.core = IECore()
+
+
+    def add_extension(self, extension_path, device_name):
+        """
+        Loads the extension library of the device.
+        """
+        self.core.add_extension(extension_path=extension_path, device_name=device_name)
+
+
+    def read_network(self, model_xml, model_bin):
+        """
+        Reads the IR files.
+        """
+        #return self.core.read_network(model=model_xml, weights=model_bin)
+        return IENetwork(model=model_xml, weights=model_bin)
+
+
+    def query_network(self, network, device_name):
+        """
+        Returns the dictionary of the network's layers supported by the device.
+        """
+        return self.core.query_network(network=network, device_name=device_name)
+
+
+    def load_network(self, network, device_name, config, num_requests):
+        """
+        Compiles the network for the device.
+        """
+        return self.core.load_network(network=network, device_name=device_name, config=config or {},
+                                      num_requests=num_requests)
+
+
+    def import_network(self, model_file, device_name, config, num_requests):
+        """
+        Imports the executable network exported to the file.
+        """
+        return self.core.import_network(model_file=model_file, device_name=device_name, config=config or {},
+                                        num_requests=num_requests)
+
+
+def synthetic_head_pose(image_mean):
+    """
+    Returns the yaw, pitch, and roll angles produced by the synthetic head pose model for the face image
+    with the specified mean pixel value. The yaw is mapped from the 0..255 range to -45..45 degrees.
+    """
+    return image_mean*90/255 - 45, 0.0, 0.0
+
+
+def synthetic_gaze_vector(left_eye_mean, right_eye_mean, yaw):
+    """
+    Returns the gaze vector produced by the synthetic gaze model for the eye images with the specified
+    mean pixel values and the yaw angle. The components are in the -1..1 range.
+    """
+    return (left_eye_mean - 127.5)/255, (right_eye_mean - 127.5)/255, yaw/45
+
+
+# The face box returned by the synthetic face detector (scaled to the 0..1 range)
+SYNTHETIC_FACE_BOX = (0.3, 0.2, 0.7, 0.8)
+
+# The synthetic facial landmarks: all points are in the middle of the face except for the ones which define
+# the eye boxes (see EyeDetector._get_eye_boxes)
+SYNTHETIC_LANDMARKS = np.full(70, 0.5, dtype=np.float32)
+for point, (x, y) in { 0: (0.4, 0.4), 2: (0.6, 0.4), 12: (0.15, 0.3), 13: (0.3, 0.25), 14: (0.45, 0.3),
+                       15: (0.55, 0.3), 16: (0.7, 0.25), 17: (0.85, 0.3) }.items():
+    SYNTHETIC_LANDMARKS[2*point:2*point+2] = x, y
+
+
+def _detect_faces(inputs, outputs):
+    """
+    Fills the output of the synthetic face detector: a single face per image followed by the end marker.
+    """
+    detections = outputs['527']
+    detections[...] = 0
+    for i in range(len(detections)):
+        detections[i, 0, 0] = (i, 1, 0.99) + SYNTHETIC_FACE_BOX
+        detections[i, 0, 1, 0] = -1
+
+
+def _detect_landmarks(inputs, outputs):
+    """
+    Fills the output of the synthetic landmarks detector.
+    """
+    outputs['align_fc3'][...] = SYNTHETIC_LANDMARKS
+
+
+def _estimate_head_pose(inputs, outputs):
+    """
+    Fills the outputs of the synthetic head pose estimator, which depend on the mean value of the face image.
+    """
+    images = inputs['data']
+    for i, image in enumerate(images):
+        yaw, pitch, roll = synthetic_head_pose(image.mean())
+        outputs['angle_y_fc'][i] = yaw
+        outputs['angle_p_fc'][i] = pitch
+        outputs['angle_r_fc'][i] = roll
+
+
+def _estimate_gaze(inputs, outputs):
+    """
+    Fills the output of the synthetic gaze estimator, which depends on the mean values of the eye images
+    and the yaw angle.
+    """
+    for i in range(len(outputs['gaze_vector'])):
+        outputs['gaze_vector'][i] = synthetic_gaze_vector(inputs['left_eye_image'][i].mean(),
+                                                          inputs['right_eye_image'][i].mean(),
+                                                          inputs['head_pose_angles'][i, 0])
+
+
+# The synthetic models by model name: the short name, the input and output shapes, and the function
+# which fills the outputs
+SYNTHETIC_MODELS = {
+    'face-detection-retail-0005': ('face-detection', { 'input.1': (1, 3, 300, 300) }, { '527': (1, 1, 200, 7) },
+                                   _detect_faces),
+    'facial-landmarks-35-adas-0002': ('landmarks', { 'data': (1, 3, 60, 60) }, { 'align_fc3': (1, 70) },
+                                      _detect_landmarks),
+    'head-pose-estimation-adas-0001': ('head-pose', { 'data': (1, 3, 60, 60) },
+                                       { 'angle_y_fc': (1, 1), 'angle_p_fc': (1, 1), 'angle_r_fc': (1, 1) },
+                                       _estimate_head_pose),
+    'gaze-estimation-adas-0002': ('gaze', { 'left_eye_image': (1, 3, 60, 60), 'right_eye_image': (1, 3, 60, 60),
+                                            'head_pose_angles': (1, 3) }, { 'gaze_vector': (1, 3) }, _estimate_gaze)
+}
+
+# The default latencies of the synthetic models (close to the ones of FP32 models on a 4-core CPU)
+SYNTHETIC_LATENCIES = {
+    'face-detection': 'lognormal:6:0.2',
+    'landmarks': 'lognormal:1:0.2',
+    'head-pose': 'lognormal:1.5:0.2',
+    'gaze': 'lognormal:1.5:0.2'
+}
+
+
+class LatencyDistribution:
+    """
+    A distribution of inference latencies defined by a string: 'constant:MS', 'uniform:MIN_MS:MAX_MS',
+    'normal:MEAN_MS:STD_MS', 'lognormal:MEDIAN_MS:SIGMA', or 'exponential:MEAN_MS'.
+    """
+
+    def __init__(self, spec):
+        """
+        Parses the distribution string.
+        """
+        kind, *params = spec.split(':')
+        try:
+            params = [ float(param) for param in params ]
+        except ValueError:
+            raise Exception('Invalid latency distribution: ' + spec)
+        arity = { 'constant': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2, 'exponential': 1 }
+        if arity.get(kind) != len(params):
+            raise Exception('Invalid latency distribution: ' + spec)
+
+        self.spec = spec
+        self.kind = kind
+        self.params = params
+        if kind == 'uniform':
+            self.mean = (params[0] + params[1]) / 2000
+        elif kind == 'lognormal':
+            self.mean = params[0] * np.exp(params[1]**2 / 2) / 1000
+        else:
+            self.mean = params[0] / 1000
+
+
+    def sample(self, rng):
+        """
+        Draws a latency in seconds by means of the random generator (numpy.random.RandomState).
+        """
+        p = self.params
+        if self.kind == 'constant':
+            value = p[0]
+        elif self.kind == 'uniform':
+            value = rng.uniform(p[0], p[1])
+        elif self.kind == 'normal':
+            value = rng.normal(p[0], p[1])
+        elif self.kind == 'lognormal':
+            value = p[0] * np.exp(rng.normal(0, p[1]))
+        else:
+            value = rng.exponential(p[0])
+        return max(0.0, value) / 1000
+
+
+class SyntheticData:
+    """
+    Describes an input or an output of a synthetic network.
+    """
+
+    def __init__(self, shape):
+        """
+        Creates the description of the data with the specified shape.
+        """
+        self.shape = list(shape)
+        self.precision = 'FP32'
+        self.layout = 'NCHW' if len(shape) == 4 else 'NC'
+
+
+class SyntheticNetwork:
+    """
+    A network of the synthetic backend. It has the inputs and outputs of the real model.
+    """
+
+    def __init__(self, model_name):
+        """
+        Creates the network of the model with the specified name (see SYNTHETIC_MODELS).
+        """
+        if model_name not in SYNTHETIC_MODELS:
+            raise Exception('Unknown synthetic model: ' + model_name)
+        self.name = model_name
+        self.short_name, inputs, outputs, self.compute = SYNTHETIC_MODELS[model_name]
+        self.inputs = { name : SyntheticData(shape) for name, shape in inputs.items() }
+        self.outputs = { name : SyntheticData(shape) for name, shape in outputs.items() }
+        self.layers = { self.short_name : 'Synthetic' }
+
+
+    @property
+    def batch_size(self):
+        """
+        The batch size of the network.
+        """
+        return next(iter(self.inputs.values())).shape[0]
+
+
+    @batch_size.setter
+    def batch_size(self, batch_size):
+        """
+        Reshapes all inputs and outputs to the batch size.
+        """
+        for data in list(self.inputs.values()) + list(self.outputs.values()):
+            data.shape[0] = batch_size
+
+
+class SyntheticRequest:
+    """
+    An inference request of the synthetic backend. The outputs are computed from the inputs by a simple
+    function (see SYNTHETIC_MODELS), so it's possible to check which input they belong to.
+    """
+
+    def __init__(self, exe_network):
+        """
+        Creates a request with the input and output arrays of the network's shapes.
+        """
+        network = exe_network.network
+        self.exe_network = exe_network
+        self.inputs = { name : np.zeros(data.shape, dtype=np.float32) for name, data in network.inputs.items() }
+        self.outputs = { name : np.zeros(data.shape, dtype=np.float32) for name, data in network.outputs.items() }
+        self.callback = None
+        self.latency = 0
+
+
+    def set_completion_callback(self, py_callback, py_data=None):
+        """
+        Sets the function called with the status and the user data once an asynchronous request completes.
+        """
+        self.callback = (py_callback, py_data)
+
+
+    def infer(self, inputs=None):
+        """
+        Runs the request synchronously. Failures are not emulated here, since the status of a synchronous
+        request isn't checked (OpenVINO raises an exception instead).
+        """
+        self._run(inputs, with_failures=False)
+
+
+    def async_infer(self, inputs=None):
+        """
+        Starts the request. The completion callback is called from a thread of the executable network.
+        """
+        self.exe_network.executor.submit(self._run_async, inputs)
+
+
+    def get_perf_counts(self):
+        """
+        Returns the performance counters of the last run: the whole model is a single layer.
+        """
+        network = self.exe_network.network
+        latency = int(self.latency * 1e6)
+        return { network.short_name : { 'status': 'EXECUTED', 'layer_type': 'Synthetic', 'exec_type': 'sleep',
+                                        'real_time': latency, 'cpu_time': 0 } }
+
+
+    def _run(self, inputs, with_failures):
+        """
+        Waits for the sampled latency and computes the outputs. Returns the status (zero on success).
+        Private method, to be used by SyntheticRequest only.
+        """
+        for name, value in (inputs or {}).items():
+            np.copyto(self.inputs[name], value, casting='unsafe')
+
+        self.latency, failed = self.exe_network.draw(with_failures)
+        time.sleep(self.latency)
+        if failed:
+            return 1    # GENERAL_ERROR
+        self.exe_network.network.compute(self.inputs, self.outputs)
+        return 0
+
+
+    def _run_async(self, inputs):
+        """
+        Runs the request in a thread of the executable network and calls the completion callback.
+        Private method, to be used by SyntheticRequest only.
+        """
+        status = self._run(inputs, with_failures=True)
+        py_callback, py_data = self.callback
+        py_callback(status, py_data)
+
+
+class SyntheticExecutableNetwork:
+    """
+    An executable network of the synthetic backend. Like the CPU plugin, it runs as many requests
+    in parallel as the number of throughput streams (CPU_THROUGHPUT_STREAMS, one by default).
+    """
+
+    def __init__(self, network, latency, failure_rate, config, num_requests, seed):
+        """
+        Creates the requests of the network.
+        """
+        self.network = network
+        self.latency = latency
+        self.failure_rate = failure_rate
+        streams = int((config or {}).get('CPU_THROUGHPUT_STREAMS', 1) or 1)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, streams), thread_name_prefix=network.short_name)
+        self.lock = threading.Lock()    # guards the random generator
+        self.rng = np.random.RandomState(seed)
+        self.requests = [ SyntheticRequest(self) for _ in range(num_requests) ]
+
+
+    def draw(self, with_failures=True):
+        """
+        Draws the latency of a request and whether it fails. Returns a tuple of the latency in seconds
+        and the failure flag.
+        """
+        with self.lock:
+            failed = with_failures and self.failure_rate > 0 and self.rng.random_sample() < self.failure_rate
+            return self.latency.sample(self.rng), failed
+
+
+    def export(self, model_file):
+        """
+        Synthetic networks can't be exported.
+        """
+        raise Exception('Synthetic networks can\'t be exported')
+
+
+class SyntheticBackend(Backend):
+    """
+    Emulates the inference of the four models without OpenVINO and the model files.
+    """
+
+    def __init__(self, latencies=None, failure_rates=None, seed=None):
+        """
+        Creates the backend. The latencies are a dictionary of latency distribution strings
+        (see LatencyDistribution) by the short model name (face-detection, landmarks, head-pose, gaze),
+        the missing models have the default latencies. The failure rates are a dictionary of the shares
+        of asynchronous requests which fail, by the short model name. The seed makes the runs reproducible.
+        """
+        short_names = [ short_name for short_name, _, _, _ in SYNTHETIC_MODELS.values() ]
+        for name in list(latencies or {}) + list(failure_rates or {}):
+            if name not in short_names:
+                raise Exception('Unknown synthetic model: ' + name)
+
+        self.latencies = { name : LatencyDistribution((latencies or {}).get(name, SYNTHETIC_LATENCIES[name]))
+                           for name in short_names }
+        self.failure_rates = { name : (failure_rates or {}).get(name, 0) for name in short_names }
+        self.short_names = short_names
+        self.seed = seed
+
+
+    def add_extension(self, extension_path, device_name):
+        """
+        Extensions are not needed.
+        """
+        pass
+
+
+    def read_network(self, model_xml, model_bin):
+        """
+        Creates the synthetic network of the model. The model files are not read, only the model name
+        (the file name) is used.
+        """
+        return SyntheticNetwork(os.path.splitext(os.path.basename(model_xml))[0])
+
+
+    def query_network(self, network, device_name):
+        """
+        All layers are supported by any device.
+        """
+        return dict(network.layers)
+
+
+    def load_network(self, network, device_name, config, num_requests):
+        """
+        Creates the executable network. Each network gets its own random generator, whose seed depends
+        on the model rather than on the load order, since the models may be loaded concurrently.
+        """
+        seed = self.seed + self.short_names.index(network.short_name) if self.seed is not None else None
+        return SyntheticExecutableNetwork(network, self.latencies[network.short_name],
+                                          self.failure_rates[network.short_name], config, num_requests, seed)
+
+
+    def import_network(self, model_file, device_name, config, num_requests):
+        """
+        Synthetic networks can't be imported.
+        """
+        raise Exception('Synthetic networks can\'t be imported')
@@ -0,0 +1,204 @@
+"""
+Benchmarks the silent-mode pipeline over a grid of model precisions, numbers of concurrent requests,
+CPU throughput streams, and CPU inference threads. Each configuration is loaded once, warmed up, and run
+several times on the input file. The script reports the model loading time, the mean and the standard
+deviation of the frame rate, and the frame latency percentiles, saves the results (.json or .csv),
+and saves the best configuration as a YAML profile which can be loaded by main.py (--profile).
+
+    python benchmark.py --input ../bin/demo.mp4 --concurrency 0 1 2 4 --cpu-streams 0 2 --profile ../best.yaml
+"""
+from input_feeder import InputFeeder
+from generic_model import GenericModel
+from face_detection import FaceDetector
+from facial_landmarks_detection import EyeDetector
+from head_pose_estimation import HeadPoseEstimator
+from gaze_estimation import GazeEstimator
+from pipeline import Pipeline
+from stages import InputStage, FaceDetectionStage, LandmarksStage, HeadPoseStage, GazeStage, SinkStage
+import numpy as np
+import itertools
+import argparse
+import logging
+import json
+import time
+import csv
+import yaml
+
+
+# The result columns in the order of the results file
+COLUMNS = [ 'precision', 'concurrency', 'cpu_streams', 'cpu_threads', 'load_time', 'fps_mean', 'fps_std',
+            'latency_mean', 'latency_p50', 'latency_p95', 'latency_p99', 'frames' ]
+
+
+def load_models(precision, concurrency, device, config):
+    """
+    Loads the four models with the specified configuration. Returns a tuple of the models and the loading time.
+    """
+    t = time.perf_counter()
+    model_args = dict(precision=precision, concurrency=concurrency, device=device, config=config or None)
+    models = [ model_class(**model_args) for model_class in (FaceDetector, EyeDetector, HeadPoseEstimator, GazeEstimator) ]
+    return models, time.perf_counter() - t
+
+
+def run_pipeline(models, input, frame_count, confidence, prefetch, queue_size):
+    """
+    Runs the silent-mode pipeline on the first frames of the input (the whole file if the frame count is None).
+    Returns a tuple of the number of completed frames, the processing time, and the list of frame latencies.
+    """
+    faceDetector, eyeDetector, headPoseEstimator, gazeEstimator = models
+    feed = InputFeeder(input, prefetch=prefetch, frame_count=frame_count)
+    sink = SinkStage(input, None, silent=True, clean=True)
+    pipeline = Pipeline([
+        InputStage(feed),
+        FaceDetectionStage(faceDetector, confidence=confidence, keep_frames=False),
+        LandmarksStage(eyeDetector),
+        HeadPoseStage(headPoseEstimator),
+        GazeStage(gazeEstimator),
+        sink
+    ], queue_size=queue_size)
+
+    t = time.perf_counter()
+    try:
+        pipeline.run()
+    finally:
+        feed.close()
+    return sink.frame_count, time.perf_counter() - t, pipeline.latencies
+
+
+def benchmark(args, precision, concurrency, cpu_streams, cpu_threads):
+    """
+    Benchmarks a single configuration. Returns a dictionary of the result columns.
+    """
+    config = GenericModel.make_cpu_config(cpu_streams, cpu_threads) if args.device.upper() == 'CPU' else {}
+    models, load_time = load_models(precision, concurrency, args.device, config)
+    run_args = (args.confidence, args.prefetch, args.queue_size)
+
+    if args.warmup > 0:
+        run_pipeline(models, args.input, args.warmup, *run_args)
+
+    fps, latencies, frames = [], [], 0
+    for _ in range(args.repeat):
+        frame_count, t, run_latencies = run_pipeline(models, args.input, args.frames or None, *run_args)
+        fps.append(frame_count / t)
+        latencies += run_latencies
+        frames = frame_count
+
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return { 'precision': precision, 'concurrency': concurrency, 'cpu_streams': cpu_streams, 'cpu_threads': cpu_threads,
+             'load_time': load_time, 'fps_mean': float(np.mean(fps)), 'fps_std': float(np.std(fps)),
+             'latency_mean': 1000*latencies.mean(), 'latency_p50': 1000*p50, 'latency_p95': 1000*p95,
+             'latency_p99': 1000*p99, 'frames': frames }
+
+
+def save_results(file_name, results):
+    """
+    Saves the results to a file. The format (.json or .csv) is defined by the extension.
+    """
+    if file_name.lower().endswith('.csv'):
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(file_name, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def save_profile(file_name, result, device, metric):
+    """
+    Saves the configuration of the result as a YAML profile of main.py arguments.
+    """
+    profile = { 'device': device, 'precision': result['precision'], 'concurrency': result['concurrency'],
+                'cpu_streams': result['cpu_streams'], 'cpu_threads': result['cpu_threads'] }
+    with open(file_name, 'w') as f:
+        f.write(f'# The best configuration by {metric}: {result["fps_mean"]:.1f} FPS, '
+                f'p95 latency {result["latency_p95"]:.1f} ms\n')
+        yaml.safe_dump(profile, f, default_flow_style=False, sort_keys=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pipeline Benchmark")
+    parser.add_argument('--input', type=str, required=True, help="An input video file.")
+    parser.add_argument('--device', type=str, default='CPU', help="Device name to perform inference on. Default is CPU.")
+    parser.add_argument('--precisions', type=str, nargs='+', default=['FP32', 'FP16', 'FP32-INT8'],
+                        help="The model precisions to benchmark. Default is FP32 FP16 FP32-INT8.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help="The numbers of concurrent requests per model to benchmark. Default is 0 1 2 4.")
+    parser.add_argument('--cpu-streams', type=int, nargs='+', default=[0],
+                        help="The numbers of CPU throughput streams per model to benchmark. Zero stands for "
+                            "the plugin default. Default is 0.")
+    parser.add_argument('--cpu-threads', type=int, nargs='+', default=[0],
+                        help="The numbers of CPU inference threads per model to benchmark. Zero stands for "
+                            "the plugin default. Default is 0.")
+    parser.add_argument('--warmup', type=int, default=30,
+                        help="Defines the number of frames processed before the measurements. Default is 30.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Defines the number of measured runs of each configuration. Default is 3.")
+    parser.add_argument('--frames', type=int, default=0,
+                        help="Limits the number of frames processed by each run. Default is 0 (the whole file).")
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help="Defines the number of frame buffers decoded in the background. Default is 16.")
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help="Defines the number of frames which can wait between two adjacent pipeline stages. Default is 4.")
+    parser.add_argument('--confidence', type=float, default=0.5,
+                        help="Specifies face detection probability threshold. Default is 0.5.")
+    parser.add_argument('--metric', type=str, default='fps', choices=['fps', 'latency'],
+                        help="Specifies how the best configuration is chosen: by the mean frame rate (default) "
+                            "or by the 95th percentile of the frame latency.")
+    parser.add_argument('--results', type=str, default=None,
+                        help="Specifies the file (.json or .csv) for saving the results of all configurations.")
+    parser.add_argument('--profile', type=str, default=None,
+                        help="Specifies the YAML file for saving the best configuration, which can be loaded by main.py.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        datefmt='%Y-%m-%d %I:%M:%S')
+
+    # The CPU plugin settings don't apply to other devices
+    is_cpu = args.device.upper() == 'CPU'
+    grid = itertools.product(args.precisions, args.concurrency,
+                             args.cpu_streams if is_cpu else [0], args.cpu_threads if is_cpu else [0])
+
+    results = []
+    for precision, concurrency, cpu_streams, cpu_threads in grid:
+        if cpu_streams > max(1, concurrency):
+            # The streams can't be busy with fewer requests than streams
+            logging.info(f'Skipping {precision}, concurrency {concurrency}, {cpu_streams} streams: '
+                         'more streams than requests')
+            continue
+
+        logging.info(f'Benchmarking {precision}, concurrency {concurrency}, {cpu_streams or "default"} streams, '
+                     f'{cpu_threads or "default"} threads...')
+        try:
+            result = benchmark(args, precision, concurrency, cpu_streams, cpu_threads)
+        except Exception as e:
+            logging.exception(e)
+            continue
+        results.append(result)
+        logging.info(f'{result["fps_mean"]:.1f} ± {result["fps_std"]:.1f} FPS, p95 latency {result["latency_p95"]:.1f} ms, '
+                     f'load time {result["load_time"]:.2f} s')
+
+    if not results:
+        raise Exception('No configuration has been benchmarked')
+
+    print(f'\n{"Precision":<12}{"Requests":>10}{"Streams":>9}{"Threads":>9}{"Load, s":>9}{"FPS":>9}{"± FPS":>8}'
+          f'{"Mean, ms":>10}{"p50, ms":>9}{"p95, ms":>9}{"p99, ms":>9}')
+    for r in results:
+        print(f'{r["precision"]:<12}{r["concurrency"]:>10}{r["cpu_streams"]:>9}{r["cpu_threads"]:>9}{r["load_time"]:>9.2f}'
+              f'{r["fps_mean"]:>9.1f}{r["fps_std"]:>8.1f}{r["latency_mean"]:>10.1f}{r["latency_p50"]:>9.1f}'
+              f'{r["latency_p95"]:>9.1f}{r["latency_p99"]:>9.1f}')
+
+    if args.metric == 'fps':
+        best = max(results, key=lambda r: r['fps_mean'])
+    else:
+        best = min(results, key=lambda r: r['latency_p95'])
+    print(f'\nBest configuration by {args.metric}: {best["precision"]}, concurrency {best["concurrency"]}, '
+          f'{best["cpu_streams"]} streams, {best["cpu_threads"]} threads')
+
+    if args.results:
+        save_results(args.results, results)
+        print(f'Results saved to {args.results}')
+    if args.profile:
+        save_profile(args.profile, best, args.device, args.metric)
+        print(f'Profile saved to {args.profile}')
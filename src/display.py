@@ -0,0 +1,132 @@
+import helpers
+import numpy as np
+import threading
+import time
+import cv2
+
+
+class Display:
+    """
+    Shows the output frames at a fixed refresh rate, so the pipeline never waits for the GUI. HighGUI requires
+    the main thread on some platforms (e.g. macOS and some Qt builds), so the frames are shown by the run method
+    called from the main thread, while the pipeline runs in the background. Only the newest frame of each window
+    is shown on a refresh, the older ones are skipped. The overlays are drawn into a reusable buffer of each window,
+    so no image is allocated per frame. The faces of a frame processed separately (see FrameContext.fork) are shown
+    together on one frame.
+    """
+
+    def __init__(self, refresh_rate=60, on_escape=None):
+        """
+        Creates the display. The refresh rate is in Hz (the monitor's rate is a sensible choice).
+        The on_escape callback is called from the thread running the display when the Esc key is pressed.
+        """
+        self.period = 1 / refresh_rate
+        self.on_escape = on_escape
+        self.lock = threading.Lock()
+        self.pending = {}   # the newest frame context, the clean flag, and the overlays by window name
+        self.shown = {}     # the index and the stream of the frame taken for showing last by window name
+        self.late = {}      # the clean flag and the overlays of the other faces of the shown frame by window name
+        self.buffers = {}   # the output image by window name
+        self.frames_shown = 0
+        self.frames_skipped = 0
+        self.render_time = 0
+        self.closed = threading.Event()
+
+
+    def show(self, window_name, ctx, clean=False):
+        """
+        Queues the frame for showing in the window along with the face box and the gaze vector (unless clean
+        is specified). The display takes over the frame context and releases it once the frame is copied
+        or replaced by a newer one. The other faces of a frame are merged by the frame index, so they are
+        drawn on the same frame even if it has already been taken for showing.
+        """
+        overlay = (ctx.face_box, ctx.gaze_vector)
+        key = (ctx.index, ctx.stream)
+        with self.lock:
+            previous = self.pending.get(window_name)
+            if self.closed.is_set():
+                previous = (ctx,)
+            elif previous is not None and (previous[0].index, previous[0].stream) == key:
+                # Another face of the pending frame
+                previous[2].append(overlay)
+                previous = (ctx,)
+            elif previous is None and self.shown.get(window_name) == key:
+                # Another face of the frame which has been taken for showing already
+                self.late.setdefault(window_name, (clean, []))[1].append(overlay)
+                previous = (ctx,)
+            else:
+                self.pending[window_name] = (ctx, clean, [ overlay ])
+                if previous is not None:
+                    self.frames_skipped += 1
+        if previous is not None:
+            previous[0].release()
+
+
+    def run(self, until):
+        """
+        Shows the pending frames and handles the keyboard once per refresh until the until callback
+        returns True or the display is closed. Must be called from the main thread.
+        """
+        next_refresh = time.perf_counter()
+        while not self.closed.is_set() and not until():
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                late, self.late = self.late, {}
+                for window_name, (ctx, _, _) in pending.items():
+                    self.shown[window_name] = (ctx.index, ctx.stream)
+            for window_name, (ctx, clean, overlays) in pending.items():
+                self._render(window_name, ctx, clean, overlays)
+            for window_name, (clean, overlays) in late.items():
+                if window_name not in pending:     # otherwise the frame has been replaced already
+                    self._draw(window_name, clean, overlays)
+
+            next_refresh = max(next_refresh + self.period, time.perf_counter())
+            delay = max(1, int(1000 * (next_refresh - time.perf_counter())))
+            if not self.buffers:
+                # There are no windows yet, so waitKey wouldn't wait
+                self.closed.wait(delay / 1000)
+            elif cv2.waitKey(delay) & 0xFF == 27 and self.on_escape is not None:
+                self.on_escape()
+
+        cv2.destroyAllWindows()
+
+
+    def close(self):
+        """
+        Closes the display. The frames which have not been shown are released.
+        """
+        self.closed.set()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for ctx, _, _ in pending.values():
+            ctx.release()
+
+
+    def _render(self, window_name, ctx, clean, overlays):
+        """
+        Copies the frame to the buffer of the window, releases the frame context, and draws the overlays.
+        Private method, to be used by Display only.
+        """
+        start = time.perf_counter()
+        frame = ctx.frame
+        buffer = self.buffers.get(window_name)
+        if buffer is None or buffer.shape != frame.shape:
+            buffer = self.buffers[window_name] = np.empty(frame.shape, dtype=frame.dtype)
+        np.copyto(buffer, frame)    # a reflected webcam frame becomes contiguous, so OpenCV can draw on it
+        ctx.release()
+        self._draw(window_name, clean, overlays)
+        self.frames_shown += 1
+        self.render_time += time.perf_counter() - start
+
+
+    def _draw(self, window_name, clean, overlays):
+        """
+        Draws the overlays (the face boxes and the gaze vectors) on the buffer of the window and shows it.
+        Private method, to be used by Display only.
+        """
+        buffer = self.buffers[window_name]
+        for face_box, gaze_vector in overlays:
+            if gaze_vector and not clean:
+                gx, gy, _ = gaze_vector
+                helpers.draw_gaze_vector(buffer, face_box, gx, gy, in_place=True)
+        cv2.imshow(window_name, buffer)
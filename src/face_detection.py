@@ -1,4 +1,6 @@
 from generic_model import GenericModel
+from collections import deque
+import numpy as np
 import helpers
 
 class FaceDetector(GenericModel):
@@ -6,30 +8,98 @@ class FaceDetector(GenericModel):
     A class for the Face Detection Model.
     """
 
-    def __init__(self, precision, concurrency, device='CPU', extensions=None):
+    def __init__(self, precision, concurrency, device='CPU', extensions=None, roi_scale=0, roi_interval=0, **kwargs):
         """
-        Initializes a new instance of the face detection model.
+        Initializes a new instance of the face detection model. A positive ROI scale enables the search window 
+        mode: when a face was found on the previous frame of the stream, the detector runs on a square window 
+        around it whose side is the specified number of times larger than the face. The detector falls back
+        to the whole frame after a miss and, if the ROI interval is positive, once in the specified number
+        of detections.
         """
 
         super().__init__(
             model_name=f'../models/intel/face-detection-retail-0005/{precision}/face-detection-retail-0005', 
             concurrency=concurrency,
             device=device, 
-            extensions=extensions)
+            extensions=extensions, **kwargs)
 
         self.input_shape = self.network.inputs[self.input_name].shape
 
+        self.roi_scale = roi_scale
+        self.roi_interval = roi_interval
+        self.windows = deque()      # the search window (0..1) and the stream of each fed input, None for the whole frame
+        self.search_faces = {}      # the face box (0..1) to search around and the detections since the whole frame by stream
+        self.roi_detections = 0
+        self.roi_hits = 0
+        self.full_detections = 0
+        self.frame_pixels = 0       # the pixels of the frames fed in the search window mode
+        self.pixels_saved = 0       # the frame pixels not resized for detection thanks to the search windows
 
-    def feed_input(self, image):
+
+    def feed_input(self, image, stream=0):
         """
-        Preprocesses the input image and feeds it to the model for inference.
+        Preprocesses the input image and feeds it to the model for inference. In the search window mode
+        only the window around the previous face of the stream is fed (see get_search_window).
         Depending on the inference mode, the call may be blocking or not.
         """
-        image_preprocessed = self._preprocess_input(image, width=self.input_shape[3], height=self.input_shape[2])
-        super().feed_input(image_preprocessed)
+        window = None
+        if self.roi_scale > 0 and image is not None and image.size > 0:
+            pixel_box = self.get_search_window(image, stream)
+            self.frame_pixels += image.shape[0] * image.shape[1]
+            if pixel_box is None:
+                self.full_detections += 1
+            else:
+                h, w = image.shape[:2]
+                xmin, ymin, xmax, ymax = pixel_box
+                window = (xmin / w, ymin / h, xmax / w, ymax / h)
+                self.pixels_saved += h * w - (xmax - xmin) * (ymax - ymin)
+                image = image[ymin:ymax, xmin:xmax]
+        self.windows.append((window, stream))
+        self.feed_input_images({ self.input_name : image })
+
+
+    def get_search_window(self, image, stream=0):
+        """
+        Returns the search window (a square in pixels, the end coordinates are exclusive) around the previous face
+        of the stream or None if the whole image has to be searched: there is no previous face, the interval of
+        detections on the whole frame has passed, or the window would cover the image anyway.
+        """
+        face_box, count = self.search_faces.get(stream, (None, 0))
+        if face_box is None or (self.roi_interval > 0 and count >= self.roi_interval):
+            self.search_faces[stream] = (face_box, 1)
+            return None
+        self.search_faces[stream] = (face_box, count + 1)
+
+        h, w = image.shape[:2]
+        xmin, ymin, xmax, ymax = helpers.fit(face_box, image)
+        side = int(self.roi_scale * max(xmax - xmin, ymax - ymin))
+        if side < 1 or (side >= w and side >= h):
+            return None
+        width, height = min(side, w), min(side, h)
+        # The window is shifted rather than cut at the image borders, so the face stays inside
+        x = helpers.clamp((xmin + xmax - width) // 2, 0, w - width)
+        y = helpers.clamp((ymin + ymax - height) // 2, 0, h - height)
+        return (x, y, x + width, y + height)
 
 
-    def consume_output(self, confidence, wait):
+    def follow_face(self, face_box, stream=0):
+        """
+        Sets the face (scaled to the 0..1 range of the frame) the next search windows of the stream are placed 
+        around. By default it's the most probable face of the last detection, which may be overridden
+        by a face selection policy.
+        """
+        _, count = self.search_faces.get(stream, (None, 0))
+        self.search_faces[stream] = (face_box, count)
+
+
+    def get_roi_hit_rate(self):
+        """
+        Returns the share of the detections on search windows which have found a face.
+        """
+        return self.roi_hits / self.roi_detections if self.roi_detections > 0 else 0
+
+
+    def consume_output(self, confidence, wait, nms_threshold=0):
         """
         Retrieves the face bounding box from the detection results. Returns a tuple. 
         The first value indicates whether the result was retrieved. The second item is 
@@ -38,14 +108,37 @@ class FaceDetector(GenericModel):
         The wait parameter specifies whether the function has to wait for the current
         inference request to finish in case no result is available at the moment of the call.
         """
-        consumed, detections = super().consume_output(wait)
-        if consumed and detections is not None:
-            face_box = self._get_bounding_box(detections, confidence=confidence)            
-        else:
-            face_box = None
+        consumed, faces = self.consume_faces(confidence, wait, nms_threshold)
+        face_box = tuple(faces[0, 1:]) if faces is not None and len(faces) > 0 else None
         return consumed, face_box
 
 
+    def consume_faces(self, confidence, wait, nms_threshold=0):
+        """
+        Retrieves all faces from the detection results (see decode_detections). Returns a tuple. 
+        The first value indicates whether the result was retrieved. The second item is the array
+        of faces or None if the input was a placeholder. The faces found in a search window are
+        mapped to the 0..1 range of the whole frame.
+        """
+        consumed, detections = super().consume_output(wait)
+        if not consumed:
+            return consumed, None
+        window, stream = self.windows.popleft() if self.windows else (None, 0)
+        if detections is None:
+            return consumed, None
+
+        faces = self.decode_detections(detections, confidence, nms_threshold)
+        if window is not None:
+            xmin, ymin, xmax, ymax = window
+            faces[:,1:] = faces[:,1:] * (xmax - xmin, ymax - ymin, xmax - xmin, ymax - ymin) + (xmin, ymin, xmin, ymin)
+            self.roi_detections += 1
+            self.roi_hits += len(faces) > 0
+        if self.roi_scale > 0:
+            # After a miss the next detection runs on the whole frame
+            self.follow_face(tuple(faces[0,1:]) if len(faces) > 0 else None, stream)
+        return consumed, faces
+
+
     def preprocess_output(self, face_box, frame):
         """
         Scales the face bounding box from the range 0..1 to the size of the frame
@@ -59,13 +152,64 @@ class FaceDetector(GenericModel):
             face_img = helpers.crop(frame, face_box)
             return face_img, face_box
 
-    def _get_bounding_box(self, detections, confidence):
+
+    @staticmethod
+    def decode_detections(detections, confidence, nms_threshold=0):
         """
-        An auxiliary function which finds the first face bounding box with sufficient detection confidence.
+        Decodes the output of the model: takes the detections up to the end marker (image id -1) with
+        a probability higher or equal to the confidence value, sorts them by probability in descending order
+        and, if the NMS threshold is positive, suppresses the boxes which overlap a more probable one
+        by a larger intersection over union. Returns an array of faces, each row being the probability 
+        and the bounding box (xmin, ymin, xmax, ymax) clipped to the 0..1 range.
         """
-        for detection in detections[0,0,:,:]:
-            if detection[2] >= confidence:
-                return detection[3:]
-        
-        return None
+        rows = detections.reshape(-1, 7)
+        ended = rows[:,0] < 0
+        if ended.any():
+            rows = rows[:np.argmax(ended)]
+        rows = rows[rows[:,2] >= confidence]
+        rows = rows[np.argsort(-rows[:,2], kind='stable')]
+        faces = np.column_stack((rows[:,2], np.clip(rows[:,3:7], 0, 1)))
+
+        if nms_threshold > 0 and len(faces) > 1:
+            boxes = faces[:,1:]
+            areas = (boxes[:,2] - boxes[:,0]) * (boxes[:,3] - boxes[:,1])
+            keep = np.ones(len(faces), dtype=bool)
+            for i in range(len(faces) - 1):
+                if not keep[i]:
+                    continue
+                # The intersection of the box with all less probable boxes at once
+                w = np.minimum(boxes[i,2], boxes[i+1:,2]) - np.maximum(boxes[i,0], boxes[i+1:,0])
+                h = np.minimum(boxes[i,3], boxes[i+1:,3]) - np.maximum(boxes[i,1], boxes[i+1:,1])
+                intersection = np.maximum(w, 0) * np.maximum(h, 0)
+                iou = intersection / np.maximum(areas[i] + areas[i+1:] - intersection, 1e-9)
+                keep[i+1:] &= iou <= nms_threshold
+            faces = faces[keep]
+        return faces
 
+
+    @staticmethod
+    def select_faces(faces, policy, max_faces=1, previous_box=None):
+        """
+        Selects the faces to process from the array returned by decode_detections according to the policy:
+        'confidence' picks the most probable face, 'largest' picks the face with the largest area, 'nearest'
+        picks the face whose center is the nearest to the center of the previous face box (or the most 
+        probable one if there is no previous face), and 'all' picks up to max_faces most probable faces.
+        Returns a list of the face bounding boxes scaled to the 0..1 range.
+        """
+        if faces is None or len(faces) == 0:
+            return []
+
+        boxes = faces[:,1:]
+        if policy == 'all':
+            return [ tuple(box) for box in boxes[:max(1, max_faces)] ]
+        elif policy == 'largest':
+            index = np.argmax((boxes[:,2] - boxes[:,0]) * (boxes[:,3] - boxes[:,1]))
+        elif policy == 'nearest' and previous_box is not None:
+            centers = (boxes[:,:2] + boxes[:,2:]) / 2
+            previous_center = (np.array(previous_box[:2]) + np.array(previous_box[2:])) / 2
+            index = np.argmin(np.sum((centers - previous_center)**2, axis=1))
+        elif policy in ('confidence', 'nearest'):
+            index = 0
+        else:
+            raise Exception('Unknown face selection policy: ' + policy)
+        return [ tuple(boxes[index]) ]
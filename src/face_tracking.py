@@ -0,0 +1,167 @@
+from collections import deque
+import cv2
+import numpy as np
+
+
+class FaceTracker:
+    """
+    Propagates the face bounding box between face detections by means of the sparse optical flow.
+    This allows to run the face detection model only once in several frames.
+    """
+
+    def __init__(self, interval, min_points=8, max_error=20.0, min_survival=0.5):
+        """
+        Initializes a new face tracker. The interval specifies how often (in frames) the face detector
+        must run. The tracker asks for detection earlier if it loses the face. The tracking confidence
+        is considered to be low when fewer than min_points feature points are left, less than min_survival
+        fraction of the points could be tracked or their mean tracking error exceeds max_error.
+        """
+        self.interval = max(1, interval)
+        self.min_points = min_points
+        self.max_error = max_error
+        self.min_survival = min_survival
+
+        self.scheduled = deque()    # (detect, interval) decisions for the frames which haven't been tracked yet
+        self.frames_since_detection = self.interval
+        self.detection_interval = self.interval     # the interval when the last detection was scheduled
+        self.lost = True
+
+        self.prev_gray = None
+        self.points = None
+        self.box = None
+
+        self.detected = 0
+        self.tracked = 0
+
+
+    def need_detection(self):
+        """
+        Decides whether the face detector has to be run on the next input frame.
+        Must be called for every frame in the order they are fed to the face detector.
+        """
+        # No features are picked while the interval is 1, so the first frame after the interval is raised
+        # (e.g. by the quality controller) is detected once more to start tracking from
+        if self.lost or self.frames_since_detection >= self.interval or self.detection_interval <= 1:
+            detect = True
+            self.frames_since_detection = 1
+            self.detection_interval = self.interval
+            # Don't request detection on each frame while the outputs of the previous detection are in flight
+            self.lost = False
+        else:
+            detect = False
+            self.frames_since_detection += 1
+
+        self.scheduled.append((detect, self.interval))
+        return detect
+
+
+    def update(self, frame, face_box):
+        """
+        Takes in the frame and the face bounding box (scaled to the frame size) produced by the face detector.
+        If the detector was skipped for this frame, the bounding box is estimated from the previous frame.
+        Must be called for every frame in the order they are fed to the face detector. Returns the face
+        bounding box or None if the face could be neither detected nor tracked.
+        While the face detector runs on every frame, the frame isn't processed at all.
+        """
+        detected, interval = self.scheduled.popleft() if self.scheduled else (True, self.interval)
+
+        if detected and interval <= 1:
+            self.detected += 1
+            self._reset(None, None)
+            if face_box is None:
+                self.lost = True
+            return face_box
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame is not None and frame.size>0 else None
+
+        if detected:
+            self.detected += 1
+            self._reset(gray, face_box)
+            if face_box is None:
+                self.lost = True
+            return face_box
+
+        box = self._track(gray)
+        if box is None:
+            self.lost = True
+        else:
+            self.tracked += 1
+        return box
+
+
+    def _reset(self, gray, face_box):
+        """
+        Starts tracking the face from the specified bounding box.
+        Private method, to be used by FaceTracker only.
+        """
+        self.prev_gray = gray
+        self.box = face_box
+        self.points = self._find_points(gray, face_box)
+
+
+    def _find_points(self, gray, box):
+        """
+        Picks good features to track inside the face bounding box.
+        Private method, to be used by FaceTracker only.
+        """
+        if gray is None or box is None:
+            return None
+
+        xmin, ymin, xmax, ymax = box
+        if xmax <= xmin or ymax <= ymin:
+            return None
+
+        mask = np.zeros_like(gray)
+        mask[max(0,ymin):ymax+1, max(0,xmin):xmax+1] = 255
+        points = cv2.goodFeaturesToTrack(gray, maxCorners=50, qualityLevel=0.01, minDistance=5, mask=mask)
+        if points is None or len(points) < self.min_points:
+            return None
+        return points
+
+
+    def _track(self, gray):
+        """
+        Estimates the face bounding box on the current frame given the feature points from the previous one.
+        Returns None if the tracking confidence is low.
+        Private method, to be used by FaceTracker only.
+        """
+        if gray is None or self.prev_gray is None or self.points is None or self.box is None \
+            or gray.shape != self.prev_gray.shape:
+            self._reset(None, None)
+            return None
+
+        new_points, status, error = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, self.points, None)
+        status = status.ravel().astype(bool) if status is not None else np.zeros(len(self.points), dtype=bool)
+        good_old = self.points[status].reshape(-1, 2)
+        good_new = new_points[status].reshape(-1, 2) if new_points is not None else good_old
+
+        if len(good_new) < max(self.min_points, self.min_survival*len(self.points)) \
+            or float(np.mean(error[status])) > self.max_error:
+            self._reset(None, None)
+            return None
+
+        # Move the box by the median displacement and scale it by the median change of the point spread
+        dx, dy = np.median(good_new - good_old, axis=0)
+        spread_old = np.linalg.norm(good_old - np.median(good_old, axis=0), axis=1)
+        spread_new = np.linalg.norm(good_new - np.median(good_new, axis=0), axis=1)
+        valid = spread_old > 1e-3
+        scale = float(np.median(spread_new[valid] / spread_old[valid])) if np.any(valid) else 1.0
+
+        xmin, ymin, xmax, ymax = self.box
+        cx = (xmin + xmax) / 2 + dx
+        cy = (ymin + ymax) / 2 + dy
+        hw = (xmax - xmin) * scale / 2
+        hh = (ymax - ymin) * scale / 2
+        h, w = gray.shape
+        box = (
+            int(max(0, cx - hw)), int(max(0, cy - hh)),
+            int(min(w - 1, cx + hw)), int(min(h - 1, cy + hh))
+        )
+
+        self.prev_gray = gray
+        self.box = box
+        self.points = good_new.reshape(-1, 1, 2)
+        if len(self.points) < self.min_points:
+            self.points = self._find_points(gray, box)
+
+        return box
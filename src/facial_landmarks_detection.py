@@ -5,7 +5,7 @@ class EyeDetector(GenericModel):
     """
     A class for eye detection.
     """
-    def __init__(self, precision, concurrency, device='CPU', extensions=None):
+    def __init__(self, precision, concurrency, device='CPU', extensions=None, **kwargs):
         """
         Initializes a facial landmark detection model instance.
         """
@@ -14,7 +14,7 @@ class EyeDetector(GenericModel):
             model_name=f'../models/intel/facial-landmarks-35-adas-0002/{precision}/facial-landmarks-35-adas-0002', 
             concurrency=concurrency,
             device=device, 
-            extensions=extensions)
+            extensions=extensions, **kwargs)
 
         self.input_shape = self.network.inputs[self.input_name].shape
 
@@ -24,8 +24,7 @@ class EyeDetector(GenericModel):
         Preprocesses the input image and feeds it to the model for inference.
         Depending on the inference mode, the call may be blocking or not.
         """
-        image_preprocessed = self._preprocess_input(face_image, self.input_shape[3], self.input_shape[2])
-        super().feed_input(image_preprocessed)
+        self.feed_input_images({ self.input_name : face_image })
 
 
     def consume_output(self, wait_needed):
@@ -7,13 +7,13 @@ class GazeEstimator(GenericModel):
     A class for gaze direction estimation.
     """
 
-    def __init__(self, precision, concurrency, device='CPU', extensions=None):
+    def __init__(self, precision, concurrency, device='CPU', extensions=None, **kwargs):
         """
         Initializes a new instance of the gaze direction estimation model.
         """
         super().__init__(
             model_name=f'../models/intel/gaze-estimation-adas-0002/{precision}/gaze-estimation-adas-0002', 
-            concurrency=concurrency, device=device, extensions=extensions)
+            concurrency=concurrency, device=device, extensions=extensions, **kwargs)
 
         self.left_eye_input_name = 'left_eye_image'
         self.left_eye_input_shape = self.network.inputs[self.left_eye_input_name].shape
@@ -32,18 +32,11 @@ class GazeEstimator(GenericModel):
         expected by the model. Depending on the inference model the call may be blocking or not.
         """
         if left_eye is not None and right_eye is not None and left_eye.size>0 and right_eye.size>0 and head_pose_angles:
-            left_eye_preprocessed = self._preprocess_input(left_eye, width=self.left_eye_input_shape[3], height=self.left_eye_input_shape[2])
-            right_eye_preprocessed = self._preprocess_input(right_eye, width=self.right_eye_input_shape[3], height=self.right_eye_input_shape[2])
-        
-            input_dict = {
-                self.left_eye_input_name : left_eye_preprocessed,
-                self.right_eye_input_name : right_eye_preprocessed,
-                self.head_pose_input_name : head_pose_angles
-            }
+            self.feed_input_images(
+                { self.left_eye_input_name : left_eye, self.right_eye_input_name : right_eye },
+                inputs={ self.head_pose_input_name : head_pose_angles })
         else:
-            input_dict = None
-
-        super().feed_input_dict(input_dict)
+            super().feed_input_dict(None)
 
 
     def consume_output(self, wait):
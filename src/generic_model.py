@@ -1,50 +1,146 @@
-from openvino.inference_engine import IENetwork, IECore
-from collections import deque, Counter
-import cv2
+try:
+    # The blob API is required by the engine preprocessing (OpenVINO 2020.2 and newer)
+    from openvino.inference_engine import Blob, TensorDesc, ResizeAlgorithm
+except ImportError:
+    Blob = TensorDesc = ResizeAlgorithm = None
+from collections import deque
+from profiler import LayerProfiler
+from backends import OpenVINOBackend
 import numpy as np
+import helpers
+import threading
 import logging
+import time
+import os
 
 class GenericModel:
 
-    core = IECore()
+    # The backend used by the models which don't specify their own one, created on first use
+    default_backend = None
+    backend_lock = threading.Lock()
 
     """
     The parent class for various object detection and recognition models.
     """
-    def __init__(self, model_name, concurrency=0, device='CPU', extensions=None):
+    def __init__(self, model_name, concurrency=0, device='CPU', extensions=None, config=None, cache=None,
+                 preprocessing='opencv', batch_size=1, batch_timeout=0.005, profile_interval=0, backend=None):
         """
-        Initializes the generic model.
+        Initializes the generic model. The config is a dictionary of plugin configuration parameters.
+        The cache is an optional NetworkCache instance used to skip compilation of the network.
+        The preprocessing parameter specifies who resizes the input images and converts their layout:
+        'opencv' does it in Python, while 'engine' makes the image inputs accept NHWC U8 images of 
+        arbitrary size, so the inference engine resizes them by means of its built-in preprocessing.
+        A batch size greater than one enables micro-batching: the network is reshaped to that batch size,
+        and the inputs are gathered into a single request until the batch is full or the batch timeout
+        (in seconds) expires. The profile interval enables layer-wise profiling: the performance counters 
+        are sampled once in the specified number of requests. The backend runs the network (see backends.py),
+        the models use the shared OpenVINOBackend by default.
         """
 
+        self.backend = backend or self.get_default_backend()
+
         # OpenVINO 2020.1 loads extensions automatically
         if extensions: #and device.lower() == 'cpu':
-            self.core.add_extension(extension_path=extensions, device_name=device)
+            self.backend.add_extension(extension_path=extensions, device_name=device)
 
 
+        self.name = os.path.basename(model_name)
         self.model_xml = model_name + '.xml'
         self.model_bin = model_name + '.bin'
 
-        #self.network = self.core.read_network(model=self.model_xml, weights=self.model_bin)
-        self.network = IENetwork(model=self.model_xml, weights=self.model_bin)
-
-        # Check for unsupported layers
-        supported_layers = set(self.core.query_network(network=self.network, device_name=device).keys())
-        net_layers = set(self.network.layers.keys())
-        unsupported_layers = net_layers.difference(supported_layers)
-        if unsupported_layers:
-            raise Exception('Unsupported layers: ' + ','.join(unsupported_layers))
-
+        self.network = self.backend.read_network(self.model_xml, self.model_bin)
+
+        if preprocessing not in ('opencv', 'engine'):
+            raise Exception('Unknown preprocessing mode: ' + preprocessing)
+        self.preprocessing = preprocessing
+        if preprocessing == 'engine':
+            self._declare_image_inputs()
+
+        if batch_size > 1:
+            if concurrency < 1:
+                raise Exception('Batching requires asynchronous inference (concurrency must be positive)')
+            if preprocessing == 'engine':
+                raise Exception('Batching is not supported with the engine preprocessing')
+            self.network.batch_size = batch_size
+        self.batch_size = max(1, batch_size)
+        self.batch_timeout = batch_timeout
+
+        if profile_interval > 0:
+            # The plugin collects the performance counters only on demand
+            config = dict(config or {}, PERF_COUNT='YES')
+
+        self.exe_network = None
+        if cache:
+            variant = preprocessing if self.batch_size == 1 else f'{preprocessing}-b{self.batch_size}'
+            cache_key = cache.make_key(self.model_xml, self.model_bin, device, config, variant=variant)
+            self.exe_network = cache.load(self.backend, cache_key, device, config, num_requests=max(1, concurrency))
+
+        if self.exe_network is None:
+            # Check for unsupported layers (a cached network has been checked already)
+            supported_layers = set(self.backend.query_network(network=self.network, device_name=device).keys())
+            net_layers = set(self.network.layers.keys())
+            unsupported_layers = net_layers.difference(supported_layers)
+            if unsupported_layers:
+                raise Exception('Unsupported layers: ' + ','.join(unsupported_layers))
+
+            self.exe_network = self.backend.load_network(network=self.network, device_name=device, 
+                config=config or {}, num_requests=max(1, concurrency))
+
+            if cache:
+                cache.store(self.exe_network, cache_key, device)
 
         self.input_name = next(iter(self.network.inputs))
         self.output_name = next(iter(self.network.outputs))
 
-        self.exe_network = self.core.load_network(network=self.network, device_name=device, num_requests=max(1, concurrency))
-
         self.concurrency = concurrency
-        self.request_index = 0
-        self.waiting_queue = deque()
-        self.output_queue = deque()
-        self.stats = Counter()
+        self.completion = threading.Condition()     # guards the request queues and signals completion of requests
+        self.waiting_queue = deque()    # indices of running requests (or None) in the order of inputs
+        self.output_queue = deque()     # the ready queue of output dictionaries and completion times in the order of inputs
+        self.output_time = None         # the completion time (time.perf_counter) of the last consumed output
+        self.free_requests = deque(range(concurrency))
+        self.request_status = [None] * concurrency
+        self.request_times = [None] * concurrency   # completion times of the requests
+        self.scratch = {}   # reusable arrays for resized images by (request index, input name)
+        self.input_refs = {}    # the images wrapped into blobs must be alive until the request is reused
+        self.batch_lock = threading.Lock()  # guards the batch which is being collected
+        self.batch_request = None   # index of the request collecting the batch
+        self.batch_layouts = {}     # batch slots (or None for placeholders) in the order of inputs, by request index
+        self.batch_deadline = 0
+        self.batch_count = 0
+        self.batches_started = 0
+        self.batched_inputs = 0
+        self.profiler = LayerProfiler(profile_interval)
+
+        for i in range(concurrency):
+            self.exe_network.requests[i].set_completion_callback(py_callback=self._on_completion, py_data=i)
+
+
+    @classmethod
+    def get_default_backend(cls):
+        """
+        Returns the backend shared by the models which don't specify their own one.
+        """
+        with cls.backend_lock:
+            if GenericModel.default_backend is None:
+                GenericModel.default_backend = OpenVINOBackend()
+            return GenericModel.default_backend
+
+
+    @staticmethod
+    def make_cpu_config(streams=0, threads=0, bind=None):
+        """
+        Returns the CPU plugin config with the specified number of throughput streams (requests executed
+        in parallel by the plugin), inference threads, and thread binding mode ('YES', 'NO', or 'NUMA').
+        Zero values and None leave the plugin defaults.
+        """
+        config = {}
+        if streams > 0:
+            config['CPU_THROUGHPUT_STREAMS'] = str(streams)
+        if threads > 0:
+            config['CPU_THREADS_NUM'] = str(threads)
+        if bind:
+            config['CPU_BIND_THREAD'] = bind
+        return config
 
 
     def feed_input(self, image):
@@ -64,45 +160,43 @@ class GenericModel:
         If the inference mode is synchronous or the number of asynchronous requests
         exceed the limit, the call will block until at least one request is completed.
         """
-
-        if self.concurrency == 0:   # Synchronous inference            
-            if input_dict:
-                self.exe_network.requests[0].infer(input_dict)
-                self.output_queue.append(self.exe_network.requests[0].outputs)
-                self._augment_perf_counts(self.exe_network.requests[0].get_perf_counts())
-            else:
-                self.output_queue.append(None)
-        
-        else:   # Asyncronous inference
-            
-            # If we hit the limit of concurrent requests, wait until something is finished
-            if len(self.waiting_queue) >= self.concurrency:
-                cur_request = self.waiting_queue.popleft()
-                # However, the waiting queue may contain requests, which are None (e.g. bad input indicators).
-                # We can remove a None request from the queue (so it's no longer overloaded) and pick the next
-                # free request (there must be one since we shortened the waiting queue and the number of busy 
-                # requests is always less than or equal to the length of the queue).
-                if cur_request:
-                    output_dict = cur_request.outputs if cur_request.wait(-1)==0 else None
-                    self._augment_perf_counts(cur_request.get_perf_counts())
-                else:
-                    output_dict = None
-                self.output_queue.append(output_dict)                
-            else:
-                cur_request = None
-
-            if not cur_request:
-                cur_request = self.exe_network.requests[self.request_index]
-                self.request_index = (self.request_index + 1) % self.concurrency
+        if not input_dict:
+            self._feed_placeholder()
+        elif self.batch_size > 1:
+            self._feed_batch_item({}, input_dict)
+        else:
+            request_index = self._acquire_request()
+            self._start_request(request_index, input_dict)
 
 
-            if input_dict:  
-                cur_request.async_infer(input_dict)
-                self.waiting_queue.append(cur_request)
-            else:
-                # Requests for previous frames might be still running,
-                # so we can't produce output before they are done
-                self.waiting_queue.append(None)
+    def feed_input_images(self, images, inputs=None):
+        """
+        Resizes the images and converts them to the CHW layout directly in the input blobs of an inference
+        request, which is then fed to the model. No temporary arrays are created except for the reusable
+        scratch buffers. The images parameter is a dictionary mapping input names to HWC images. Other inputs
+        are copied to the blobs as is. If any image is missing or empty, the model is fed with a placeholder
+        which produces None. Blocks under the same conditions as feed_input_dict.
+        """
+        if any(image is None or image.size < 1 for image in images.values()):
+            self._feed_placeholder()
+            return
+
+        if self.batch_size > 1:
+            self._feed_batch_item(images, inputs or {})
+            return
+
+        request_index = self._acquire_request()
+        request = self.exe_network.requests[request_index]
+        if self.preprocessing == 'engine':
+            self._set_image_blobs(request_index, images)
+        else:
+            for name, image in images.items():
+                buffer = self._get_input_buffer(request, name)
+                scratch_key = (request_index, name)
+                self.scratch[scratch_key] = helpers.resize_into(image, buffer[0], self.scratch.get(scratch_key))
+        for name, value in (inputs or {}).items():
+            np.copyto(self._get_input_buffer(request, name), value, casting='unsafe')
+        self._start_request(request_index)
 
 
     def consume_output_dict(self, wait):
@@ -112,33 +206,41 @@ class GenericModel:
         is the output dictionary. The wait parameter specifies whether the function 
         has to wait for the current inference request to finish in case no result is 
         available at the moment of the call. The function never waits if there are no
-        busy requests or the result is already available.
-        """
-
-        if self.output_queue:
-            return True, self.output_queue.popleft()
-
-        if self.waiting_queue:
-            request = self.waiting_queue[0]
-            if request:
-                if wait:    
-                    status = request.wait(-1)      
-                    outputs = request.outputs if status==0 else None
-                    self.waiting_queue.popleft()                    
-                    self._augment_perf_counts(request.get_perf_counts())              
-                    return True, outputs
-                else:   # don't wait                    
-                    if request.wait(0) == 0:    # result available
-                        self.waiting_queue.popleft()
-                        self._augment_perf_counts(request.get_perf_counts())
-                        return True, request.outputs
-                    else:
+        busy requests or the result is already available. If the oldest result belongs
+        to a batch which is not full yet, the batch is started once its timeout expires.
+        """
+
+        while True:
+            with self.completion:
+                if self.output_queue:
+                    return True, self._pop_output()
+
+                if not self.waiting_queue:
+                    return False, None  # both queues are empty, nothing to wait for
+
+                # The batch lock can't be acquired while holding the completion lock
+                batch_pending = self.waiting_queue[0] == self.batch_request
+                if not batch_pending:
+                    if not wait:
                         return False, None
-            else:   # request is None
-                return True, None
+                    self.completion.wait()
+                    continue
+
+                timeout = self.batch_deadline - time.perf_counter()
+                if wait and timeout > 0:
+                    self.completion.wait(timeout)
+                    continue
+
+            with self.batch_lock:
+                if self.batch_request is not None and time.perf_counter() >= self.batch_deadline:
+                    self._start_batch()
+
+            if not wait:
+                with self.completion:
+                    if self.output_queue:
+                        return True, self._pop_output()
+                return False, None
 
-        # Both queues are empty, nothing to wait for
-        return False, None  
 
     def consume_output(self, wait):
         """
@@ -155,59 +257,246 @@ class GenericModel:
 
     def get_stats(self):
         """
-        Returns the dictionary containing layer-wise performance counters.
+        Returns the list of layer-wise performance statistics (see LayerProfiler.get_layer_stats).
         """
-        return self.stats
+        with self.completion:
+            return self.profiler.get_layer_stats()
 
     def reset_stats(self):
         """
-        Resets layer performance counters to zero.
+        Discards the collected layer performance statistics.
+        """
+        with self.completion:
+            self.profiler.reset()
+
+    def print_stats(self, title, top=10):
+        """
+        Prints the top layers of the model by execution time.
         """
-        self.stats = Counter()
+        with self.completion:
+            table = self.profiler.format_top(top)
+        logging.info(f'{title}\n{table}')
 
-    def print_stats(self, title):
+
+    def _feed_placeholder(self):
+        """
+        Feeds the model with a placeholder (bad input indicator) which produces None output
+        without running inference. 
+        Private method, to be used by GenericModel only.
         """
-        Prints layer-wise performance of the model.
+        if self.batch_size > 1:
+            with self.batch_lock:
+                if self.batch_request is not None:
+                    # The placeholder must come out between the neighboring items of the batch
+                    self.batch_layouts[self.batch_request].append(None)
+                    return
+
+        with self.completion:
+            if self.concurrency == 0:
+                self.output_queue.append((None, time.perf_counter()))
+            else:
+                # Requests for previous frames might be still running,
+                # so we can't produce output before they are done
+                self.waiting_queue.append(None)
+                self._release_completed()
+
+
+    def _pop_output(self):
+        """
+        Takes the oldest output dictionary from the output queue and remembers its completion time.
+        The completion lock must be held by the caller.
+        Private method, to be used by GenericModel only.
         """
-        
-        # No need to show the log level and datetime for a multiline message
-        logger = logging.getLogger()
-        original_formatter = logger.handlers[0].formatter        
-        logger.handlers[0].setFormatter(logging.Formatter(fmt='%(message)s'))        
-        logger.info(title)
+        output_dict, self.output_time = self.output_queue.popleft()
+        return output_dict
 
-        if self.stats:
-            for layer_name, execution_time in self.stats.items():
-                # cpu_time and real_time seem to be measured in microseconds, 
-                # but the documentation is not really clear about it
-                logger.info(f'{layer_name} : {execution_time} us')    
+
+    def _feed_batch_item(self, images, inputs):
+        """
+        Writes the inputs to the next slot of the batch which is being collected. Starts a new batch if 
+        there is none or the current one has timed out. The batch is started once all slots are filled.
+        Private method, to be used by GenericModel only.
+        """
+        with self.batch_lock:
+            if self.batch_request is not None and time.perf_counter() >= self.batch_deadline:
+                self._start_batch()
+
+            if self.batch_request is None:
+                # The request takes its place in the waiting queue now, so the outputs keep the order of inputs
+                self.batch_request = self._acquire_request()
+                self.batch_layouts[self.batch_request] = []
+                self.batch_deadline = time.perf_counter() + self.batch_timeout
+                self.batch_count = 0
+
+            request_index = self.batch_request
+            request = self.exe_network.requests[request_index]
+            slot = self.batch_count
+            for name, image in images.items():
+                buffer = self._get_input_buffer(request, name)
+                scratch_key = (request_index, name)
+                self.scratch[scratch_key] = helpers.resize_into(image, buffer[slot], self.scratch.get(scratch_key))
+            for name, value in inputs.items():
+                np.copyto(self._get_input_buffer(request, name)[slot:slot+1], value, casting='unsafe')
+
+            self.batch_layouts[request_index].append(slot)
+            self.batch_count += 1
+            self.batched_inputs += 1
+            if self.batch_count == self.batch_size:
+                self._start_batch()
+
+
+    def _start_batch(self):
+        """
+        Starts the request with the collected batch. The unused slots contain stale data, 
+        their outputs are ignored. The batch lock must be held by the caller.
+        Private method, to be used by GenericModel only.
+        """
+        request_index = self.batch_request
+        self.batch_request = None
+        self.batches_started += 1
+        self._start_request(request_index)
+
+
+    def _acquire_request(self):
+        """
+        Picks a free inference request and returns its index. In the asynchronous mode the request
+        is added to the waiting queue. If we hit the limit of concurrent requests, waits until something 
+        is finished. Requests are released by the completion callback in the order they were fed.
+        Private method, to be used by GenericModel only.
+        """
+        if self.concurrency == 0:   # Synchronous inference
+            return 0
+
+        with self.completion:
+            while not self.free_requests:
+                self.completion.wait()
+            request_index = self.free_requests.popleft()
+            self.request_status[request_index] = None
+            self.waiting_queue.append(request_index)
+            return request_index
+
+
+    def _start_request(self, request_index, input_dict=None):
+        """
+        Runs the acquired inference request. If the input dictionary is not specified, the input blobs 
+        must be filled in advance. In the synchronous mode the call blocks until the output is ready.
+        Private method, to be used by GenericModel only.
+        """
+        request = self.exe_network.requests[request_index]
+
+        if self.concurrency == 0:   # Synchronous inference
+            request.infer(input_dict)
+            # The request will be reused, so its output blobs have to be copied
+            output_dict = { name : blob.copy() for name, blob in request.outputs.items() }
+            with self.completion:
+                self._sample_perf_counts(request)
+                self.output_queue.append((output_dict, time.perf_counter()))
         else:
-            logger.info('No data')
+            # The callback acquires the lock, so the request must be started outside of it
+            request.async_infer(input_dict)
+
 
-        logger.handlers[0].setFormatter(original_formatter) # restore the log format
+    def _declare_image_inputs(self):
+        """
+        Declares all 4D inputs of the network as NHWC U8 images of arbitrary size, so the inference engine 
+        resizes them and converts the layout and the precision itself.
+        Private method, to be used by GenericModel only.
+        """
+        if Blob is None:
+            raise Exception('The engine preprocessing requires OpenVINO 2020.2 or newer')
 
+        # OpenVINO 2020.2 and newer provide input_info, while 2020.1 has only inputs
+        inputs = self.network.input_info if hasattr(self.network, 'input_info') else self.network.inputs
+        self.image_inputs = set()
+        for name, input_info in inputs.items():
+            if len(self.network.inputs[name].shape) == 4:
+                input_info.precision = 'U8'
+                input_info.layout = 'NHWC'
+                input_info.preprocess_info.resize_algorithm = ResizeAlgorithm.RESIZE_BILINEAR
+                self.image_inputs.add(name)
 
-    def _preprocess_input(self, image, width, height):
+
+    def _set_image_blobs(self, request_index, images):
         """
-        Performs default preprocessing of the input:
-        1) Resizes the image to the desired resolution
-        2) Converts the channel order from HWC to CHW
-        3) Adds the batch dimension
-        Protected method, to be used by GenericModel and descendant classes.
+        Wraps the images into NHWC U8 blobs and sets them as inputs of the inference request. 
+        The blob must reside in contiguous memory, so only crops (views with gaps between rows) 
+        and reflected frames are copied, while whole frames are passed as is.
+        Private method, to be used by GenericModel only.
         """
+        refs = []
+        for name, image in images.items():
+            image = np.ascontiguousarray(image[None,...])
+            _, h, w, c = image.shape
+            tensor_desc = TensorDesc(precision='U8', dims=[1, c, h, w], layout='NHWC')
+            self.exe_network.requests[request_index].set_blob(blob_name=name, blob=Blob(tensor_desc, image))
+            refs.append(image)
+        self.input_refs[request_index] = refs
+
 
-        if image is not None and image.size>0 and width>0 and height>0:
-            frame_resized = cv2.resize(src=image, dsize=(width, height))
-            frame_resized = np.moveaxis(frame_resized, -1, 0)[None,...] # HWC -> BCHW
-            return frame_resized
+    def _get_input_buffer(self, request, input_name):
+        """
+        Returns the numpy array which shares memory with the input blob of the inference request.
+        Private method, to be used by GenericModel only.
+        """
+        # OpenVINO 2020.2 and newer expose the blobs, while 2020.1 exposes their buffers directly
+        if hasattr(request, 'input_blobs'):
+            return request.input_blobs[input_name].buffer
         else:
-            return None
-    
+            return request.inputs[input_name]
+
+
+    def _on_completion(self, status, request_index):
+        """
+        The completion callback of the inference requests. It is called by OpenVINO from its own thread.
+        Private method, to be used by GenericModel only.
+        """
+        with self.completion:
+            self.request_status[request_index] = status
+            self.request_times[request_index] = time.perf_counter()
+            self._release_completed()
+
+
+    def _release_completed(self):
+        """
+        Moves the outputs of completed requests from the head of the waiting queue to the output queue,
+        so the results are kept in the order of inputs, and frees the requests for further use.
+        The completion lock must be held by the caller.
+        Private method, to be used by GenericModel only.
+        """
+        while self.waiting_queue:
+            request_index = self.waiting_queue[0]
+            if request_index is not None:
+                status = self.request_status[request_index]
+                if status is None:  # still running
+                    break
+                request = self.exe_network.requests[request_index]
+                layout = self.batch_layouts.pop(request_index, None)
+                if layout is None:
+                    # The request will be reused, so its output blobs have to be copied
+                    output_dicts = [ { name : blob.copy() for name, blob in request.outputs.items() } if status == 0 else None ]
+                else:
+                    # Scatter the batch outputs in the order of inputs
+                    outputs = request.outputs if status == 0 else None
+                    output_dicts = [ { name : blob[slot:slot+1].copy() for name, blob in outputs.items() } 
+                                     if outputs is not None and slot is not None else None for slot in layout ]
+                self._sample_perf_counts(request)
+                self.free_requests.append(request_index)
+                completion_time = self.request_times[request_index]
+            else:
+                output_dicts = [ None ]
+                completion_time = time.perf_counter()
+
+            self.waiting_queue.popleft()
+            self.output_queue.extend((output_dict, completion_time) for output_dict in output_dicts)
+
+        self.completion.notify_all()
+
 
-    def _augment_perf_counts(self, perf_counts):
+    def _sample_perf_counts(self, request):
         """
-        Accumulates performance counters for each layer in the model.
+        Passes the performance counters of the completed request to the profiler if it's time to sample them.
+        The completion lock must be held by the caller.
         Private method, to be used by GenericModel only.
         """
-        layer_timings = { layer_name : v.get('real_time', 0) for layer_name, v in perf_counts.items() }
-        self.stats.update(layer_timings)
\ No newline at end of file
+        if self.profiler.should_sample():
+            self.profiler.add(request.get_perf_counts())
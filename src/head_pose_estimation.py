@@ -5,14 +5,14 @@ class HeadPoseEstimator(GenericModel):
     A class for head pose estimation.
     """
 
-    def __init__(self, precision, concurrency, device='CPU', extensions=None):
+    def __init__(self, precision, concurrency, device='CPU', extensions=None, **kwargs):
         """
         Initializes a new head pose estimation model instance.
         """
 
         super().__init__(
             model_name=f'../models/intel/head-pose-estimation-adas-0001/{precision}/head-pose-estimation-adas-0001', 
-            concurrency=concurrency, device=device, extensions=extensions)
+            concurrency=concurrency, device=device, extensions=extensions, **kwargs)
 
         self.input_shape = self.network.inputs[self.input_name].shape
 
@@ -26,9 +26,7 @@ class HeadPoseEstimator(GenericModel):
         Takes in the face image, preprocesses it, and feeds to the model for inference.
         Depending on the inference mode, the call may be blocking or not.
         """
-        face_image_preprocessed = self._preprocess_input(face_image, 
-            width=self.input_shape[3], height=self.input_shape[2])
-        super().feed_input(face_image_preprocessed)
+        self.feed_input_images({ self.input_name : face_image })
 
     def consume_output(self, wait):
         """
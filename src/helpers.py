@@ -1,5 +1,12 @@
 import cv2
 import math
+import sys
+import numpy as np
+try:
+    # Not available on Windows
+    import resource
+except ImportError:
+    resource = None
 
 def crop(image, box):
     """
@@ -40,9 +47,10 @@ def clamp(value, range_min, range_max):
 
 
 
-def draw_gaze_vector(image, box, gx, gy):
+def draw_gaze_vector(image, box, gx, gy, in_place=False):
     """
-    Draws a gaze vector and a face bounding box.
+    Draws a gaze vector and a face bounding box. Returns a copy of the image with the drawings
+    unless in_place is specified, in which case the image itself is drawn on and returned.
     """
 
     if box is None:
@@ -55,7 +63,7 @@ def draw_gaze_vector(image, box, gx, gy):
     p1 = ((box[0]+box[2])//2, (box[1]+box[3])//2)
     p2 = (int(p1[0]+gx), int(p1[1]-gy))     # OpeCV's y axis is directed to down
 
-    output_image = image.copy()
+    output_image = image if in_place else image.copy()
     cv2.arrowedLine(output_image, p1, p2, color=(0,255,0))
     cv2.rectangle(output_image, (box[0], box[1]), (box[2], box[3]), color=(0,0,255))
     return output_image
@@ -72,4 +80,31 @@ def draw_landmarks(face_image, landmarks):
         y = int(h*landmarks[0, i+1])
         res_img = cv2.circle(res_img, (x,y), radius=2, color=(0,255,0))
 
-    return res_img
\ No newline at end of file
+    return res_img
+
+def resize_into(image, buffer, scratch=None):
+    """
+    Resizes the HWC image and writes it to the CHW buffer (e.g. an inference request input blob) converting
+    the data type if necessary. The scratch is a reusable HWC array for the resized image. Returns the scratch 
+    array to be passed to the next call. A horizontally reflected view (negative stride) is resized as is and 
+    reflected while copying to the buffer, so OpenCV doesn't have to make a contiguous copy of it.
+    """
+    c, h, w = buffer.shape
+    if scratch is None or scratch.shape != (h, w, c) or scratch.dtype != image.dtype:
+        scratch = np.empty((h, w, c), dtype=image.dtype)
+
+    reflected = image.strides[1] < 0
+    cv2.resize(src=image[:, ::-1] if reflected else image, dsize=(w, h), dst=scratch)
+    chw = scratch.transpose(2, 0, 1)
+    np.copyto(buffer, chw[:, :, ::-1] if reflected else chw, casting='unsafe')
+    return scratch
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes or None if it's unknown (e.g. on Windows).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, while macOS reports bytes
+    return peak if sys.platform == 'darwin' else 1024 * peak
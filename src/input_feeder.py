@@ -1,17 +1,29 @@
 import cv2
+import numpy as np
 from numpy import ndarray
+from collections import deque
+import threading
+import time
 
 class InputFeeder:
 
-    def __init__(self, input):
+    def __init__(self, input, prefetch=0, policy='all', start_frame=0, frame_count=None):
         """
-        Creates an input feed from an image or a video file. In order to use a webcam feed, pass in 'cam' as input.        
+        Creates an input feed from an image or a video file. In order to use a webcam feed, pass in 'cam' as input.
+        Other cameras can be selected by their index, e.g. 'cam1'.
+        The prefetch parameter specifies the number of frame buffers to be decoded in the background thread.
+        Pass zero to read frames synchronously. The policy defines what happens when all buffers are filled:
+        'all' makes the background thread wait until a buffer is recycled (no frames are lost), while 'latest'
+        keeps only the newest decoded frame (the older ones are dropped), so the consumer always gets the most recent one.
+        The start frame and the frame count limit reading of a video file to a range of frames
+        (the whole file by default).
         """
-                        
+
         self.input = input.lower()
+        self.is_cam = self.input.startswith('cam') and (self.input[3:] == '' or self.input[3:].isdigit())
 
-        if self.input == 'cam':            
-            self.cap = cv2.VideoCapture(0)
+        if self.is_cam:
+            self.cap = cv2.VideoCapture(int(self.input[3:] or 0))
         else:
             # Restore the original letter case (important for file names)
             self.input = input
@@ -21,23 +33,151 @@ class InputFeeder:
 
         if not self.cap.isOpened():
             raise Exception('Failed to open the input: ' + self.input)
-        
-    
+
+        if policy not in ('all', 'latest'):
+            raise Exception('Unknown frame policy: ' + policy)
+
+        if start_frame > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        self.prefetch = prefetch
+        self.policy = policy
+        self.frames_left = frame_count  # None stands for reading until the end of the file
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self.decode_time = 0
+        self.frame_time = None  # the time when the last frame returned by read_next was captured
+        self.frame_decode_start = None  # the time when decoding of that frame started
+
+        if prefetch > 0:
+            self.lock = threading.Condition()
+            self.free_buffers = deque([None] * prefetch) # None stands for a buffer which is not allocated yet
+            self.ready_buffers = deque()    # decoded frames in the order of reading
+            self.lent_buffers = {}          # buffers given out to the consumer, by id
+            self.end_of_stream = False
+            self.closed = False
+            self.thread = threading.Thread(target=self._read_frames, name='input-feeder', daemon=True)
+            self.thread.start()
+
+
     def read_next(self):
         """
         Reads the next frame from the input stream. If the next frame is not available, returns None.
         In case the source is a webcam, the frame will be automatically reflected.
+        When prefetching is enabled, the frame must be returned to the feeder by calling recycle
+        after it's no longer needed.
         """
-        read, frame = self.cap.read()
-        if read:
-            return frame[:,::-1,:] if self.input=='cam' else frame
+        if self.prefetch > 0:
+            with self.lock:
+                while not self.ready_buffers and not self.end_of_stream:
+                    self.lock.wait()
+                if not self.ready_buffers:
+                    return None
+                frame, self.frame_decode_start, self.frame_time = self.ready_buffers.popleft()
+                self.lent_buffers[id(frame)] = frame
+                self.lock.notify_all()
         else:
-            return None
+            t = time.perf_counter()
+            read, frame = self._read()
+            self.frame_time = time.perf_counter()
+            self.frame_decode_start = t
+            self.decode_time += self.frame_time - t
+            if not read:
+                return None
+            self.frames_decoded += 1
+
+        return frame[:,::-1,:] if self.is_cam else frame
+
+
+    def recycle(self, frame):
+        """
+        Returns the frame obtained from read_next back to the ring buffer, so it can be reused
+        for decoding. Does nothing if prefetching is disabled.
+        """
+        if self.prefetch < 1 or frame is None:
+            return
+
+        with self.lock:
+            # The frame may be a reflected view of the buffer
+            buffer = frame if id(frame) in self.lent_buffers else frame.base
+            if buffer is not None and self.lent_buffers.pop(id(buffer), None) is not None:
+                self.free_buffers.append(buffer)
+                self.lock.notify_all()
+
+
+    def get_decode_fps(self):
+        """
+        Returns the decoding speed in frames per second (not counting the time spent waiting for free buffers).
+        """
+        return self.frames_decoded / self.decode_time if self.decode_time > 0 else 0
 
 
     def close(self):
         """
-        Closes the VideoCapture.
+        Stops the background thread and closes the VideoCapture.
         """
+        if self.prefetch > 0:
+            with self.lock:
+                self.closed = True
+                self.lock.notify_all()
+            self.thread.join()
+
         self.cap.release()
 
+
+    def _read(self, buffer=None):
+        """
+        Decodes the next frame (into the buffer, if specified) unless the frame range is exhausted.
+        Returns a tuple like cv2.VideoCapture.read does.
+        Private method, to be used by InputFeeder only.
+        """
+        if self.frames_left == 0:
+            return False, None
+
+        read, frame = self.cap.read(buffer) if buffer is not None else self.cap.read()
+        if read and self.frames_left is not None:
+            self.frames_left -= 1
+        return read, frame
+
+
+    def _read_frames(self):
+        """
+        The background thread routine which decodes frames into the ring of buffers.
+        Private method, to be used by InputFeeder only.
+        """
+        while True:
+            with self.lock:
+                while not self.free_buffers and not self.closed:
+                    if self.policy == 'latest' and self.ready_buffers:
+                        # The consumer is lagging behind, so the stale frame is dropped
+                        self.free_buffers.append(self.ready_buffers.popleft()[0])
+                        self.frames_dropped += 1
+                    else:
+                        self.lock.wait()
+                if self.closed:
+                    return
+                buffer = self.free_buffers.popleft()
+
+            t = time.perf_counter()
+            read, frame = self._read(buffer)
+            frame_time = time.perf_counter()
+            self.decode_time += frame_time - t
+
+            with self.lock:
+                if not read:
+                    self.end_of_stream = True
+                    self.lock.notify_all()
+                    return
+
+                if buffer is None:
+                    # Now that the frame size is known, allocate the rest of the ring
+                    self.free_buffers = deque(np.empty_like(frame) if b is None else b for b in self.free_buffers)
+
+                self.ready_buffers.append((frame, t, frame_time))
+                self.frames_decoded += 1
+                if self.policy == 'latest':
+                    # The consumer only wants the newest frame, so the older ones are recycled right away
+                    while len(self.ready_buffers) > 1:
+                        self.free_buffers.append(self.ready_buffers.popleft()[0])
+                        self.frames_dropped += 1
+                self.lock.notify_all()
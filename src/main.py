@@ -1,39 +1,165 @@
 from input_feeder import InputFeeder
+from backends import SyntheticBackend
+from allocation import MODELS, parse_threads, parse_bind, parse_model_config, resolve_settings, get_model_args, allocate
 from face_detection import FaceDetector
 from facial_landmarks_detection import EyeDetector
 from head_pose_estimation import HeadPoseEstimator
 from gaze_estimation import GazeEstimator
-from mouse_controller import MouseController
-from collections import deque
+from mouse_controller import MouseController, RecordingBackend
+from display import Display
+from network_cache import NetworkCache
+from face_tracking import FaceTracker
+from result_cache import ResultCache
+from profiler import save_profiles
+from pipeline import Pipeline, ModelStage, RouterStage
+from recording import Recorder, Recording
+from quality import QualityController, LEVERS, preload
+from stages import InputStage, FaceDetectionStage, LandmarksStage, HeadPoseStage, GazeStage, SinkStage, \
+    RecordStage, ReplayStage
+from concurrent.futures import ThreadPoolExecutor, wait
 import helpers
-import cv2
 import argparse
 import time
 import logging
+import yaml
 #import traceback
 
 
 parser = argparse.ArgumentParser(description="Computer Pointer Controller")
-parser.add_argument('--input', type=str, required=True,
-                    help="An input file name or 'cam' to capture input from a webcam.")
+parser.add_argument('--input', type=str, required=True, nargs='+',
+                    help="An input file name or 'cam' to capture input from a webcam (other webcams can be selected "
+                        "by their index, e.g. 'cam1'). Several inputs enable the multi-stream mode.")
 parser.add_argument('--device', type=str, default='cpu', 
                     help="Device name to perform inference on. Defaults to CPU.")
 parser.add_argument('--ext', type=str, default=None,
                     help="Specifies the extension to use with the device.")
+parser.add_argument('--backend', type=str, default='openvino', choices=['openvino', 'synthetic'],
+                    help="Specifies the inference backend: 'openvino' (default) or 'synthetic', which emulates the models "
+                        "without OpenVINO and the model files (see backends.py).")
 parser.add_argument('--precision', type=str, default='FP32',
                     help="Specifies the model precision to use: FP32, FP16, or FP32-INT8. Default is FP32.")
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help="Specifies the directory for caching compiled networks, which speeds up model loading. "
+                        "Caching is disabled by default.")
+parser.add_argument('--preprocessing', type=str, default='opencv', choices=['opencv', 'engine'],
+                    help="Specifies who resizes the model inputs and converts their layout: 'opencv' (default) "
+                        "or 'engine' (the inference engine's built-in preprocessing). The engine takes contiguous images only, "
+                        "so the face and eye crops and reflected webcam frames are still copied once.")
 parser.add_argument('--concurrency', type=int, default=1, 
                     help="Defines the number of concurrent requests each model can execute. "
                         "Pass zero for synchronous inference. Default is 1.")
+parser.add_argument('--cpu-streams', type=int, default=0,
+                    help="Defines the number of CPU throughput streams (requests executed in parallel by the plugin) "
+                        "of each model. Pass zero for the plugin default (default).")
+parser.add_argument('--cpu-threads', type=parse_threads, default=0,
+                    help="Defines the number of CPU inference threads of each model. Pass 'auto' to split the cores "
+                        "between the models in proportion to their measured cost. Pass zero for the plugin default (default).")
+parser.add_argument('--cpu-bind', type=parse_bind, default=None, choices=['YES', 'NO', 'NUMA'],
+                    help="Specifies whether the CPU plugin binds the inference threads to cores: YES, NO, or NUMA. "
+                        "The plugin decides by default (NO with the 'auto' threads).")
+parser.add_argument('--model-config', type=str, nargs='+', default=None,
+                    help="Overrides the device and the CPU settings of particular models as MODEL.SETTING=VALUE, e.g. "
+                        "face-detection.threads=4 gaze.device=MULTI:CPU,GPU. The models are face-detection, landmarks, "
+                        "head-pose, and gaze. The settings are device, streams, threads (a number or 'auto'), and bind.")
+parser.add_argument('--calibration-runs', type=int, default=20,
+                    help="Defines the number of inferences measuring the cost of each model for the 'auto' threads. "
+                        "Default is 20.")
+parser.add_argument('--batch', type=int, default=1,
+                    help="Defines the batch size of the landmarks and head pose models. The inputs are gathered "
+                        "until the batch is full or the batch timeout expires. Requires positive concurrency. Default is 1.")
+parser.add_argument('--batch-timeout', type=float, default=5,
+                    help="Defines how long (in milliseconds) an incomplete batch waits for more inputs. Default is 5.")
+parser.add_argument('--prefetch', type=int, default=16,
+                    help="Defines the number of frame buffers decoded in the background. Pass zero to read "
+                        "frames synchronously. Default is 16.")
+parser.add_argument('--frame-policy', type=str, default=None, choices=['all', 'latest'],
+                    help="Specifies what to do when all frame buffers are filled: 'all' waits for a free buffer, "
+                        "'latest' drops stale frames. Default is 'latest' for a webcam and 'all' for files.")
+parser.add_argument('--queue-size', type=int, default=4,
+                    help="Defines the number of frames which can wait between two adjacent pipeline stages. Default is 4.")
+parser.add_argument('--max-in-flight', type=int, default=0,
+                    help="Limits the number of frames which have been read but not completed yet: reading waits until "
+                        "a frame leaves the pipeline. Pass zero to rely on the queue sizes only (default).")
+parser.add_argument('--latency-budget', type=float, default=0,
+                    help="Enables the real-time mode with the specified latency budget (in milliseconds): the frames "
+                        "which can't be processed in time are dropped. Pass zero to process all frames (default).")
+parser.add_argument('--target-fps', type=float, default=0,
+                    help="Enables the adaptive quality controller which holds the specified frame rate (input frames handled "
+                        "per second) by switching the --adapt-levers. Disabled by default.")
+parser.add_argument('--target-latency', type=float, default=0,
+                    help="Enables the adaptive quality controller which holds the 95th percentile of the frame latency "
+                        "(in milliseconds) below the specified value. Can be combined with --target-fps. Disabled by default.")
+parser.add_argument('--adapt-levers', type=str, nargs='+', default=LEVERS, choices=LEVERS,
+                    help="Specifies the levers of the quality controller in the order of application: switching the slowest "
+                        "model to --fallback-precision, running face detection less often, and skipping frames. Default is all.")
+parser.add_argument('--fallback-precision', type=str, default=None,
+                    help="Specifies the precision of the models preloaded in the background for the quality controller, "
+                        "e.g. FP32-INT8. The precision lever is unavailable without it.")
+parser.add_argument('--adapt-period', type=float, default=1.0,
+                    help="Defines how often (in seconds) the quality controller measures the pipeline. Default is 1.")
+parser.add_argument('--motion-threshold', type=float, default=0,
+                    help="Enables motion-gated inference: the head pose and the gaze vector are reused while the mean "
+                        "difference of the downsampled face and eye images (0..255) is below the threshold. "
+                        "Pass zero to run the models on every frame (default).")
+parser.add_argument('--motion-angle', type=float, default=5,
+                    help="Defines the largest change of the head pose angles (in degrees) for which motion-gated inference "
+                        "reuses the gaze vector. Default is 5.")
+parser.add_argument('--max-reuse', type=int, default=5,
+                    help="Defines the number of frames a cached output can be reused for. Default is 5.")
+parser.add_argument('--motion-cache', type=int, default=8,
+                    help="Defines the number of outputs kept by each motion-gated stage. Default is 8.")
+parser.add_argument('--record', type=str, default=None,
+                    help="Specifies the directory for recording the model outputs of every frame. Disabled by default.")
+parser.add_argument('--record-eyes', action='store_true', default=False,
+                    help="Records the eye images along with the model outputs.")
+parser.add_argument('--replay', type=str, default=None,
+                    help="Specifies the directory of a recording whose model outputs are used instead of running "
+                        "the models preceding the --replay-from stage.")
+parser.add_argument('--replay-from', type=str, default='gaze', choices=['landmarks', 'head-pose', 'gaze', 'sink'],
+                    help="Specifies the first stage which is recomputed in the replay mode. Default is gaze.")
 parser.add_argument('--confidence', type=float, default=0.5,
                     help="Specifies face detection probability threshold. Must be in range from 0 to 1. "
                         "Default is 0.5.")
+parser.add_argument('--track', type=int, default=0,
+                    help="Enables face tracking: the face detector runs once in the specified number of frames "
+                        "or when the tracker loses the face. Pass zero to detect faces on every frame (default).")
+parser.add_argument('--face-policy', type=str, default='confidence', choices=['confidence', 'largest', 'nearest', 'all'],
+                    help="Specifies which of the detected faces is processed: the most probable one (default), the largest one, "
+                        "the one nearest to the previous face, or all faces up to --max-faces. The mouse follows the gaze "
+                        "of the first face.")
+parser.add_argument('--max-faces', type=int, default=4,
+                    help="Defines the maximum number of faces processed per frame with --face-policy all. Default is 4.")
+parser.add_argument('--roi-scale', type=float, default=0,
+                    help="Enables the search window mode: the face detector runs on a square window around the previous face "
+                        "whose side is the specified number of times larger than the face, e.g. 3. Pass zero to detect "
+                        "faces on the whole frame (default).")
+parser.add_argument('--roi-interval', type=int, default=30,
+                    help="Defines how often (once in the specified number of detections) the face detector runs on the whole "
+                        "frame in the search window mode. It also does after a miss. Pass zero to fall back only on "
+                        "a miss. Default is 30.")
+parser.add_argument('--nms', type=float, default=0,
+                    help="Enables non-maximum suppression of the face detections overlapping a more probable one by "
+                        "a larger intersection over union (0..1), e.g. 0.5. Pass zero to disable it (default).")
 parser.add_argument('--failsafe', action='store_true', default=False, 
                     help="Enables the fail-safe feature of PyAutoGUI. By default, it's disabled.")
 parser.add_argument('--clean', action='store_true', default=False,
                     help="Enables visualization of intermediate model outputs. Active by default.")
+parser.add_argument('--display-rate', type=float, default=60,
+                    help="Defines the refresh rate (in Hz) of the output windows, e.g. the monitor's rate. Only the newest "
+                        "frame is shown on each refresh. Default is 60.")
+parser.add_argument('--trace', type=str, default=None,
+                    help="Specifies the file for saving the processing steps of every frame in the Chrome trace format "
+                        "(can be viewed by chrome://tracing or Perfetto). Disabled by default.")
 parser.add_argument('--stats', action='store_true', default=False,
                     help="Prints per-layer performance statistics. Disabled by default.")
+parser.add_argument('--stats-interval', type=int, default=10,
+                    help="Defines how often (once in the specified number of requests) the layer performance "
+                        "counters are sampled. Default is 10.")
+parser.add_argument('--stats-top', type=int, default=10,
+                    help="Defines the number of the slowest layers printed for each model. Default is 10.")
+parser.add_argument('--stats-file', type=str, default=None,
+                    help="Specifies the file (.json or .csv) for saving per-layer performance statistics. "
+                        "JSON files can be compared by profiler.py. Implies --stats.")
 parser.add_argument('--silent', action='store_true', default=False, 
                     help="Enables the silent mode when video output and the mouse control feature "
                         "are disabled. Useful for performance measurement. Disabled by default.")
@@ -41,8 +167,85 @@ parser.add_argument('--speed', type=str, default='medium',
                     help="Controls the mouse speed. Possible values: fast, slow, medium. Default is medium.")
 parser.add_argument('--log', type=str, default=None, 
                     help="Specifies the log file. Leave it empty to print log messages to the console (default).")
+parser.add_argument('--profile', type=str, default=None,
+                    help="Specifies a YAML file of argument values (e.g. the best configuration found by benchmark.py). "
+                        "The values are checked like the command line arguments, and the arguments given in the command line "
+                        "take precedence.")
+
+def parse_profile_value(action, value):
+    """
+    Converts a profile value the way the parser converts the command line argument of the action
+    and checks it against the choices. YAML values come typed, so they are converted from their strings
+    (booleans are kept for the flags and parse_bind). A dictionary is accepted for --model-config.
+    """
+    if value is None or isinstance(value, dict) and action.dest == 'model_config':
+        return value
+    if action.nargs == 0:
+        if not isinstance(value, bool):
+            raise Exception(f'expected true or false, got {value!r}')
+        return value
+    if action.nargs in ('+', '*'):
+        values = value if isinstance(value, list) else [ value ]
+        return [ parse_profile_value(argparse.Action(action.option_strings, action.dest, type=action.type,
+                                                     choices=action.choices), item) for item in values ]
+    if action.type is not None:
+        value = action.type(value if isinstance(value, bool) else str(value))
+    if action.choices is not None and value not in action.choices:
+        raise Exception(f'invalid choice {value!r} (choose from {", ".join(map(repr, action.choices))})')
+    return value
+
+
+def total(models, counter):
+    """
+    Sums the counter of the models a stage has run (see ModelStage.models).
+    """
+    return sum(getattr(model, counter) for model in models)
+
+
+def log_loading_time(futures, start_time):
+    """
+    Waits for the models to load and logs the loading time unless some of them has failed to load
+    (the error is reported by the pipeline).
+    """
+    wait(futures)
+    if all(future.exception() is None for future in futures):
+        logging.info(f'Model Loading Time: {time.time() - start_time:.4} s')
+
+
+# The profile replaces the defaults, so the command line arguments override it
+known_args, _ = parser.parse_known_args()
+if known_args.profile:
+    with open(known_args.profile) as f:
+        profile = { key.replace('-', '_') : value for key, value in (yaml.safe_load(f) or {}).items() }
+    unknown_keys = set(profile).difference(vars(known_args))
+    if unknown_keys:
+        parser.error('unknown arguments in the profile: ' + ', '.join(sorted(unknown_keys)))
+    actions = { action.dest : action for action in parser._actions }
+    for key, value in profile.items():
+        try:
+            profile[key] = parse_profile_value(actions[key], value)
+        except Exception as e:
+            parser.error(f'invalid value of {key} in the profile: {e}')
+    parser.set_defaults(**profile)
 
 args = parser.parse_args()
+args.stats = args.stats or args.stats_file is not None
+if args.batch > 1 and args.concurrency < 1:
+    parser.error('batching requires positive concurrency')
+if (args.record or args.replay) and len(args.input) > 1:
+    parser.error('recording and replay support a single input only')
+try:
+    model_settings = resolve_settings(parse_model_config(args.model_config), dict(device=args.device, 
+        streams=args.cpu_streams, threads=args.cpu_threads, bind=args.cpu_bind))
+except Exception as e:
+    parser.error(str(e))
+if args.backend == 'synthetic' and (args.cache_dir or args.preprocessing == 'engine'):
+    parser.error('the network cache and the engine preprocessing require the OpenVINO backend')
+if args.face_policy == 'all' and (args.track > 0 or args.record or args.replay or args.roi_scale > 0):
+    parser.error('the face tracking, the search window, and the recording can only follow a single face')
+adaptive = args.target_fps > 0 or args.target_latency > 0
+if adaptive and args.face_policy == 'all' and 'detection' in args.adapt_levers:
+    parser.error('the detection lever relies on face tracking, which can only follow a single face')
 
 # Set up logging
 logging.basicConfig(filename=args.log, level=logging.INFO, 
@@ -53,110 +256,240 @@ logging.info('Initialization...')
 
 try:
 
-    feed = InputFeeder(args.input)
+    feeds = []
+    for input in args.input:
+        frame_policy = args.frame_policy or ('latest' if input.lower().startswith('cam') else 'all')
+        feeds.append(InputFeeder(input, prefetch=args.prefetch, policy=frame_policy))
 
     t = -time.time()    # measure model loading time
-    faceDetector = FaceDetector(precision=args.precision, concurrency=args.concurrency, device=args.device, extensions=args.ext)
-    eyeDetector = EyeDetector(precision=args.precision, concurrency=args.concurrency, device=args.device, extensions=args.ext)
-    headPoseEstimator = HeadPoseEstimator(precision=args.precision, concurrency=args.concurrency, device=args.device, extensions=args.ext)
-    gazeEstimator = GazeEstimator(precision=args.precision, concurrency=args.concurrency, device=args.device, extensions=args.ext)
-    mouseController = MouseController(precision='high', speed=args.speed.lower(), failsafe=args.failsafe)
-    t += time.time()
+    networkCache = NetworkCache(args.cache_dir) if args.cache_dir else None
+
+    model_args = dict(precision=args.precision, concurrency=args.concurrency, extensions=args.ext, 
+                      cache=networkCache, preprocessing=args.preprocessing,
+                      backend=SyntheticBackend() if args.backend == 'synthetic' else None,
+                      profile_interval=args.stats_interval if args.stats else 0)
+    # Only the models fed with face crops benefit from batching
+    batch_args = dict(batch_size=args.batch, batch_timeout=args.batch_timeout/1000)
+    roi_args = dict(roi_scale=args.roi_scale, roi_interval=args.roi_interval)
+    # In the replay mode the outputs of the stages preceding the replay-from stage are loaded from the recording,
+    # so their models are not needed
+    # Only the display (see below) needs the whole frames after the replayed face detection
+    replayStage = ReplayStage(Recording(args.replay), args.replay_from, keep_frames=not args.silent) \
+        if args.replay else None
+    replayedStages = replayStage.replayed_stages if replayStage else []
+    modelClasses = { model : model_class for model, model_class in 
+                     zip(MODELS, (FaceDetector, EyeDetector, HeadPoseEstimator, GazeEstimator)) if model not in replayedStages }
+    modelArgs = { model : dict(model_args, **(batch_args if model in ('landmarks', 'head-pose') else {}),
+                               **(roi_args if model == 'face-detection' else {})) for model in modelClasses }
+
+    # The 'auto' threads are allocated in proportion to the model costs, which are measured beforehand
+    costs = {}
+    if any(model_settings[model]['threads'] == 'auto' for model in modelClasses):
+        logging.info('Measuring model costs...')
+        costs = allocate(model_settings, modelClasses, modelArgs, runs=args.calibration_runs)
+    if costs or args.model_config:
+        for model in modelClasses:
+            settings = model_settings[model]
+            cost = f', cost {1000*costs[model]:.2f} ms' if model in costs else ''
+            logging.info(f'{model}: device {settings["device"]}, streams {settings["streams"] or "default"}, '
+                         f'threads {settings["threads"] or "default"}, bind {settings["bind"] or "default"}{cost}')
 
-    logging.info(f'Model Loading Time: {t:.4} s')
+    # The models are loaded concurrently. The pipeline starts as soon as the face detector is ready,
+    # while the frames wait in the queues for the downstream models to load.
+    loader = ThreadPoolExecutor(max_workers=4)
+    modelsLoading = [ loader.submit(modelClasses[model], **modelArgs[model], **get_model_args(model_settings[model]))
+                      if model in modelClasses else None for model in MODELS ]
+    # The loading time is logged as soon as the last model is ready
+    loader.submit(log_loading_time, [ model_loading for model_loading in modelsLoading if model_loading ], -t)
+    loader.shutdown(wait=False)
+
+    # The silent mode doesn't move the mouse, so there is no need for a display. There is only one mouse 
+    # pointer, so it follows the first stream, while the moves of the other streams are just recorded.
+    mouseControllers = [ MouseController(precision='high', speed=args.speed.lower(), failsafe=args.failsafe,
+                                         backend=RecordingBackend() if args.silent or stream > 0 else None)
+                         for stream in range(len(feeds)) ]
+    # The detection lever of the quality controller changes the interval of the face trackers
+    track = args.track or (1 if adaptive and 'detection' in args.adapt_levers else 0)
+    faceTrackers = [ FaceTracker(interval=track) if track > 0 else None for _ in feeds ]
+
+    # The fallback models of the quality controller are loaded once the pipeline has its models
+    controller, fallbackLoader = None, None
+    if adaptive:
+        fallbackModels = {}
+        if args.fallback_precision and 'precision' in args.adapt_levers:
+            fallbackLoader = ThreadPoolExecutor(max_workers=1)
+            fallbackModels = { model : fallbackLoader.submit(preload, modelsLoading, modelClasses[model],
+                                   **dict(modelArgs[model], precision=args.fallback_precision),
+                                   **get_model_args(model_settings[model])) for model in modelClasses }
+            fallbackLoader.shutdown(wait=False)
+        controller = QualityController(target_fps=args.target_fps, target_latency=args.target_latency/1000,
+                                       period=args.adapt_period, levers=args.adapt_levers,
+                                       fallback_models=fallbackModels, face_trackers=faceTrackers)
+    headPoseCache, gazeCache = [ ResultCache(args.motion_threshold, args.max_reuse, capacity=args.motion_cache,
+                                             value_threshold=args.motion_angle)
+                                 if args.motion_threshold > 0 else None for _ in range(2) ]
+
+    # Each stream has its own sink. In the multi-stream mode the frames are routed to the sinks 
+    # after gaze estimation, while all streams share the model stages.
+    # The frames are shown by the main thread, so the sinks never wait for the GUI
+    display = Display(refresh_rate=args.display_rate) if not args.silent else None
+    sinks = [ SinkStage(input if len(feeds) == 1 else f'[{stream}] {input}', mouseControllers[stream], 
+                        silent=args.silent, clean=args.clean, display=display) for stream, input in enumerate(args.input) ]
 
     logging.info('Running...')
 
-    q = deque()     # the processing queue
-    faces_produced = 0
-    head_poses_produced = 0
-    eyes_produced = 0
-    hpae_consumed = 0
-    wait_needed = False
-    done = False
-    t = -time.time()    # measure processing time
+    # The replay stage substitutes the stages whose models are not loaded
+    # Only the display needs the whole frames after face detection, otherwise just the face images are kept
+    faceDetectionStage = FaceDetectionStage(modelsLoading[0], confidence=args.confidence, face_tracker=faceTrackers,
+                                            policy=args.face_policy, max_faces=args.max_faces, nms_threshold=args.nms,
+                                            keep_frames=display is not None)
+    stages = [ InputStage(*feeds) ] + ([ replayStage ] if replayStage else []) + [ stage for stage in [
+        faceDetectionStage,
+        LandmarksStage(modelsLoading[1]),
+        HeadPoseStage(modelsLoading[2], cache=headPoseCache),
+        GazeStage(modelsLoading[3], cache=gazeCache)
+    ] if stage.model is not None ]
 
-    while not done:
-
-        # get a new gaze direction vector if available
-        gaze_vector_consumed, gaze_vector = gazeEstimator.consume_output(wait_needed)
-        if gaze_vector_consumed:
-            frame, face_box, _, _ = q.popleft()
-            faces_produced -= 1
-            eyes_produced -= 1
-            head_poses_produced -= 1
-            hpae_consumed -= 1
-
-            if not args.silent: # the silent mode is used only for measurements 
-                if gaze_vector:
-                    gx, gy, _ = gaze_vector            
-                    mouseController.move(gx, gy)
-
-                    if args.clean:
-                        output_frame = frame
-                    else:
-                        output_frame = helpers.draw_gaze_vector(frame, face_box, gx, gy)
-
-                else:   # gaze vector is None
-                    output_frame = frame    # show the original frame
-
-                cv2.imshow(args.input, output_frame)
-                if cv2.waitKey(5) & 0xFF == 27:
-                    break
-
-        # if a new pair of head pose and eyes is available, use them to estimate the gaze direction
-        if hpae_consumed < min(head_poses_produced, eyes_produced):
-            left_eye, right_eye = q[hpae_consumed][2]
-            head_pose_angles = q[hpae_consumed][3]
-            hpae_consumed += 1
-            gazeEstimator.feed_input(left_eye, right_eye, head_pose_angles)
-
-        # get a new head pose if available
-        head_pose_consumed, head_pose_angles = headPoseEstimator.consume_output(wait_needed)
-        if head_pose_consumed:
-            q[head_poses_produced][3] = head_pose_angles
-            head_poses_produced += 1
-
-        # get a new pair of eye images if available
-        eyes_consumed, eye_boxes = eyeDetector.consume_output(wait_needed)
-        if eyes_consumed:
-            frame, face_box, _, _ = q[eyes_produced]    # the corresponding frame and the face bounding box for this detection
-            eyes = eyeDetector.preprocess_output(eye_boxes, face_image=helpers.crop(frame, face_box))
-            q[eyes_produced][2] = eyes
-            eyes_produced += 1
-
-        # get a new face and the bounding box if available
-        face_consumed, face_box = faceDetector.consume_output(confidence=args.confidence, wait=wait_needed)
-        if face_consumed:        
-            face_img, face_box = faceDetector.preprocess_output(face_box, frame=q[faces_produced][0])
-            q[faces_produced][1] = face_box
-            faces_produced += 1
-            eyeDetector.feed_input(face_img)
-            headPoseEstimator.feed_input(face_img)
-
-        frame = feed.read_next()    # get the next frame from the input feed
-        if frame is not None:
-            # [original frame, face box, eyes, head pose]
-            q.append([frame, None, None, None])
-            faceDetector.feed_input(frame)
-        else:
-            # When we reached the end of the input stream we have to wait for all frames to finish processing.
-            # To avoid idle running the loop, blocking wait is used when no output is available from any model.
-            wait_needed = not gaze_vector_consumed and not head_pose_consumed and not eyes_consumed and not face_consumed
-            done = len(q)<1     
-        
+    recorder = Recorder(args.record, record_eyes=args.record_eyes) if args.record else None
+    if recorder:
+        stages.append(RecordStage(recorder))
+    stages.append(sinks[0] if len(sinks) == 1 else RouterStage(sinks, queue_size=args.queue_size))
+
+    pipeline = Pipeline(stages, queue_size=args.queue_size, latency_budget=args.latency_budget/1000, 
+                        trace=args.trace is not None, controller=controller, max_in_flight=args.max_in_flight)
+    if display:
+        display.on_escape = pipeline.stop   # Esc stops the pipeline
+
+    start_time = -t
+    t = -time.time()    # measure processing time
+    if display:
+        # HighGUI requires the main thread on some platforms, so the pipeline runs in the background
+        runner = ThreadPoolExecutor(max_workers=1)
+        running = runner.submit(pipeline.run)
+        runner.shutdown(wait=False)
+        try:
+            display.run(until=running.done)
+        except KeyboardInterrupt:
+            pipeline.stop()
+            raise
+        running.result()
+    else:
+        pipeline.run()
     t += time.time()
-    feed.close()
+    for feed in feeds:
+        feed.close()
+    for mouseController in mouseControllers:
+        mouseController.close()
+    if display:
+        display.close()
+    if recorder:
+        recorder.close()
+    # The quality controller may have switched the stages to the fallback models, so the counters of all models
+    # a stage has run are reported. The models of the replayed stages are not loaded.
+    stageModels = { stage.name : stage.models for stage in stages if isinstance(stage, ModelStage) }
+    faceDetectors, eyeDetectors, headPoseEstimators, gazeEstimators = [ stageModels.get(model, []) for model in MODELS ]
 
     logging.info('Done')
-    logging.info(f'Total Processing Time: {t:.4} s\n')
+    if networkCache:
+        logging.info(f'Network Cache Hits: {networkCache.hits}, Misses: {networkCache.misses}')
+    if pipeline.first_completion_time:
+        logging.info(f'Time to First Gaze Vector: {pipeline.first_completion_time - start_time:.4} s')
+    logging.info(f'Total Processing Time: {t:.4} s')
+    for stream, feed in enumerate(feeds):
+        stream_name = f'[{stream}] {feed.input}: ' if len(feeds) > 1 else ''
+        logging.info(f'{stream_name}Decoding Speed: {feed.get_decode_fps():.1f} FPS, Frames Decoded: {feed.frames_decoded}, '
+                     f'Frames Dropped: {feed.frames_dropped}')
+    logging.info('')
+
+    latency_stats = pipeline.get_latency_stats()
+    if latency_stats:
+        logging.info('Frame Latency: mean {:.1f} ms, median {:.1f} ms, 95th percentile {:.1f} ms, 99th percentile {:.1f} ms'.format(
+            *[1000*v for v in latency_stats]))
+    frames_skipped = controller.frames_skipped if controller else 0
+    logging.info(f'Frames Completed: {len(pipeline.latencies)}, Late Frames Dropped: {pipeline.frames_dropped - frames_skipped}, '
+                 f'Peak Frames in Flight: {pipeline.peak_in_flight}\n')
+
+    logging.info(f'{"Processing Step":<26}{"Frames":>8}{"p50, ms":>10}{"p95, ms":>10}{"p99, ms":>10}{"FPS":>10}')
+    for name, (count, p50, p95, p99, throughput) in pipeline.get_span_stats().items():
+        logging.info(f'{name:<26}{count:>8}{1000*p50:>10.2f}{1000*p95:>10.2f}{1000*p99:>10.2f}{throughput:>10.1f}')
+    logging.info('')
+    if args.trace:
+        pipeline.write_trace(args.trace)
+        logging.info(f'Trace saved to {args.trace}\n')
+
+    if len(feeds) > 1:
+        for stream, (feed, sink) in enumerate(zip(feeds, sinks)):
+            stream_stats = f'[{stream}] {feed.input}: {sink.frame_count / t:.1f} FPS'
+            latency_stats = pipeline.get_latency_stats(stream)
+            if latency_stats:
+                stream_stats += ', latency: mean {:.1f} ms, median {:.1f} ms, 95th percentile {:.1f} ms, 99th percentile {:.1f} ms'.format(
+                    *[1000*v for v in latency_stats])
+            logging.info(stream_stats)
+        logging.info('')
+
+    if not args.silent:
+        mouseController = mouseControllers[0]
+        logging.info(f'Mouse Moves: {mouseController.moves_requested}, Merged: {mouseController.moves_merged}\n')
+        logging.info(f'Frames Shown: {display.frames_shown}, Skipped: {display.frames_skipped}, '
+                     f'Render Time: {1000*display.render_time / max(1, display.frames_shown):.2f} ms per frame\n')
+
+    if recorder:
+        logging.info(f'Frames Recorded: {recorder.frame_count}, Recording: {args.record}\n')
+    if replayStage:
+        logging.info(f'Replayed Stages: {", ".join(replayedStages)}, Frames Missing in Recording: {replayStage.frames_missing}\n')
+
+    if args.batch > 1:
+        for model_name, models in (('Eye Detector', eyeDetectors), ('Head Pose Estimator', headPoseEstimators)):
+            if not models:
+                continue
+            batches_started = total(models, 'batches_started')
+            logging.info(f'{model_name} Batches: {batches_started}, '
+                         f'Average Batch Size: {total(models, "batched_inputs") / max(1, batches_started):.2f}')
+        logging.info('')
+
+    if controller:
+        logging.info(f'Quality Switches: {len(controller.switches)}, Frames Skipped: {controller.frames_skipped}, '
+                     f'Final Configuration: {controller.describe()}\n')
+
+    if args.roi_scale > 0 and faceDetectors:
+        roi_hits, roi_detections, full_detections, pixels_saved, frame_pixels = [ total(faceDetectors, counter)
+            for counter in ('roi_hits', 'roi_detections', 'full_detections', 'pixels_saved', 'frame_pixels') ]
+        logging.info(f'Search Window Hit Rate: {100*roi_hits / max(1, roi_detections):.1f}% '
+                     f'({roi_hits} of {roi_detections}), Whole-Frame Detections: {full_detections}')
+        logging.info(f'Frame Pixels Saved: {pixels_saved / max(1, roi_detections + full_detections) / 1e6:.3f} MP per detection '
+                     f'({100*pixels_saved / max(1, frame_pixels):.1f}%)\n')
+
+    if args.face_policy == 'all':
+        logging.info(f'Faces Detected: {faceDetectionStage.faces_detected}, '
+                     f'Faces Processed: {sum(sink.face_count for sink in sinks)}\n')
+
+    if track > 0:
+        logging.info(f'Face Detections: {sum(faceTracker.detected for faceTracker in faceTrackers)}, '
+                     f'Tracked Faces: {sum(faceTracker.tracked for faceTracker in faceTrackers)}\n')
+
+    if args.motion_threshold > 0:
+        for stage_name, cache in (('Head Pose', headPoseCache), ('Gaze', gazeCache)):
+            logging.info(f'{stage_name} Cache Hit Rate: {100*cache.get_hit_rate():.1f}% ({cache.hits} of {cache.lookups}), '
+                         f'Evictions: {cache.evictions}')
+        logging.info('')
 
     if args.stats:
         logging.info('Layer-wise Execution Time')
-        faceDetector.print_stats(title="\nFace Detector")
-        eyeDetector.print_stats(title="\nEye Detector")
-        headPoseEstimator.print_stats(title="\nHead Pose Estimator")
-        gazeEstimator.print_stats(title="\nGaze Direction Estimator")
+        # The layers differ between the precisions, so the fallback models are profiled separately
+        profiled = [ (title if i == 0 else f'{title} ({args.fallback_precision})',
+                      model.name if i == 0 else f'{model.name} ({args.fallback_precision})', model)
+                     for title, models in (("\nFace Detector", faceDetectors), ("\nEye Detector", eyeDetectors),
+                         ("\nHead Pose Estimator", headPoseEstimators), ("\nGaze Direction Estimator", gazeEstimators))
+                     for i, model in enumerate(models) ]
+        for title, _, model in profiled:
+            model.print_stats(title=title, top=args.stats_top)
+        if args.stats_file:
+            save_profiles(args.stats_file, { name : model.profiler for _, name, model in profiled })
+            logging.info(f'Layer-wise statistics saved to {args.stats_file}')
+
+    peak_rss = helpers.get_peak_rss()
+    if peak_rss is not None:
+        logging.info(f'Peak Memory Usage (RSS): {peak_rss / 2**20:.1f} MB')
 
 #except:
 #    logging.error(traceback.format_exc())
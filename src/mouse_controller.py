@@ -1,17 +1,59 @@
-import pyautogui
+import threading
+import time
+
+class PyAutoGuiBackend:
+    """
+    Moves the mouse pointer by means of the pyautogui library.
+    """
+
+    def __init__(self, failsafe):
+        """
+        The failsafe parameter can be used to change the PyAutoGUI's failsafe mode. When set to true,
+        the exception will be raised once the mouse pointer reaches the screen corner.
+        """
+        # PyAutoGUI needs a display, so it's imported only when the real mouse is controlled
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.pyautogui.FAILSAFE = failsafe
+        self.pyautogui.PAUSE = 0   # the controller keeps its own pace
+
+    def move(self, dx, dy):
+        """
+        Moves the mouse pointer by the specified number of pixels.
+        """
+        self.pyautogui.moveRel(dx, dy, duration=0)
+
+
+class RecordingBackend:
+    """
+    A stand-in for the mouse which just records the moves. Can be used when there is no display (e.g. for tests).
+    """
+
+    def __init__(self):
+        self.moves = []
+
+    def move(self, dx, dy):
+        """
+        Records the relative move along with the time it was made.
+        """
+        self.moves.append((time.perf_counter(), dx, dy))
+
 
 class MouseController:
     """
-    This class allows to control the mouse pointer. It uses the pyautogui library.      
+    This class allows to control the mouse pointer. The pointer is moved by a dedicated thread, so the
+    move call never blocks. Moves requested while the previous one is still animating are merged.
     """
 
-    def __init__(self, precision, speed, failsafe):
+    def __init__(self, precision, speed, failsafe, backend=None, tick=0.01):
         """
-        Initializes a new instance of the mouse pointer controller. 
+        Initializes a new instance of the mouse pointer controller.
         Mouse movement precision determines how much the mouse moves (can be 'high', 'low', and 'medium').
-        The speed defines how fast it moves (can be 'fast', 'slow', and 'medium').   
+        The speed defines how fast it moves (can be 'fast', 'slow', and 'medium').
         The failsafe parameter can be used to change the PyAutoGUI's failsafe mode. When set to true,
         the exception will be raised once the mouse pointer reaches the screen corner.
+        The backend performs the actual moves (PyAutoGuiBackend by default). The tick specifies
+        the interval (in seconds) between the interpolated moves.
         """
         #precision_dict={'high':100, 'low':1000, 'medium':500}
         precision_dict={'high':70, 'low':150, 'medium':100}
@@ -20,12 +62,76 @@ class MouseController:
 
         self.precision=precision_dict[precision]
         self.speed=speed_dict[speed]
+        self.tick = tick
+        self.backend = backend if backend is not None else PyAutoGuiBackend(failsafe)
 
-        pyautogui.FAILSAFE = failsafe
+        self.lock = threading.Condition()
+        self.remaining = [0.0, 0.0]     # the distance left to move
+        self.end_time = 0               # when the current animation must finish
+        self.moves_requested = 0
+        self.moves_merged = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._animate, name='mouse-controller', daemon=True)
+        self.thread.start()
 
     def move(self, x, y):
         """
         Moves the mouse pointer. Call this function with the x and y output of the gaze estimation model.
+        The call returns immediately. If the previous move hasn't finished yet, the remaining distance
+        is added to the new one.
+        """
+        with self.lock:
+            if self.error is not None:
+                raise self.error    # e.g. PyAutoGUI's fail-safe was triggered
+
+            if self.remaining[0] or self.remaining[1]:
+                self.moves_merged += 1
+            self.moves_requested += 1
+            self.remaining[0] += x*self.precision
+            self.remaining[1] += -1*y*self.precision
+            self.end_time = time.perf_counter() + self.speed
+            self.lock.notify_all()
+
+    def close(self):
         """
-        pyautogui.moveRel(x*self.precision, -1*y*self.precision, duration=self.speed)
-        #pyautogui.moveRel(x*self.precision, -1*y*self.precision, duration=0)
+        Stops the mouse controller thread. The move in progress is not completed.
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join()
+
+    def _animate(self):
+        """
+        The thread routine which interpolates the pointer motion at a fixed tick.
+        Private method, to be used by MouseController only.
+        """
+        residual = [0.0, 0.0]   # fractions of a pixel which haven't been moved yet
+        while True:
+            with self.lock:
+                while not (self.remaining[0] or self.remaining[1]) and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+
+                # Move a part of the remaining distance proportional to the time left
+                ticks_left = max(1.0, (self.end_time - time.perf_counter()) / self.tick)
+                step = [ r / ticks_left for r in self.remaining ]
+                self.remaining = [ r - s for r, s in zip(self.remaining, step) ]
+                if ticks_left <= 1:
+                    self.remaining = [0.0, 0.0]
+
+            # The backend works with whole pixels
+            residual = [ r + s for r, s in zip(residual, step) ]
+            dx, dy = [ int(round(r)) for r in residual ]
+            residual = [ residual[0] - dx, residual[1] - dy ]
+            if dx or dy:
+                try:
+                    self.backend.move(dx, dy)
+                except Exception as e:
+                    with self.lock:
+                        self.error = e
+                        self.remaining = [0.0, 0.0]
+
+            time.sleep(self.tick)
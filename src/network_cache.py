@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import re
+import os
+
+class NetworkCache:
+    """
+    An on-disk cache of compiled executable networks. It relies on the export/import facilities of OpenVINO,
+    so loading a cached network doesn't require compiling it again. Cache entries are keyed by the model
+    files' hash, the device, the plugin config, and the OpenVINO version. The cache is bounded by the number
+    of entries, the least recently used ones are removed. Note that not every plugin can export networks
+    (e.g. the CPU plugin of OpenVINO 2020 can't), so the cache does nothing for such devices.
+    """
+
+    def __init__(self, cache_dir, max_entries=32):
+        """
+        Initializes the cache which stores networks in the specified directory. The max entries
+        limits the number of cached networks.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.unsupported_devices = set()    # devices which failed to export networks
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def make_key(self, model_xml, model_bin, device, config, variant=None):
+        """
+        Computes the cache key for the model on the device with the plugin config. The variant
+        distinguishes the networks compiled from the same files in different ways (e.g. preprocessing).
+        """
+        hasher = hashlib.sha256()
+        for file_name in (model_xml, model_bin):
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hasher.update(chunk)
+        hasher.update(device.upper().encode())
+        hasher.update(json.dumps(config or {}, sort_keys=True).encode())
+        # The module requires OpenVINO, while the cache can't be used with other backends anyway
+        from openvino.inference_engine import get_version
+        hasher.update(get_version().encode())
+        hasher.update(str(variant).encode())
+
+        # The precision is a part of the model path (the model files differ anyway)
+        model_name = os.path.splitext(os.path.basename(model_xml))[0]
+        precision = os.path.basename(os.path.dirname(model_xml))
+        variant = f'-{variant}' if variant else ''
+        # Device names like MULTI:CPU,GPU contain characters which are not allowed in file names
+        device_name = re.sub(r'[^A-Za-z0-9_.]', '_', device.upper())
+        return f'{model_name}-{precision}-{device_name}{variant}-{hasher.hexdigest()[:32]}'
+
+
+    def load(self, backend, key, device, config, num_requests):
+        """
+        Imports the cached executable network. Returns None if there is no such entry.
+        A corrupt entry is removed, so it can be rebuilt.
+        """
+        path = self._get_path(key)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+
+        try:
+            exe_network = backend.import_network(model_file=path, device_name=device, config=config or {},
+                                                 num_requests=num_requests)
+        except Exception as e:
+            logging.warning(f'Failed to import the cached network {path}: {e}')
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(path)  # the modification time tells which entries were used recently
+        except OSError:
+            pass
+        return exe_network
+
+
+    def store(self, exe_network, key, device):
+        """
+        Exports the executable network to the cache and removes the least recently used entries
+        beyond the limit. Does nothing if the device doesn't support exporting networks.
+        """
+        if device.upper() in self.unsupported_devices:
+            return
+
+        path = self._get_path(key)
+        temp_path = path + '.tmp'
+        try:
+            exe_network.export(temp_path)
+            os.replace(temp_path, path)     # never leave a partially written entry
+        except Exception as e:
+            logging.warning(f'Network caching is not available for {device}: {e}')
+            self.unsupported_devices.add(device.upper())
+            self._remove(temp_path)
+            return
+
+        # Other configs of the same model stay valid (e.g. the points of a benchmark sweep),
+        # so the entries are evicted by the time of their last use only
+        paths = [ os.path.join(self.cache_dir, file_name) for file_name in os.listdir(self.cache_dir)
+                  if file_name.endswith('.blob') ]
+        paths.sort(key=self._get_time, reverse=True)
+        for entry_path in paths[self.max_entries:]:
+            if entry_path != path:
+                self._remove(entry_path)
+
+
+    def _get_path(self, key):
+        """
+        Returns the file path of the cache entry.
+        Private method, to be used by NetworkCache only.
+        """
+        return os.path.join(self.cache_dir, key + '.blob')
+
+
+    def _get_time(self, path):
+        """
+        Returns the modification time of the file or zero if it has been removed meanwhile (the models are loaded concurrently).
+        Private method, to be used by NetworkCache only.
+        """
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+
+    def _remove(self, path):
+        """
+        Removes the file ignoring errors.
+        Private method, to be used by NetworkCache only.
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,205 @@
+"""
+Analyzes a video file offline. The file is split into ranges of frames which are processed by independent
+pipelines in a pool of processes. Each worker loads its own models and runs inference on its own subset of
+CPU cores, so the workers don't oversubscribe the CPU. The per-frame face box, eye boxes, head pose angles,
+and gaze vector are merged into one columnar file ordered by frame index (.npz or .csv).
+"""
+from input_feeder import InputFeeder
+from pipeline import Pipeline, Stage
+from stages import InputStage, FaceDetectionStage, LandmarksStage, HeadPoseStage, GazeStage
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import argparse
+import logging
+import time
+import cv2
+import os
+
+
+# The output columns and the number of values per frame in each of them
+COLUMNS = [
+    ('face_box', 4),        # xmin, ymin, xmax, ymax in pixels
+    ('left_eye_box', 4),    # in pixels of the frame
+    ('right_eye_box', 4),
+    ('head_pose', 3),       # yaw, pitch, roll in degrees
+    ('gaze_vector', 3)
+]
+
+
+class ColumnSink(Stage):
+    """
+    The final stage of the analysis pipeline which stores the model outputs of every frame in columns.
+    The missing values (e.g. when there is no face on the frame) are stored as NaN.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty column sink.
+        """
+        super().__init__('columns')
+        self.columns = { name : [] for name, _ in COLUMNS }
+
+
+    def process(self, ctx):
+        """
+        Appends the outputs of the frame to the columns.
+        """
+        left_eye_box, right_eye_box = ctx.eye_boxes or (None, None)
+        row = {
+            'face_box': ctx.face_box,
+            'left_eye_box': self._to_frame(left_eye_box, ctx.face_box),
+            'right_eye_box': self._to_frame(right_eye_box, ctx.face_box),
+            'head_pose': ctx.head_pose,
+            'gaze_vector': ctx.gaze_vector if ctx.has_gaze_inputs() else None
+        }
+        for name, size in COLUMNS:
+            self.columns[name].append(row[name] if row[name] is not None else (np.nan,) * size)
+
+        self.pipeline.complete(ctx)
+        ctx.release()
+
+
+    def _to_frame(self, eye_box, face_box):
+        """
+        Converts the eye box from the 0..1 range of the face image to the pixels of the frame.
+        Private method, to be used by ColumnSink only.
+        """
+        if eye_box is None or face_box is None:
+            return None
+        xmin, ymin, xmax, ymax = face_box
+        w, h = xmax - xmin + 1, ymax - ymin + 1
+        return (xmin + eye_box[0]*w, ymin + eye_box[1]*h, xmin + eye_box[2]*w, ymin + eye_box[3]*h)
+
+
+# The models loaded by the worker process (see init_worker)
+worker_models = None
+
+
+def init_worker(core_sets, model_args):
+    """
+    Initializes the worker process: pins it to the next free set of CPU cores and loads the models,
+    which are then reused for all frame ranges processed by the worker.
+    """
+    global worker_models
+
+    cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    cv2.setNumThreads(1)    # the worker's cores are busy with inference
+
+    # The inference threads are limited to the number of the worker's cores. They are not bound
+    # by the plugin, since each worker would bind its threads to the same first cores.
+    config = { 'CPU_THREADS_NUM': str(len(cores)), 'CPU_BIND_THREAD': 'NO' }
+
+    # These modules require OpenVINO, so they are imported by the worker processes only
+    from face_detection import FaceDetector
+    from facial_landmarks_detection import EyeDetector
+    from head_pose_estimation import HeadPoseEstimator
+    from gaze_estimation import GazeEstimator
+
+    worker_models = [ model_class(**model_args, config=config)
+                      for model_class in (FaceDetector, EyeDetector, HeadPoseEstimator, GazeEstimator) ]
+
+
+def analyze_range(input, start_frame, frame_count, confidence, prefetch):
+    """
+    Runs the pipeline on the range of frames. Returns a tuple of the start frame and the dictionary of columns.
+    """
+    faceDetector, eyeDetector, headPoseEstimator, gazeEstimator = worker_models
+    feed = InputFeeder(input, prefetch=prefetch, start_frame=start_frame, frame_count=frame_count)
+    sink = ColumnSink()
+    pipeline = Pipeline([
+        InputStage(feed),
+        FaceDetectionStage(faceDetector, confidence=confidence),
+        LandmarksStage(eyeDetector),
+        HeadPoseStage(headPoseEstimator),
+        GazeStage(gazeEstimator),
+        sink
+    ])
+    try:
+        pipeline.run()
+    finally:
+        feed.close()
+
+    columns = { name : np.array(values, dtype=np.float32).reshape(-1, size)
+                for (name, size), values in zip(COLUMNS, sink.columns.values()) }
+    return start_frame, columns
+
+
+def save_columns(file_name, columns):
+    """
+    Saves the columns to a .npz file (an array per column) or a .csv file (a value per column).
+    """
+    if file_name.lower().endswith('.csv'):
+        header = [ 'frame' ]
+        for name, size in COLUMNS:
+            header += [ f'{name}_{i}' for i in range(size) ]
+        table = np.column_stack([ columns['frame'] ] + [ columns[name] for name, _ in COLUMNS ])
+        np.savetxt(file_name, table, delimiter=',', header=','.join(header), comments='', fmt='%.6g')
+    else:
+        np.savez(file_name, **columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline Gaze Analysis")
+    parser.add_argument('--input', type=str, required=True, help="An input video file.")
+    parser.add_argument('--output', type=str, required=True,
+                        help="The output file. The format (.npz or .csv) is defined by the extension.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Defines the number of worker processes. Default is the number of CPU cores.")
+    parser.add_argument('--chunk', type=int, default=500,
+                        help="Defines the number of frames in a range processed by a worker at a time. Default is 500.")
+    parser.add_argument('--device', type=str, default='CPU', help="Device name to perform inference on. Default is CPU.")
+    parser.add_argument('--precision', type=str, default='FP32', help="Model precision. Default is FP32.")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Defines the number of concurrent requests each model of a worker can execute. Default is 1.")
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help="Defines the number of frame buffers decoded in the background by each worker. Default is 16.")
+    parser.add_argument('--confidence', type=float, default=0.5,
+                        help="Specifies face detection probability threshold. Default is 0.5.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        datefmt='%Y-%m-%d %I:%M:%S')
+
+    cap = cv2.VideoCapture(args.input)
+    if not cap.isOpened():
+        raise Exception('Failed to open the input: ' + args.input)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    # The frame count reported by the container may be inaccurate, so the last range is read to the end
+    starts = list(range(0, max(1, total_frames), args.chunk))
+    ranges = [ (start, args.chunk if i + 1 < len(starts) else None) for i, start in enumerate(starts) ]
+
+    # Split the available cores between the workers evenly
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    workers = max(1, min(args.workers, len(cores), len(ranges)))
+    core_sets = [ set(cores[i::workers]) for i in range(workers) ]
+
+    # Forking a process with a loaded inference engine is unsafe, so the workers are spawned
+    context = multiprocessing.get_context('spawn')
+    core_queue = context.Queue()
+    for core_set in core_sets:
+        core_queue.put(core_set)
+    model_args = dict(precision=args.precision, concurrency=args.concurrency, device=args.device)
+
+    logging.info(f'Analyzing {total_frames} frames in {len(ranges)} ranges by {workers} workers...')
+    t = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(core_queue, model_args)) as pool:
+        futures = [ pool.submit(analyze_range, args.input, start, count, args.confidence, args.prefetch)
+                    for start, count in ranges ]
+        results = [ future.result() for future in futures ]
+    t = time.perf_counter() - t
+
+    # The results come in the order of ranges, so the frames are ordered as well
+    columns = { name : np.concatenate([ result[name] for _, result in results ]) for name, _ in COLUMNS }
+    columns['frame'] = np.concatenate([ np.arange(start, start + len(result['face_box'])) for start, result in results ])
+    save_columns(args.output, columns)
+
+    frame_count = len(columns['frame'])
+    logging.info(f'Frames Analyzed: {frame_count}, Faces Detected: {int(np.sum(~np.isnan(columns["face_box"][:,0])))}')
+    logging.info(f'Total Time: {t:.4} s, Throughput: {frame_count / t:.1f} FPS')
+    logging.info(f'Results saved to {args.output}')
@@ -0,0 +1,741 @@
+import threading
+import queue
+import logging
+import time
+import numpy as np
+import json
+import copy
+from collections import defaultdict
+from concurrent.futures import Future
+
+# The end-of-stream marker passed through the queues after the last frame
+END = object()
+
+
+class FrameContext:
+    """
+    Carries an input frame along with the intermediate model outputs through the pipeline stages.
+    The attributes are slotted, so a context takes little memory once its frame is detached (see detach_frame).
+    """
+
+    __slots__ = ('index', 'frame', 'stream', 'on_release', 'capture_time', 'admission_time', 'face_box', 'face_image',
+                 'eye_boxes', 'eyes', 'head_pose', 'gaze_vector', 'face', 'face_count', 'spans')
+
+    def __init__(self, index, frame, on_release=None, capture_time=None, stream=0):
+        """
+        Creates a new frame context. The index is the sequential number of the frame in the input
+        (it is shared by all streams when there are several of them). The stream is the number of the input
+        stream the frame came from. The on_release callback is called with the frame once the context is 
+        no longer needed. The capture time (time.perf_counter) is used for measuring latency.
+        """
+        self.index = index
+        self.frame = frame
+        self.stream = stream
+        self.on_release = on_release
+        self.capture_time = capture_time if capture_time is not None else time.perf_counter()
+        self.admission_time = None
+        self.face_box = None
+        self.face_image = None
+        self.eye_boxes = None       # left and right eye boxes scaled to the 0..1 range of the face image
+        self.eyes = (None, None)    # left and right eye images
+        self.head_pose = None
+        self.gaze_vector = None
+        self.face = 0               # the number of the face on the frame (see fork)
+        self.face_count = 1
+        self.spans = []             # (name, start, end) of the processing steps in time.perf_counter units
+
+
+    def trace(self, name, start, end):
+        """
+        Records the time span of a processing step (e.g. decoding or inference of a model).
+        """
+        self.spans.append((name, start, end))
+
+
+    def fork(self, count):
+        """
+        Splits the context into the specified number of contexts (this one being the first), one for each face
+        on the frame, so the next stages process the faces as separate work items. The copies share the frame
+        and the model outputs stored so far but have their own time spans. The frame is released along with
+        the last of the contexts. Returns the list of the contexts.
+        """
+        if count <= 1:
+            return [ self ]
+
+        on_release = self.on_release
+        if on_release is not None:
+            lock = threading.Lock()
+            remaining = [ count ]
+            def release_shared(frame):
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    on_release(frame)
+            self.on_release = release_shared
+
+        self.face_count = count
+        forks = [ self ]
+        for face in range(1, count):
+            ctx = copy.copy(self)
+            ctx.face = face
+            ctx.spans = list(self.spans)
+            forks.append(ctx)
+        return forks
+
+
+    def detach_frame(self):
+        """
+        Copies the face image out of the frame and releases the frame early, so its buffer can be reused
+        while the face goes through the rest of the pipeline. The frame is None afterwards.
+        """
+        if self.face_image is not None:
+            self.face_image = self.face_image.copy()
+        self.release()
+        self.frame = None
+
+
+    def has_gaze_inputs(self):
+        """
+        Checks whether the gaze vector has been estimated. Without a face, the eye images, or the head pose
+        the gaze estimator is skipped and returns zeros, which must not be stored as a real gaze vector.
+        """
+        return self.face_box is not None and self.head_pose is not None \
+            and all(eye is not None and eye.size > 0 for eye in self.eyes)
+
+
+    def release(self):
+        """
+        Releases the frame (e.g. returns it to the input feeder for reuse). The frame and the images 
+        cropped from it must not be used after this call.
+        """
+        if self.on_release is not None:
+            self.on_release(self.frame)
+            self.on_release = None
+
+
+class Stage:
+    """
+    A pipeline stage which runs in its own worker thread. It takes frame contexts from the input queue,
+    processes them and passes them to the next stage in the same order.
+    """
+
+    def __init__(self, name):
+        """
+        Initializes a new pipeline stage. The name is used for the worker thread.
+        """
+        self.name = name
+        self.input = None
+        self.output = None
+        self.pipeline = None
+        self.workers = []
+
+
+    def start(self):
+        """
+        Starts the worker threads of the stage.
+        """
+        self.workers = [ threading.Thread(target=self._run, name=self.name, daemon=True) ]
+        for worker in self.workers:
+            worker.start()
+
+
+    def process(self, ctx):
+        """
+        Processes the frame context. The default implementation passes it to the next stage unchanged.
+        Descendant classes must call emit to pass the context further.
+        """
+        self.emit(ctx)
+
+
+    def discard(self, ctx):
+        """
+        Called for the frame contexts which are dropped because the pipeline is stopping.
+        """
+        ctx.release()
+
+
+    def finish(self):
+        """
+        Called when the end of the stream is reached. Passes the end-of-stream marker to the next stage.
+        """
+        self.emit(END)
+
+
+    def emit(self, ctx):
+        """
+        Passes the frame context to the next stage. Blocks if the next stage is lagging behind.
+        """
+        if self.output is not None:
+            self.output.put(ctx)
+
+
+    def _inputs(self):
+        """
+        Yields frame contexts from the input queue until the end of the stream.
+        Protected method, to be used by Stage and descendant classes.
+        """
+        while True:
+            ctx = self.input.get()
+            if ctx is END:
+                return
+            yield ctx
+
+
+    def _run(self):
+        """
+        The worker thread routine. Once the pipeline is stopped, the remaining frames are discarded
+        rather than processed, so the upstream stages never get blocked.
+        Private method, to be used by Stage only.
+        """
+        try:
+            for ctx in self._inputs():
+                if self.pipeline.stopped:
+                    self.discard(ctx)
+                else:
+                    self.process(ctx)
+        except Exception as e:
+            self.pipeline.abort(e)
+            for ctx in self._inputs():
+                self.discard(ctx)
+
+        self.finish()
+
+
+class SourceStage(Stage):
+    """
+    The first stage of the pipeline, which produces frame contexts instead of reading them from a queue.
+    """
+
+    def produce(self):
+        """
+        Returns the next frame context or None when the input is exhausted. Must be implemented by descendants.
+        """
+        raise NotImplementedError()
+
+
+    def _run(self):
+        """
+        The worker thread routine.
+        Private method, to be used by SourceStage only.
+        """
+        try:
+            while self.pipeline.wait_for_room():
+                ctx = self.produce()
+                if ctx is None:
+                    break
+                self.emit(ctx)
+        except Exception as e:
+            self.pipeline.abort(e)
+
+        self.finish()
+
+
+class ModelStage(Stage):
+    """
+    A stage running inference of a model. One worker feeds the model with inputs while the other one
+    collects the results, so the model can run as many concurrent requests as its concurrency allows.
+    """
+
+    def __init__(self, name, model, cache=None):
+        """
+        Initializes a new model stage. The model is an instance of GenericModel or its descendant. 
+        It can also be a concurrent.futures.Future of the model which is still loading.
+        The cache (an instance of ResultCache) enables reusing the previous output when the input
+        images are almost unchanged. The descendants supporting it implement get_gate_images,
+        get_output, and set_output (and get_gate_values if other inputs matter).
+        """
+        super().__init__(name)
+        self.model = model
+        self.cache = cache
+        self.pending = None
+        self.replacement = None     # the model to switch to (see replace_model)
+        self.models = []            # the models the stage has run, the first one first
+
+
+    def start(self):
+        """
+        Waits for the model to load and starts the feeding and the collecting workers.
+        """
+        if isinstance(self.model, Future):
+            self.model = self.model.result()
+        self.models.append(self.model)
+
+        # Contexts whose results have not been collected yet. The queue is bounded, so the feeding
+        # worker doesn't run too far ahead when the next stage is lagging behind.
+        self.pending = queue.Queue(maxsize=max(1, self.model.concurrency) * self.model.batch_size)
+        self.workers = [
+            threading.Thread(target=self._run, name=self.name, daemon=True),
+            threading.Thread(target=self._collect, name=self.name + '-collector', daemon=True)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+
+    def submit(self, ctx):
+        """
+        Feeds the model with the input data taken from the frame context. Must be implemented by descendants.
+        """
+        raise NotImplementedError()
+
+
+    def collect(self, ctx):
+        """
+        Waits for the model output corresponding to the frame context and stores it in the context.
+        Must be implemented by descendants.
+        """
+        raise NotImplementedError()
+
+
+    def get_gate_images(self, ctx):
+        """
+        Returns the list of the input images whose changes decide whether the cached output can be reused.
+        Must be implemented by descendants supporting the cache.
+        """
+        raise NotImplementedError()
+
+
+    def get_gate_values(self, ctx):
+        """
+        Returns the list of the other input values whose changes decide whether the cached output can be reused,
+        or None if they are missing. There are none by default.
+        """
+        return []
+
+
+    def get_output(self, ctx):
+        """
+        Returns the output of the stage stored in the frame context. Must be implemented by descendants 
+        supporting the cache.
+        """
+        raise NotImplementedError()
+
+
+    def set_output(self, ctx, output):
+        """
+        Stores the output of the stage in the frame context. Must be implemented by descendants
+        supporting the cache.
+        """
+        raise NotImplementedError()
+
+
+    def replace_model(self, model):
+        """
+        Requests the stage to switch to another model (e.g. the same network in another precision) loaded with 
+        the same concurrency and batch size. The feeding worker switches once the outputs of the current model
+        have been collected, so the order of frames is kept. The counters of the models are reported for
+        all models the stage has run (see the models attribute).
+        """
+        self.replacement = model
+
+
+    def split(self, ctx):
+        """
+        Returns the list of the frame contexts to pass to the next stage in place of the collected one.
+        The default implementation returns the context itself. The descendants may fork the context
+        (see Pipeline.fork) to pass several work items.
+        """
+        return [ ctx ]
+
+
+    def process(self, ctx):
+        """
+        Feeds the model and passes the context to the collecting worker. In the real-time mode
+        the frames which can't make the deadline are dropped before feeding the model. If the cached 
+        output can be reused, the model is not fed at all.
+        """
+        if not self.pipeline.admit(ctx) or self.pipeline.is_superseded(ctx):
+            self.pipeline.drop(ctx)
+            return
+
+        feed_start = time.perf_counter()
+        signature, cached, output = None, False, None
+        if self.cache:
+            signature = self.cache.get_signature(self.get_gate_images(ctx), key=ctx.stream,
+                                                 values=self.get_gate_values(ctx))
+            cached, output = self.cache.lookup(signature)
+
+        if not cached:
+            if self.replacement is not None:
+                self.pending.join()     # the outputs of the current model must be collected first
+                self.model, self.replacement = self.replacement, None
+                if self.model not in self.models:
+                    self.models.append(self.model)
+            self.submit(ctx)
+        feed_end = time.perf_counter()
+        ctx.trace(self.name + ' feed', feed_start, feed_end)
+        self.pending.put((ctx, signature, cached, output, feed_start, feed_end))
+
+
+    def finish(self):
+        """
+        Lets the collecting worker know that there will be no more inputs.
+        """
+        self.pending.put(END)
+
+
+    def _collect(self):
+        """
+        The collecting worker routine. Model outputs come out in the order of inputs, so they
+        are matched with the pending contexts one by one (skipping the contexts with cached outputs).
+        Private method, to be used by ModelStage only.
+        """
+        while True:
+            item = self.pending.get()
+            if item is END:
+                self.pending.task_done()
+                break
+            ctx, signature, cached, output, feed_start, feed_end = item
+            contexts = [ ctx ]
+
+            try:
+                if cached:
+                    self.set_output(ctx, output)
+                else:
+                    self.collect(ctx)
+                    if self.model.output_time > feed_end:
+                        # Otherwise the output was ready during feeding (synchronous inference or a placeholder)
+                        ctx.trace(self.name + ' inference', feed_end, self.model.output_time)
+                    if self.cache:
+                        self.cache.store(signature, self.get_output(ctx))
+                ctx.trace(self.name, feed_start, time.perf_counter())
+                contexts = self.split(ctx)
+            except Exception as e:
+                self.pipeline.abort(e)
+
+            for ctx in contexts:
+                if self.pipeline.stopped:
+                    self.discard(ctx)
+                elif self.pipeline.is_superseded(ctx):
+                    # There is no way to cancel requests, but at least the next stages won't waste time on it
+                    self.pipeline.drop(ctx)
+                else:
+                    self.emit(ctx)
+            self.pending.task_done()
+
+        self.emit(END)
+
+
+class RouterStage(Stage):
+    """
+    The final stage of the pipeline which routes frame contexts to the branch stages by their stream number.
+    Each branch has its own input queue and worker thread, so a lagging branch doesn't stall the others
+    until its queue is full.
+    """
+
+    def __init__(self, branches, queue_size=4):
+        """
+        Creates a router stage. The branches are the stages processing the streams, in the order of streams.
+        The queue size specifies the number of frames which can wait in front of each branch.
+        """
+        super().__init__('router')
+        self.branches = branches
+        self.queue_size = queue_size
+
+
+    def start(self):
+        """
+        Starts the branches and the routing worker. The pipeline waits for the branch workers as well.
+        """
+        for branch in self.branches:
+            branch.pipeline = self.pipeline
+            branch.input = queue.Queue(maxsize=max(1, self.queue_size))
+            branch.start()
+        super().start()
+        self.workers += [ worker for branch in self.branches for worker in branch.workers ]
+
+
+    def process(self, ctx):
+        """
+        Passes the frame context to the branch of its stream.
+        """
+        self.branches[ctx.stream].input.put(ctx)
+
+
+    def finish(self):
+        """
+        Passes the end-of-stream marker to all branches.
+        """
+        for branch in self.branches:
+            branch.input.put(END)
+
+
+class Pipeline:
+    """
+    Runs a chain of stages connected by bounded queues. Each stage works in its own thread, so a slow
+    stage doesn't stall the others as long as there is room in the queues. When a queue is full,
+    the preceding stage blocks (backpressure).
+
+    In the real-time mode (when the latency budget is specified) the pipeline minimizes latency rather 
+    than maximizes completeness: a frame is not admitted to the first model stage if it can't be processed
+    within the budget, and the frames which are late and superseded by newer ones are dropped.
+    """
+
+    def __init__(self, stages, queue_size=4, latency_budget=None, trace=False, controller=None, max_in_flight=0):
+        """
+        Creates a pipeline from the list of stages. The first stage must be a SourceStage.
+        The queue size specifies the number of frames which can wait between two adjacent stages.
+        The latency budget (in seconds) enables the real-time mode. The trace parameter specifies
+        whether the time spans of all completed frames are kept for write_trace. The controller
+        (see quality.QualityController) adapts the processing to the measured frame rate and latency
+        while the pipeline runs. A positive max in flight limits the number of frames which have been read
+        but not completed or dropped yet: the source waits until one of them leaves the pipeline.
+        """
+        self.stages = stages
+        self.controller = controller
+        self.error = None
+        self._stopped = threading.Event()
+
+        self.max_in_flight = max_in_flight
+        self.frames_read = 0            # frames let in by wait_for_room
+        self.frames_finished = 0        # frames completed or dropped (counted by their first face)
+        self.peak_in_flight = 0
+        self.room = threading.Condition()
+
+        self.latency_budget = latency_budget
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.stream_latencies = defaultdict(list)
+        self.frames_dropped = 0
+        self.frames_in_flight = 0       # frames admitted to the model stages which haven't completed yet
+        self.latest_admitted = -1       # index of the newest admitted frame which is expected to meet the deadline
+        self.expected_latency = 0       # moving average of the time from admission to completion
+        self.first_completion_time = None   # time.time() when the first frame was completed
+        self.span_durations = defaultdict(list) # durations of the processing steps by name
+        self.span_intervals = {}        # the first start and the last end of each processing step
+        self.traces = [] if trace else None # (index, stream, spans) of the completed frames
+
+        for stage in stages:
+            stage.pipeline = self
+
+        for prev_stage, next_stage in zip(stages[:-1], stages[1:]):
+            prev_stage.output = next_stage.input = queue.Queue(maxsize=max(1, queue_size))
+
+
+    @property
+    def stopped(self):
+        """
+        Indicates whether the pipeline was requested to stop.
+        """
+        return self._stopped.is_set()
+
+
+    def stop(self):
+        """
+        Requests the pipeline to stop. The source stops producing frames and the frames
+        which are still in the pipeline are discarded.
+        """
+        self._stopped.set()
+        with self.room:
+            self.room.notify_all()
+
+
+    def wait_for_room(self):
+        """
+        Called by the source before reading a frame. Waits while the number of frames in flight is at
+        the limit (backpressure). Returns False if the pipeline has been stopped.
+        """
+        with self.room:
+            while self.max_in_flight > 0 and self.frames_read - self.frames_finished >= self.max_in_flight \
+                and not self.stopped:
+                self.room.wait()
+            if self.stopped:
+                return False
+            self.frames_read += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.frames_read - self.frames_finished)
+            return True
+
+
+    def _finish_frame(self, ctx):
+        """
+        Makes room for another frame once the frame has left the pipeline.
+        Private method, to be used by Pipeline only.
+        """
+        if ctx.face == 0:
+            with self.room:
+                self.frames_finished += 1
+                self.room.notify_all()
+
+
+    def abort(self, error):
+        """
+        Stops the pipeline due to an error in one of the stages. The first error will be
+        re-raised by the run method.
+        """
+        if self.error is None:
+            self.error = error
+            logging.error(f'Pipeline stage failed: {error}')
+        self.stop()
+
+
+    def admit(self, ctx):
+        """
+        Decides whether the frame is admitted to the model stages. The frame is rejected in the real-time mode
+        if its age along with the expected processing time exceeds the latency budget. However, the frame is
+        always admitted when no other frames are being processed, so the pipeline can't starve. Such a frame
+        doesn't supersede the older ones (see is_superseded) unless it's expected to meet the deadline.
+        The frames skipped by the controller are rejected as well. Returns True for the frames which have
+        been admitted already.
+        """
+        with self.lock:
+            if ctx.admission_time is not None:
+                return True
+            if self.controller is not None and not self.controller.admit(ctx):
+                return False
+
+            now = time.perf_counter()
+            in_time = not self.latency_budget or now - ctx.capture_time + self.expected_latency <= self.latency_budget
+            if self.frames_in_flight > 0 and not in_time:
+                return False
+
+            ctx.admission_time = now
+            self.frames_in_flight += 1
+            if in_time:
+                self.latest_admitted = max(self.latest_admitted, ctx.index)
+            return True
+
+
+    def is_superseded(self, ctx):
+        """
+        Checks whether the frame has exceeded the latency budget while a newer frame, which is expected to meet
+        the deadline, is already being processed. Always returns False if the real-time mode is off.
+        """
+        return bool(self.latency_budget) and ctx.index < self.latest_admitted \
+            and time.perf_counter() - ctx.capture_time > self.latency_budget
+
+
+    def fork(self, ctx, count):
+        """
+        Splits the frame context into the specified number of work items (see FrameContext.fork).
+        Each of them is completed or dropped separately. Returns the list of the contexts.
+        """
+        forks = ctx.fork(count)
+        if ctx.admission_time is not None:
+            with self.lock:
+                self.frames_in_flight += len(forks) - 1
+        return forks
+
+
+    def drop(self, ctx):
+        """
+        Removes the frame from the pipeline without completing it. The additional faces of a frame (see fork)
+        are not counted as dropped frames. The time an admitted frame has spent in the pipeline is the lower bound
+        of its processing time, so it raises the expected latency. Otherwise the estimate wouldn't grow while
+        no frames complete.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            if ctx.face == 0:
+                self.frames_dropped += 1
+            if ctx.admission_time is not None:
+                self.frames_in_flight -= 1
+                self.expected_latency = max(self.expected_latency, now - ctx.admission_time)
+        self._finish_frame(ctx)
+        ctx.release()
+
+
+    def complete(self, ctx):
+        """
+        Registers the frame which went through all stages. Called by the final stage. The frame latency
+        is taken from the first face of the frame (see fork).
+        """
+        now = time.perf_counter()
+        with self.lock:
+            if self.first_completion_time is None:
+                self.first_completion_time = time.time()
+            if ctx.face == 0:
+                self.latencies.append(now - ctx.capture_time)
+                self.stream_latencies[ctx.stream].append(now - ctx.capture_time)
+            if ctx.admission_time is not None:
+                self.frames_in_flight -= 1
+                self.expected_latency = 0.9*self.expected_latency + 0.1*(now - ctx.admission_time)
+
+            for name, start, end in ctx.spans:
+                self.span_durations[name].append(end - start)
+                first_start, last_end = self.span_intervals.get(name, (start, end))
+                self.span_intervals[name] = (min(first_start, start), max(last_end, end))
+            if self.traces is not None:
+                self.traces.append((ctx.index, ctx.stream, ctx.face, ctx.spans))
+        self._finish_frame(ctx)
+
+
+    def get_latency_stats(self, stream=None):
+        """
+        Returns a tuple of the mean, median, 95th and 99th percentiles of the frame latency in seconds 
+        (from capture to completion). If the stream is specified, only its frames are taken into account.
+        Returns None if no frames were completed.
+        """
+        with self.lock:
+            latencies = self.latencies if stream is None else self.stream_latencies.get(stream)
+            if not latencies:
+                return None
+            latencies = np.array(latencies)
+        return (latencies.mean(),) + tuple(np.percentile(latencies, [50, 95, 99]))
+
+
+    def get_span_stats(self):
+        """
+        Returns a dictionary of statistics of the processing steps (decoding, feeding and inference of the models, 
+        the sink, etc.) in the order of their first appearance. Each item is a tuple of the number of frames, 
+        the median, 95th and 99th percentiles of the duration in seconds, and the throughput in frames per second
+        (the number of frames divided by the time from the first start to the last end of the step).
+        """
+        stats = {}
+        with self.lock:
+            for name, durations in self.span_durations.items():
+                first_start, last_end = self.span_intervals[name]
+                throughput = len(durations) / (last_end - first_start) if last_end > first_start else 0
+                stats[name] = (len(durations),) + tuple(np.percentile(durations, [50, 95, 99])) + (throughput,)
+        return stats
+
+
+    def write_trace(self, file_name):
+        """
+        Writes the time spans of the completed frames to a file in the Chrome trace event format, which can be 
+        opened by chrome://tracing or Perfetto. Each processing step is shown as an async track, so the overlapping 
+        requests of a model are visible. Requires the pipeline to be created with trace enabled.
+        """
+        events = []
+        with self.lock:
+            origin = min((start for _, _, _, spans in self.traces for _, start, _ in spans), default=0)
+            for index, stream, face, spans in self.traces:
+                id = f'{stream}-{index}' + (f'-{face}' if face > 0 else '')
+                for name, start, end in spans:
+                    common = { 'name': name, 'cat': name, 'id': id, 'pid': stream, 'tid': 0 }
+                    events.append(dict(common, ph='b', ts=1e6*(start - origin), args={ 'frame': index }))
+                    events.append(dict(common, ph='e', ts=1e6*(end - origin)))
+        with open(file_name, 'w') as f:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+
+    def run(self):
+        """
+        Starts all stages and waits until the whole input is processed or the pipeline is stopped.
+        The stages are started one by one, so the first stages may already run while the next ones
+        are waiting for their models to load.
+        """
+        try:
+            for stage in self.stages:
+                stage.start()
+        except BaseException:
+            # Some stages have not been started, so the rest of the pipeline can't finish gracefully
+            self.stop()
+            raise
+
+        if self.controller is not None:
+            self.controller.start(self)
+        try:
+            for stage in self.stages:
+                for worker in stage.workers:
+                    # Join with a timeout, so the main thread can still handle KeyboardInterrupt
+                    while worker.is_alive():
+                        worker.join(0.1)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+        finally:
+            if self.controller is not None:
+                self.controller.stop()
+
+        if self.error is not None:
+            raise self.error
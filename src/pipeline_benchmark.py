@@ -0,0 +1,298 @@
+"""
+Benchmarks the pipeline itself by means of the synthetic backend (see backends.py), so neither OpenVINO
+nor the model files are required. The frames are generated: each one is filled with a single value derived
+from its index, so the synthetic outputs tell which frame they have been computed from. Four suites are run:
+
+    overhead    the models respond instantly, so the frame rate is limited by the pipeline's own overhead
+                (queues, threads, request scheduling, and preprocessing);
+    ordering    the requests have random latencies and fail at the specified rate, and every completed frame
+                is checked to come in order and to carry the outputs computed from its own image (or None);
+    throughput  the frame rate at several concurrency levels is compared with the bound set by the slowest model;
+    realtime    the frames come at a fixed rate, and the latency budget is below the time a frame takes to pass
+                through the models, so most frames are late; the pipeline must still complete some of them.
+
+The script exits with a non-zero code if the ordering or the real-time check fails, so it can be run in CI:
+    python pipeline_benchmark.py --concurrency 0 1 2 4 --failure-rate 0.05
+"""
+from backends import SyntheticBackend, synthetic_head_pose, synthetic_gaze_vector
+from generic_model import GenericModel
+from face_detection import FaceDetector
+from facial_landmarks_detection import EyeDetector
+from head_pose_estimation import HeadPoseEstimator
+from gaze_estimation import GazeEstimator
+from pipeline import Pipeline, Stage
+from stages import InputStage, FaceDetectionStage, LandmarksStage, HeadPoseStage, GazeStage
+import numpy as np
+import argparse
+import time
+import sys
+
+
+def get_frame_value(index):
+    """
+    Returns the pixel value of the generated frame with the specified index.
+    """
+    return index % 256
+
+
+class SyntheticFeed:
+    """
+    Generates the frames filled with the values returned by get_frame_value. Provides the same interface
+    as InputFeeder does.
+    """
+
+    def __init__(self, frame_count, width, height, frame_rate=0):
+        """
+        Creates a feed of the specified number of frames. If the frame rate is specified, the frames
+        are generated no faster than that, like a webcam does.
+        """
+        self.input = 'synthetic'
+        self.is_cam = False
+        self.frame_count = frame_count
+        self.width = width
+        self.height = height
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        self.frame_rate = frame_rate
+        self.start_time = None
+        self.frame_time = None
+        self.frame_decode_start = None
+
+
+    def read_next(self):
+        """
+        Generates the next frame. Returns None after the last frame.
+        """
+        if self.frames_decoded == self.frame_count:
+            return None
+        if self.frame_rate > 0:
+            if self.start_time is None:
+                self.start_time = time.perf_counter()
+            time.sleep(max(0, self.start_time + self.frames_decoded / self.frame_rate - time.perf_counter()))
+        self.frame_decode_start = time.perf_counter()
+        frame = np.full((self.height, self.width, 3), get_frame_value(self.frames_decoded), dtype=np.uint8)
+        self.frame_time = time.perf_counter()
+        self.frames_decoded += 1
+        return frame
+
+
+    def recycle(self, frame):
+        """
+        The frames are not reused.
+        """
+        pass
+
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+        pass
+
+
+class CheckSink(Stage):
+    """
+    The final stage which checks the order of frames and their outputs.
+    """
+
+    def __init__(self):
+        """
+        Creates the sink.
+        """
+        super().__init__('sink')
+        self.indices = []
+        self.mismatches = 0     # frames with the outputs computed from other frames
+        self.failures = 0       # frames without a gaze vector because of failed requests
+
+
+    def process(self, ctx):
+        """
+        Checks the outputs of the frame.
+        """
+        value = get_frame_value(ctx.index)
+        yaw, _, _ = synthetic_head_pose(value)
+        expected_gaze_vector = synthetic_gaze_vector(value, value, yaw)
+
+        # The gaze estimator returns zeros instead of the missing gaze vector
+        if ctx.gaze_vector is None or not any(ctx.gaze_vector):
+            self.failures += 1
+        elif ctx.head_pose is None or not np.isclose(ctx.head_pose[0], yaw, atol=1e-2) \
+            or not np.allclose(ctx.gaze_vector, expected_gaze_vector, atol=1e-3):
+            self.mismatches += 1
+        self.indices.append(ctx.index)
+
+        self.pipeline.complete(ctx)
+        ctx.release()
+
+
+    def is_ordered(self, frame_count):
+        """
+        Checks whether all frames have been completed in order.
+        """
+        return self.indices == list(range(frame_count))
+
+
+def run(backend, concurrency, args, cpu_streams=0, frame_rate=0, latency_budget=0):
+    """
+    Runs the pipeline on the generated frames. Returns a tuple of the sink, the pipeline, and the processing time.
+    """
+    config = GenericModel.make_cpu_config(cpu_streams)
+    model_args = dict(precision='FP32', concurrency=concurrency, backend=backend, config=config or None)
+    batch_args = dict(batch_size=args.batch) if concurrency > 0 else {}
+    faceDetector = FaceDetector(**model_args)
+    eyeDetector = EyeDetector(**model_args, **batch_args)
+    headPoseEstimator = HeadPoseEstimator(**model_args, **batch_args)
+    gazeEstimator = GazeEstimator(**model_args)
+
+    sink = CheckSink()
+    pipeline = Pipeline([
+        InputStage(SyntheticFeed(args.frames, args.width, args.height, frame_rate)),
+        FaceDetectionStage(faceDetector, confidence=0.5, keep_frames=False),
+        LandmarksStage(eyeDetector),
+        HeadPoseStage(headPoseEstimator),
+        GazeStage(gazeEstimator),
+        sink
+    ], queue_size=args.queue_size, latency_budget=latency_budget)
+
+    t = time.perf_counter()
+    pipeline.run()
+    return sink, pipeline, time.perf_counter() - t
+
+
+def parse_model_values(items, convert):
+    """
+    Parses the list of 'model=value' strings into a dictionary.
+    """
+    values = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise Exception('Expected model=value: ' + item)
+        values[name] = convert(value)
+    return values
+
+
+def benchmark_overhead(args):
+    """
+    Measures the frame rate with the models responding instantly.
+    """
+    print('Pipeline Overhead (zero model latency)')
+    print(f'{"Concurrency":<14}{"FPS":>10}{"Overhead, us/frame":>20}{"p50 latency, ms":>17}')
+    latencies = dict.fromkeys(['face-detection', 'landmarks', 'head-pose', 'gaze'], 'constant:0')
+    for concurrency in args.concurrency:
+        sink, pipeline, t = run(SyntheticBackend(latencies, seed=args.seed), concurrency, args)
+        fps = len(sink.indices) / t
+        _, p50, _, _ = pipeline.get_latency_stats() or (0, 0, 0, 0)
+        print(f'{concurrency:<14}{fps:>10.1f}{1e6/fps:>20.1f}{1000*p50:>17.2f}')
+    print()
+
+
+def benchmark_ordering(args, latencies):
+    """
+    Checks the order of frames and their outputs with random latencies and failures. Returns True on success.
+    """
+    failure_rates = dict.fromkeys(['face-detection', 'landmarks', 'head-pose', 'gaze'], args.failure_rate)
+    # Only the asynchronous requests can fail (see SyntheticRequest.infer)
+    success_rate = (1 - args.failure_rate) ** 4
+    print(f'Ordering (failure rate {args.failure_rate} per request)')
+    print(f'{"Concurrency":<14}{"Frames":>8}{"In Order":>10}{"Mismatches":>12}{"Failed":>8}{"Expected":>10}')
+    passed = True
+    for concurrency in args.concurrency:
+        backend = SyntheticBackend(latencies, failure_rates, seed=args.seed)
+        sink, _, _ = run(backend, concurrency, args)
+        ordered = sink.is_ordered(args.frames)
+        expected_failures = args.frames * (1 - success_rate) if concurrency > 0 else 0
+        print(f'{concurrency:<14}{len(sink.indices):>8}{str(ordered):>10}{sink.mismatches:>12}{sink.failures:>8}'
+              f'{expected_failures:>10.0f}')
+        passed = passed and ordered and sink.mismatches == 0 and (concurrency > 0 or sink.failures == 0)
+    print()
+    return passed
+
+
+def benchmark_throughput(args, latencies):
+    """
+    Measures the frame rate at the concurrency levels. The synthetic device runs as many requests of a model
+    in parallel as the concurrency level is, so the bound is set by the model with the longest mean latency.
+    """
+    print('Throughput')
+    print(f'{"Concurrency":<14}{"FPS":>10}{"Bound FPS":>12}{"Efficiency":>12}{"p50, ms":>10}{"p95, ms":>10}{"p99, ms":>10}')
+    for concurrency in args.concurrency:
+        backend = SyntheticBackend(latencies, seed=args.seed)
+        sink, pipeline, t = run(backend, concurrency, args, cpu_streams=concurrency)
+        fps = len(sink.indices) / t
+        slowest = max(latency.mean for latency in backend.latencies.values())
+        bound = max(1, concurrency) / slowest if slowest > 0 else float('inf')
+        _, p50, p95, p99 = pipeline.get_latency_stats() or (0, 0, 0, 0)
+        print(f'{concurrency:<14}{fps:>10.1f}{bound:>12.1f}{100*fps/bound:>11.1f}%'
+              f'{1000*p50:>10.2f}{1000*p95:>10.2f}{1000*p99:>10.2f}')
+    print()
+
+
+def benchmark_realtime(args, latencies):
+    """
+    Runs the real-time mode with the latency budget set to a half of the mean time a frame takes to pass through
+    the models, so no frame can make the deadline. The pipeline must still keep completing frames rather than
+    drop all of them: at least a quarter of the frames which the models can process one by one at the input
+    frame rate. Returns True on success.
+    """
+    print(f'Real-Time Mode ({args.frame_rate:g} FPS input)')
+    print(f'{"Concurrency":<14}{"Frames":>8}{"Budget, ms":>12}{"Completed":>11}{"Dropped":>9}{"Completion Rate":>17}{"Expected":>10}')
+    passed = True
+    for concurrency in args.concurrency:
+        backend = SyntheticBackend(latencies, seed=args.seed)
+        frame_time = sum(latency.mean for latency in backend.latencies.values())
+        budget = 0.5 * frame_time
+        expected = args.frames * min(1, 1 / (args.frame_rate * frame_time)) if frame_time > 0 else args.frames
+        sink, pipeline, _ = run(backend, concurrency, args, frame_rate=args.frame_rate, latency_budget=budget)
+        completed = len(sink.indices)
+        print(f'{concurrency:<14}{args.frames:>8}{1000*budget:>12.2f}{completed:>11}{pipeline.frames_dropped:>9}'
+              f'{100*completed/args.frames:>16.1f}%{expected:>10.0f}')
+        passed = passed and completed >= expected / 4 and sink.indices == sorted(sink.indices) and sink.mismatches == 0
+    print()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthetic Pipeline Benchmark")
+    parser.add_argument('--suites', type=str, nargs='+', default=['overhead', 'ordering', 'throughput', 'realtime'],
+                        choices=['overhead', 'ordering', 'throughput', 'realtime'], help="The suites to run. Default is all.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help="The numbers of concurrent requests per model. Default is 0 1 2 4.")
+    parser.add_argument('--batch', type=int, default=1,
+                        help="Defines the batch size of the landmarks and head pose models in the asynchronous mode. "
+                            "Default is 1.")
+    parser.add_argument('--latency', type=str, nargs='*', default=[],
+                        help="Specifies the latency distributions of the models as MODEL=DISTRIBUTION, e.g. "
+                            "face-detection=lognormal:6:0.2 (see backends.LatencyDistribution). The models are "
+                            "face-detection, landmarks, head-pose, and gaze. The defaults are close to the FP32 "
+                            "models on a 4-core CPU.")
+    parser.add_argument('--failure-rate', type=float, default=0.02,
+                        help="Defines the share of asynchronous requests which fail in the ordering suite. Default is 0.02.")
+    parser.add_argument('--frames', type=int, default=500, help="Number of frames per run. Default is 500.")
+    parser.add_argument('--width', type=int, default=640, help="Frame width. Default is 640.")
+    parser.add_argument('--height', type=int, default=480, help="Frame height. Default is 480.")
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help="Defines the number of frames which can wait between two adjacent pipeline stages. Default is 4.")
+    parser.add_argument('--frame-rate', type=float, default=100,
+                        help="Defines the input frame rate in the realtime suite. Default is 100.")
+    parser.add_argument('--seed', type=int, default=0, help="The seed of the random latencies and failures. Default is 0.")
+    args = parser.parse_args()
+
+    latencies = parse_model_values(args.latency, str)
+    passed = True
+    if 'overhead' in args.suites:
+        benchmark_overhead(args)
+    if 'ordering' in args.suites:
+        passed = benchmark_ordering(args, latencies)
+    if 'throughput' in args.suites:
+        benchmark_throughput(args, latencies)
+    realtime_passed = True
+    if 'realtime' in args.suites:
+        realtime_passed = benchmark_realtime(args, latencies)
+
+    if not passed:
+        print('Ordering check FAILED')
+    if not realtime_passed:
+        print('Real-time check FAILED')
+    if not passed or not realtime_passed:
+        sys.exit(1)
@@ -0,0 +1,186 @@
+"""
+Compares the legacy preprocessing (resize, HWC -> CHW view, and a copy to the input blob made by the plugin)
+with the zero-copy preprocessing which resizes images straight into the input blobs (helpers.resize_into),
+and with the part of the engine preprocessing done in Python: a crop is copied to contiguous memory before
+being wrapped into a blob (the resize done by the plugin is not included).
+Input blobs are emulated with preallocated arrays, so neither OpenVINO nor the models are required.
+
+When an input file is specified, the script also runs the models on it and compares the OpenCV preprocessing 
+with the built-in preprocessing of the inference engine.
+"""
+import helpers
+import cv2
+import numpy as np
+import argparse
+import tracemalloc
+import time
+
+
+# The crops taken from each frame: (name, crop rectangle relative to the frame size, blob size)
+CROPS = [
+    ('face detection', (0.0, 0.0, 1.0, 1.0), (300, 300)),
+    ('landmarks', (0.3, 0.2, 0.6, 0.7), (60, 60)),
+    ('head pose', (0.3, 0.2, 0.6, 0.7), (60, 60)),
+    ('left eye', (0.35, 0.3, 0.42, 0.38), (60, 60)),
+    ('right eye', (0.48, 0.3, 0.55, 0.38), (60, 60))
+]
+
+
+def preprocess_legacy(image, blob):
+    """
+    The preprocessing used before: a resized image is allocated, and the plugin copies its
+    non-contiguous CHW view to the input blob.
+    """
+    resized = cv2.resize(src=image, dsize=(blob.shape[3], blob.shape[2]))
+    chw = np.moveaxis(resized, -1, 0)[None,...]
+    np.copyto(blob, chw)    # done by the plugin when the input dictionary is passed to infer
+
+
+def preprocess_zero_copy(image, blob, scratch):
+    """
+    Resizes the image straight into the blob. Returns the scratch array.
+    """
+    return helpers.resize_into(image, blob[0], scratch)
+
+
+def preprocess_engine(image):
+    """
+    The copy made by GenericModel for the engine preprocessing: a blob requires contiguous memory,
+    so crops and reflected frames are copied, while whole frames are passed as is.
+    """
+    return np.ascontiguousarray(image[None,...])
+
+
+def preprocess_frames(frames, method, on_crop=None):
+    """
+    Preprocesses all crops of the frames by the specified method. The on_crop callback is called
+    before and after each crop is preprocessed (with the argument 'before' or 'after').
+    """
+    blobs = [ np.zeros((1, 3, h, w), dtype=np.float32) for _, _, (w, h) in CROPS ]
+    scratches = [ None ] * len(CROPS)
+    for frame in frames:
+        fh, fw = frame.shape[:2]
+        for i, (_, (x0, y0, x1, y1), _) in enumerate(CROPS):
+            crop = frame[int(y0*fh):int(y1*fh), int(x0*fw):int(x1*fw)]
+            if on_crop:
+                on_crop('before')
+            if method == 'legacy':
+                preprocess_legacy(crop, blobs[i])
+            elif method == 'engine':
+                preprocess_engine(crop)
+            else:
+                scratches[i] = preprocess_zero_copy(crop, blobs[i], scratches[i])
+            if on_crop:
+                on_crop('after')
+
+
+def run(frames, method, min_size=1024):
+    """
+    Preprocesses all crops of the frames by the specified method. Returns the average number of
+    preprocessing calls per frame which allocated memory, the peak of temporary memory, and the time per frame.
+    The allocations are measured by tracemalloc (numpy reports its arrays to it) in a separate pass, so they
+    don't slow down the timed one. Allocations smaller than the min size (Python objects) are not counted.
+    """
+    t = time.perf_counter()
+    preprocess_frames(frames, method)
+    t = time.perf_counter() - t
+
+    stats = { 'allocating calls': 0, 'peak': 0 }
+    def on_crop(when):
+        if when == 'before':
+            tracemalloc.clear_traces()  # resets the peak as well
+        else:
+            _, peak = tracemalloc.get_traced_memory()
+            stats['peak'] = max(stats['peak'], peak)
+            stats['allocating calls'] += peak >= min_size
+
+    tracemalloc.start()
+    try:
+        preprocess_frames(frames, method, on_crop)
+    finally:
+        tracemalloc.stop()
+
+    return stats['allocating calls'] / len(frames), stats['peak'], t / len(frames)
+
+
+def run_models(input, precision, device, preprocessing, max_frames):
+    """
+    Runs the four models synchronously on the input frames with the specified preprocessing mode.
+    Returns a dictionary of the average time per frame (preprocessing + inference) for each model.
+    """
+    # These modules require OpenVINO, so they are imported only when the models are benchmarked
+    from input_feeder import InputFeeder
+    from face_detection import FaceDetector
+    from facial_landmarks_detection import EyeDetector
+    from head_pose_estimation import HeadPoseEstimator
+    from gaze_estimation import GazeEstimator
+
+    model_args = dict(precision=precision, concurrency=0, device=device, preprocessing=preprocessing)
+    faceDetector = FaceDetector(**model_args)
+    eyeDetector = EyeDetector(**model_args)
+    headPoseEstimator = HeadPoseEstimator(**model_args)
+    gazeEstimator = GazeEstimator(**model_args)
+
+    def timed(model_name, func, *func_args, **func_kwargs):
+        t = time.perf_counter()
+        result = func(*func_args, **func_kwargs)
+        timings[model_name] += time.perf_counter() - t
+        return result
+
+    timings = dict.fromkeys(['face detection', 'landmarks', 'head pose', 'gaze'], 0)
+    feed = InputFeeder(input)
+    frame_count = 0
+    while frame_count < max_frames:
+        frame = feed.read_next()
+        if frame is None:
+            break
+        frame_count += 1
+
+        timed('face detection', faceDetector.feed_input, frame)
+        _, face_box = timed('face detection', faceDetector.consume_output, confidence=0.5, wait=True)
+        face_img, face_box = faceDetector.preprocess_output(face_box, frame)
+
+        timed('landmarks', eyeDetector.feed_input, face_img)
+        _, eye_boxes = timed('landmarks', eyeDetector.consume_output, wait_needed=True)
+        left_eye, right_eye = eyeDetector.preprocess_output(eye_boxes, face_img)
+
+        timed('head pose', headPoseEstimator.feed_input, face_img)
+        _, head_pose = timed('head pose', headPoseEstimator.consume_output, wait=True)
+
+        timed('gaze', gazeEstimator.feed_input, left_eye, right_eye, head_pose)
+        timed('gaze', gazeEstimator.consume_output, wait=True)
+
+    feed.close()
+    return { name : t / max(1, frame_count) for name, t in timings.items() }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Preprocessing Benchmark")
+    parser.add_argument('--width', type=int, default=1280, help="Frame width. Default is 1280.")
+    parser.add_argument('--height', type=int, default=720, help="Frame height. Default is 720.")
+    parser.add_argument('--frames', type=int, default=200, help="Number of frames to process. Default is 200.")
+    parser.add_argument('--reflect', action='store_true', default=False,
+                        help="Uses reflected frames like the webcam input does.")
+    parser.add_argument('--input', type=str, default=None,
+                        help="An input video file for comparing the OpenCV and the engine preprocessing with the models.")
+    parser.add_argument('--precision', type=str, default='FP32', help="Model precision. Default is FP32.")
+    parser.add_argument('--device', type=str, default='CPU', help="Device name to perform inference on. Default is CPU.")
+    args = parser.parse_args()
+
+    frame = np.random.randint(0, 256, size=(args.height, args.width, 3), dtype=np.uint8)
+    if args.reflect:
+        frame = frame[:,::-1,:]
+    frames = [ frame ] * args.frames
+
+    print(f'{"Method":<12}{"Allocating calls/frame":>24}{"Temporary memory":>20}{"Time/frame":>14}')
+    for method in ('legacy', 'zero-copy', 'engine'):
+        allocations, peak, t = run(frames, method)
+        print(f'{method:<12}{allocations:>24.2f}{peak/1024:>17.1f} KB{t*1000:>11.3f} ms')
+    print('The engine preprocessing is measured without the resize done by the plugin: only the copies of the crops.')
+
+    if args.input:
+        print(f'\n{"Model":<16}{"OpenCV":>12}{"Engine":>12}')
+        timings = { mode : run_models(args.input, args.precision, args.device, mode, args.frames) 
+                    for mode in ('opencv', 'engine') }
+        for model_name in timings['opencv']:
+            print(f'{model_name:<16}{timings["opencv"][model_name]*1000:>9.3f} ms{timings["engine"][model_name]*1000:>9.3f} ms')
@@ -0,0 +1,181 @@
+"""
+Layer-wise profiling of the models. Performance counters are sampled every N requests, and the per-layer
+statistics can be printed, exported to JSON or CSV, and compared between two saved runs.
+
+Run this module as a script to compare two runs saved in the JSON format, e.g. FP32 vs FP32-INT8:
+    python profiler.py ../profiles/fp32.json ../profiles/int8.json --top 20
+"""
+import numpy as np
+import argparse
+import json
+import csv
+
+
+class LayerProfiler:
+    """
+    Collects the performance counters of a model's layers. The counters are obtained from a request
+    only once in the specified number of requests, which cuts the profiling overhead.
+    """
+
+    def __init__(self, sample_interval=1):
+        """
+        Creates a profiler sampling every sample_interval-th request. Zero disables sampling.
+        """
+        self.sample_interval = sample_interval
+        self.reset()
+
+
+    def reset(self):
+        """
+        Discards the collected statistics.
+        """
+        self.requests = 0
+        self.samples = 0
+        self.layers = {}    # layer name -> dictionary of the layer type, execution type, and lists of timings
+
+
+    def should_sample(self):
+        """
+        Counts a completed request and tells whether its performance counters have to be sampled.
+        """
+        self.requests += 1
+        return self.sample_interval > 0 and (self.requests - 1) % self.sample_interval == 0
+
+
+    def add(self, perf_counts):
+        """
+        Adds a sample of the performance counters returned by InferRequest.get_perf_counts.
+        The layers which have not been executed are ignored.
+        """
+        self.samples += 1
+        for layer_name, counters in perf_counts.items():
+            if counters.get('status', 'EXECUTED') != 'EXECUTED':
+                continue
+            layer = self.layers.get(layer_name)
+            if layer is None:
+                layer = self.layers[layer_name] = { 'layer_type': counters.get('layer_type', ''),
+                                                    'exec_type': counters.get('exec_type', ''),
+                                                    'real_time': [], 'cpu_time': [] }
+            layer['real_time'].append(counters.get('real_time', 0))
+            layer['cpu_time'].append(counters.get('cpu_time', 0))
+
+
+    def get_layer_stats(self):
+        """
+        Returns a list of the per-layer statistics sorted by the total execution time in descending order.
+        Each item is a dictionary of the layer name, type, execution type (the kernel chosen by the plugin),
+        the number of samples, the mean and the percentiles of the real time, and the mean CPU time.
+        The times are in microseconds.
+        """
+        stats = []
+        for layer_name, layer in self.layers.items():
+            real_time = np.array(layer['real_time'], dtype=np.float64)
+            p50, p95, p99 = np.percentile(real_time, [50, 95, 99])
+            stats.append({ 'layer': layer_name, 'layer_type': layer['layer_type'], 'exec_type': layer['exec_type'],
+                           'count': len(real_time), 'mean': real_time.mean(), 'p50': p50, 'p95': p95, 'p99': p99,
+                           'cpu_time': float(np.mean(layer['cpu_time'])), 'total': real_time.sum() })
+        return sorted(stats, key=lambda s: s['total'], reverse=True)
+
+
+    def format_top(self, top=10):
+        """
+        Returns a table of the top layers by the total execution time as a multiline string.
+        """
+        stats = self.get_layer_stats()
+        if not stats:
+            return 'No data'
+
+        total = sum(s['total'] for s in stats)
+        lines = [ f'Requests: {self.requests}, Samples: {self.samples}, Mean time per sample: {total / self.samples:.1f} us',
+                  f'{"Layer":<40}{"Type":<16}{"Exec Type":<20}{"Mean, us":>10}{"p95, us":>10}{"p99, us":>10}{"CPU, us":>10}{"Share":>8}' ]
+        for s in stats[:top]:
+            lines.append(f'{s["layer"][:39]:<40}{s["layer_type"][:15]:<16}{s["exec_type"][:19]:<20}{s["mean"]:>10.1f}'
+                         f'{s["p95"]:>10.1f}{s["p99"]:>10.1f}{s["cpu_time"]:>10.1f}{100*s["total"]/total:>7.1f}%')
+        return '\n'.join(lines)
+
+
+    def to_dict(self):
+        """
+        Returns the statistics as a dictionary which can be serialized to JSON.
+        """
+        return { 'requests': self.requests, 'samples': self.samples, 'sample_interval': self.sample_interval,
+                 'layers': self.get_layer_stats() }
+
+
+def save_profiles(file_name, profilers):
+    """
+    Saves the statistics of several models (a dictionary of profilers by model name) to a file.
+    The format (.json or .csv) is defined by the extension. Only JSON files can be compared by diff_profiles.
+    """
+    profiles = { model_name : profiler.to_dict() for model_name, profiler in profilers.items() }
+    if file_name.lower().endswith('.csv'):
+        columns = [ 'layer', 'layer_type', 'exec_type', 'count', 'mean', 'p50', 'p95', 'p99', 'cpu_time', 'total' ]
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([ 'model' ] + columns)
+            for model_name, profile in profiles.items():
+                for layer in profile['layers']:
+                    writer.writerow([ model_name ] + [ layer[column] for column in columns ])
+    else:
+        with open(file_name, 'w') as f:
+            json.dump(profiles, f, indent=2)
+
+
+def diff_profiles(base, other):
+    """
+    Compares two runs saved by save_profiles in the JSON format (passed as loaded dictionaries).
+    Returns a tuple of two lists. The first one compares the layers by name, the second one
+    compares the layer types (since different precisions may fuse layers differently). The items are tuples
+    of the model name, the layer name or type, the mean time per request in the base and the other run (None
+    if the layer is missing), and the difference, sorted by the absolute difference in descending order.
+    """
+    layer_rows, type_rows = [], []
+    for model_name in sorted(set(base) | set(other)):
+        times, type_times = [], []
+        for profile in (base.get(model_name), other.get(model_name)):
+            layers = profile['layers'] if profile else []
+            # The mean time per request, so the runs with different numbers of samples are comparable
+            samples = max(1, profile['samples']) if profile else 1
+            times.append({ l['layer'] : l['total'] / samples for l in layers })
+            by_type = {}
+            for l in layers:
+                by_type[l['layer_type']] = by_type.get(l['layer_type'], 0) + l['total'] / samples
+            type_times.append(by_type)
+
+        for rows, (base_times, other_times) in ((layer_rows, times), (type_rows, type_times)):
+            for name in set(base_times) | set(other_times):
+                base_time, other_time = base_times.get(name), other_times.get(name)
+                rows.append((model_name, name, base_time, other_time, (other_time or 0) - (base_time or 0)))
+
+    key = lambda row: abs(row[4])
+    return sorted(layer_rows, key=key, reverse=True), sorted(type_rows, key=key, reverse=True)
+
+
+def format_diff(rows, top=20, title='Layer'):
+    """
+    Returns the top rows returned by diff_profiles as a multiline string. The title is the name of the second column.
+    """
+    fmt = lambda t: f'{t:>12.1f}' if t is not None else f'{"-":>12}'
+    lines = [ f'{"Model":<28}{title:<40}{"Base, us":>12}{"Other, us":>12}{"Diff, us":>12}' ]
+    for model_name, name, base_time, other_time, difference in rows[:top]:
+        lines.append(f'{model_name[:27]:<28}{name[:39]:<40}{fmt(base_time)}{fmt(other_time)}{difference:>+12.1f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Layer-wise Profile Comparison")
+    parser.add_argument('base', type=str, help="The JSON file of the base run.")
+    parser.add_argument('other', type=str, help="The JSON file of the run compared to the base one.")
+    parser.add_argument('--top', type=int, default=20, help="Number of the largest differences to show. Default is 20.")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.other) as f:
+        other = json.load(f)
+
+    layer_rows, type_rows = diff_profiles(base, other)
+    print('Layers (mean time per request)')
+    print(format_diff(layer_rows, args.top))
+    print('\nLayer Types (mean time per request)')
+    print(format_diff(type_rows, args.top, title='Layer Type'))
@@ -0,0 +1,288 @@
+"""
+Adaptive quality control: holds a target frame rate or frame latency while the load of the machine varies
+by trading the quality of the results for speed. The levers are applied one step at a time in the order
+they are given and released in the reverse order:
+
+    precision   switches the model stage which takes the longest to the fallback precision (e.g. FP32-INT8),
+                the fallback models are preloaded in the background;
+    detection   runs the face detector less often (twice as rarely per step), the face tracker fills the gaps;
+    skip        processes only one of every N frames of each stream (N grows by one per step).
+
+The controller measures the pipeline once per period. When the target is missed, the next step is applied.
+When the target has been met for a number of periods, the last step is released to probe whether the machine
+is able to keep up again. A probe which fails doubles the number of periods before the next one, so the
+controller doesn't oscillate. Every switch is logged along with the measurements which triggered it.
+"""
+from pipeline import ModelStage
+from concurrent.futures import wait
+import numpy as np
+import threading
+import logging
+import time
+
+
+# The levers in the default order of application
+LEVERS = ['precision', 'detection', 'skip']
+
+
+def preload(futures, model_class, **kwargs):
+    """
+    Waits for the futures (e.g. the models which the pipeline needs to start) and creates the model.
+    Used for loading the fallback models in the background.
+    """
+    wait([ future for future in futures if future ])
+    return model_class(**kwargs)
+
+
+class QualityController:
+    """
+    Adapts the pipeline to hold the target frame rate and/or latency (see the module docstring).
+    """
+
+    def __init__(self, target_fps=0, target_latency=0, period=1.0, levers=LEVERS, fallback_models=None,
+                 face_trackers=None, max_detection_interval=8, max_skip=4, settle_periods=2, probe_periods=4):
+        """
+        Creates a controller. The target frame rate is the number of input frames handled per second (including
+        the skipped ones), the target latency (in seconds) applies to the 95th percentile of the frame latency.
+        A zero target is ignored. The period (in seconds) defines how often the pipeline is measured.
+        The fallback models are a dictionary of futures of the models by stage name. The face trackers
+        (one for each stream) are required by the detection lever. The settle periods are skipped after
+        each switch, so the measurements reflect the new configuration. The probe periods is the initial
+        number of periods the target has to be met for before a step is released.
+        """
+        self.target_fps = target_fps
+        self.target_latency = target_latency
+        self.period = period
+        self.levers = levers
+        self.fallback_models = fallback_models or {}
+        self.face_trackers = [ tracker for tracker in face_trackers or [] if tracker ]
+        self.max_detection_interval = max_detection_interval
+        self.max_skip = max_skip
+        self.settle_periods = settle_periods
+        self.probe_periods = probe_periods
+
+        self.pipeline = None
+        self.stages = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.steps = []             # the applied steps, the latest one last
+        self.stride = 1             # one of every stride frames of each stream is processed
+        self.stream_counts = {}     # the frames seen by admit by stream
+        self.frames_skipped = 0
+        self.switches = []          # (time.perf_counter, description, measurements) of every switch
+        self.settle = 0
+        self.good_periods = 0
+        self.probing = False
+        self.exhausted = False
+
+        self.mark_time = None
+        self.completed = 0
+        self.consumed = 0
+        self.span_counts = {}
+
+
+    def admit(self, ctx):
+        """
+        Decides whether the frame is processed or skipped. Called by Pipeline.admit under the pipeline lock.
+        """
+        if self.stride <= 1:
+            return True
+        count = self.stream_counts.get(ctx.stream, 0)
+        self.stream_counts[ctx.stream] = count + 1
+        if count % self.stride:
+            self.frames_skipped += 1
+            return False
+        return True
+
+
+    def start(self, pipeline):
+        """
+        Starts measuring the pipeline in the controller thread. Called by Pipeline.run.
+        """
+        self.pipeline = pipeline
+        self.stages = [ stage for stage in pipeline.stages if isinstance(stage, ModelStage) ]
+        self._measure()     # set the marks
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='quality', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Stops the controller thread.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def describe(self):
+        """
+        Returns the description of the current configuration.
+        """
+        if not self.steps:
+            return 'full quality'
+        parts = [ f'{stage.name} at the fallback precision' for lever, stage, _ in self.steps if lever == 'precision' ]
+        if self.face_trackers and self.face_trackers[0].interval > 1:
+            parts.append(f'face detection once in {self.face_trackers[0].interval} frames')
+        if self.stride > 1:
+            parts.append(f'1 of {self.stride} frames processed')
+        return ', '.join(parts)
+
+
+    def _run(self):
+        """
+        The controller thread routine: measures the pipeline and makes a decision once per period.
+        Private method, to be used by QualityController only.
+        """
+        while not self.stopped.wait(self.period):
+            measurements = self._measure()
+            if measurements is not None:
+                self._decide(measurements)
+
+
+    def _measure(self):
+        """
+        Measures the frame rate, the 95th percentile of the frame latency, and the median time of each
+        model stage (from feeding to collecting) since the previous call. Returns a dictionary or None
+        if no frames were completed.
+        Private method, to be used by QualityController only.
+        """
+        pipeline = self.pipeline
+        now = time.perf_counter()
+        with pipeline.lock:
+            completed = len(pipeline.latencies)
+            consumed = completed + pipeline.frames_dropped
+            latencies = pipeline.latencies[self.completed:]
+            stage_times = {}
+            for stage in self.stages:
+                durations = pipeline.span_durations.get(stage.name, [])
+                if len(durations) > self.span_counts.get(stage.name, 0):
+                    stage_times[stage.name] = float(np.median(durations[self.span_counts.get(stage.name, 0):]))
+                self.span_counts[stage.name] = len(durations)
+
+        elapsed = now - self.mark_time if self.mark_time is not None else 0
+        fps = (consumed - self.consumed) / elapsed if elapsed > 0 else 0
+        self.mark_time, self.completed, self.consumed = now, completed, consumed
+        if not latencies:
+            return None
+        return { 'fps': fps, 'latency': float(np.percentile(latencies, 95)), 'stages': stage_times }
+
+
+    def _decide(self, measurements):
+        """
+        Applies the next step if the target is missed or releases the last one if the target has been
+        met long enough.
+        Private method, to be used by QualityController only.
+        """
+        if self.settle > 0:
+            self.settle -= 1
+            return
+
+        missed = (self.target_fps and measurements['fps'] < self.target_fps) or \
+            (self.target_latency and measurements['latency'] > self.target_latency)
+        if missed:
+            self.good_periods = 0
+            if self.probing:
+                # The machine can't keep up with the released step yet, so the next probe waits longer
+                self.probe_periods = min(2 * self.probe_periods, 64)
+                self.probing = False
+            description = self._degrade(measurements)
+            if description is None:
+                if not self.exhausted:
+                    logging.warning(f'Quality controller: the target is missed, no levers left ({self._format(measurements)})')
+                    self.exhausted = True
+                return
+        else:
+            self.probing = False
+            self.good_periods += 1
+            if not self.steps or self.good_periods < self.probe_periods:
+                return
+            description = self._upgrade()
+            self.good_periods = 0
+            self.probing = True
+            self.exhausted = False
+
+        self.settle = self.settle_periods
+        self.switches.append((time.perf_counter(), description, measurements))
+        logging.info(f'Quality controller: {description} ({self._format(measurements)})')
+
+
+    def _degrade(self, measurements):
+        """
+        Applies the next available step. Returns its description or None if all levers are exhausted.
+        Private method, to be used by QualityController only.
+        """
+        for lever in self.levers:
+            if lever == 'precision':
+                swapped = [ stage for _, stage, _ in (step for step in self.steps if step[0] == 'precision') ]
+                candidates = [ stage for stage in self.stages if stage not in swapped and self._is_ready(stage.name) ]
+                if candidates:
+                    # The stage which takes the longest gains the most
+                    stage = max(candidates, key=lambda stage: measurements['stages'].get(stage.name, 0))
+                    self.steps.append(('precision', stage, stage.model))
+                    stage.replace_model(self.fallback_models[stage.name].result())
+                    return f'{stage.name} switched to the fallback precision'
+            elif lever == 'detection':
+                interval = self.face_trackers[0].interval if self.face_trackers else None
+                if interval is not None and interval < self.max_detection_interval:
+                    self.steps.append(('detection', None, interval))
+                    self._set_detection_interval(min(2 * interval, self.max_detection_interval))
+                    return f'face detection once in {self.face_trackers[0].interval} frames'
+            elif lever == 'skip':
+                if self.stride < self.max_skip:
+                    self.steps.append(('skip', None, self.stride))
+                    self.stride += 1
+                    return f'processing 1 of {self.stride} frames'
+        return None
+
+
+    def _upgrade(self):
+        """
+        Releases the last applied step. Returns its description.
+        Private method, to be used by QualityController only.
+        """
+        lever, stage, previous = self.steps.pop()
+        if lever == 'precision':
+            stage.replace_model(previous)
+            return f'{stage.name} switched back to the primary precision'
+        elif lever == 'detection':
+            self._set_detection_interval(previous)
+            return f'face detection once in {previous} frames'
+        else:
+            self.stride = previous
+            return f'processing 1 of {previous} frames' if previous > 1 else 'processing every frame'
+
+
+    def _is_ready(self, stage_name):
+        """
+        Checks whether the fallback model of the stage has been loaded successfully.
+        Private method, to be used by QualityController only.
+        """
+        future = self.fallback_models.get(stage_name)
+        return future is not None and future.done() and future.exception() is None
+
+
+    def _set_detection_interval(self, interval):
+        """
+        Sets the face detection interval of all face trackers.
+        Private method, to be used by QualityController only.
+        """
+        for tracker in self.face_trackers:
+            tracker.interval = interval
+
+
+    def _format(self, measurements):
+        """
+        Formats the measurements for the log.
+        Private method, to be used by QualityController only.
+        """
+        stages = ', '.join(f'{name} {1000*t:.1f} ms' for name, t in measurements['stages'].items())
+        targets = []
+        if self.target_fps:
+            targets.append(f'target {self.target_fps:g} FPS')
+        if self.target_latency:
+            targets.append(f'target {1000*self.target_latency:g} ms')
+        return f'{measurements["fps"]:.1f} FPS, p95 latency {1000*measurements["latency"]:.1f} ms, ' \
+               f'{", ".join(targets)}; stages: {stages}'
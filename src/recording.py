@@ -0,0 +1,149 @@
+import numpy as np
+import json
+import cv2
+import os
+
+# The recorded model outputs and the shapes of their per-frame values. Missing values are stored as NaN.
+FIELDS = [
+    ('face_box', (4,)),     # xmin, ymin, xmax, ymax in pixels of the frame
+    ('eye_boxes', (2, 4)),  # left and right eye boxes scaled to the 0..1 range of the face image
+    ('head_pose', (3,)),    # yaw, pitch, roll
+    ('gaze_vector', (3,))
+]
+
+# The order of the stages whose outputs are recorded
+STAGES = ['face-detection', 'landmarks', 'head-pose', 'gaze']
+
+
+class Recorder:
+    """
+    Records the model outputs of every frame to memory-mapped .npy files keyed by frame index.
+    Optionally, the eye images are recorded as well (resized to the same size).
+    """
+
+    def __init__(self, directory, record_eyes=False, eye_size=(60, 60), capacity=1024):
+        """
+        Creates a new recording in the directory. The eye size (width, height) applies to the recorded
+        eye images. The capacity is the initial number of frames, the files grow as needed.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.eye_size = eye_size
+        self.frame_count = 0
+
+        self.shapes = { name : (shape, np.float32, np.nan) for name, shape in FIELDS }
+        self.shapes['recorded'] = ((), np.uint8, 0)   # whether the frame has been recorded
+        if record_eyes:
+            self.shapes['eyes'] = ((2, eye_size[1], eye_size[0], 3), np.uint8, 0)
+            self.shapes['eyes_recorded'] = ((2,), np.uint8, 0)  # the crops can be empty even if the eye boxes are not
+
+        self.capacity = capacity
+        self.arrays = { name : self._create(name, capacity) for name in self.shapes }
+
+
+    def record(self, ctx):
+        """
+        Stores the model outputs from the frame context under its frame index.
+        """
+        index = ctx.index
+        if index >= self.capacity:
+            self._grow(max(index + 1, 2*self.capacity))
+
+        values = {
+            'face_box': ctx.face_box,
+            'eye_boxes': ctx.eye_boxes if ctx.eye_boxes and ctx.eye_boxes[0] and ctx.eye_boxes[1] else None,
+            'head_pose': ctx.head_pose,
+            'gaze_vector': ctx.gaze_vector if ctx.has_gaze_inputs() else None
+        }
+        for name, value in values.items():
+            self.arrays[name][index] = value if value is not None else np.nan
+
+        if 'eyes' in self.arrays:
+            for i, eye in enumerate(ctx.eyes):
+                if eye is not None and eye.size > 0:
+                    self.arrays['eyes'][index, i] = cv2.resize(eye, self.eye_size)
+                    self.arrays['eyes_recorded'][index, i] = 1
+
+        self.arrays['recorded'][index] = 1
+        self.frame_count = max(self.frame_count, index + 1)
+
+
+    def close(self):
+        """
+        Flushes the files and writes the description of the recording.
+        """
+        for array in self.arrays.values():
+            array.flush()
+        with open(os.path.join(self.directory, 'recording.json'), 'w') as f:
+            json.dump({ 'frame_count': self.frame_count, 'eye_size': self.eye_size,
+                        'fields': sorted(self.arrays) }, f)
+
+
+    def _create(self, name, capacity):
+        """
+        Creates the memory-mapped file of the field filled with the missing values.
+        Private method, to be used by Recorder only.
+        """
+        shape, dtype, missing = self.shapes[name]
+        array = np.lib.format.open_memmap(self._get_path(name), mode='w+', dtype=dtype, shape=(capacity,) + shape)
+        array[...] = missing
+        return array
+
+
+    def _grow(self, capacity):
+        """
+        Enlarges the files to the new capacity.
+        Private method, to be used by Recorder only.
+        """
+        for name, old_array in self.arrays.items():
+            data = np.array(old_array[:self.capacity])
+            del old_array
+            self.arrays[name] = None    # the file must be closed before it's replaced
+            array = self._create(name, capacity)
+            array[:len(data)] = data
+            self.arrays[name] = array
+        self.capacity = capacity
+
+
+    def _get_path(self, name):
+        """
+        Returns the file path of the field.
+        Private method, to be used by Recorder only.
+        """
+        return os.path.join(self.directory, name + '.npy')
+
+
+class Recording:
+    """
+    Provides access to the model outputs saved by Recorder. The files are memory-mapped,
+    so only the frames which are actually read are loaded from the disk.
+    """
+
+    def __init__(self, directory):
+        """
+        Opens the recording in the directory.
+        """
+        with open(os.path.join(directory, 'recording.json')) as f:
+            description = json.load(f)
+        self.frame_count = description['frame_count']
+        self.arrays = { name : np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                        for name in description['fields'] }
+        self.has_eyes = 'eyes' in self.arrays
+
+
+    def get(self, index):
+        """
+        Returns a dictionary of the model outputs recorded for the frame. The missing values are None.
+        Returns None if the frame has not been recorded.
+        """
+        if index >= self.frame_count or not self.arrays['recorded'][index]:
+            return None
+
+        outputs = {}
+        for name, _ in FIELDS:
+            value = self.arrays[name][index]
+            outputs[name] = None if np.isnan(value).any() else value
+        if self.has_eyes:
+            outputs['eyes'] = tuple(eye if recorded else None 
+                                    for eye, recorded in zip(self.arrays['eyes'][index], self.arrays['eyes_recorded'][index]))
+        return outputs
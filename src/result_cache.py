@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+import cv2
+
+
+class ResultCache:
+    """
+    A bounded cache of model outputs which lets a stage reuse its previous output while the input images
+    are almost unchanged (e.g. the user sits still). Inputs are compared by their signatures: downsampled
+    grayscale copies of the images and the other input values (e.g. the head pose angles). A cached output is reused for a limited number of frames, so the output
+    doesn't freeze when the changes are too small to exceed the threshold but accumulate over time.
+    """
+
+    def __init__(self, threshold, max_reuse, capacity=8, size=16, value_threshold=0):
+        """
+        Creates an empty cache. The threshold is the mean absolute difference between two signatures
+        (in the 0..255 range of pixel values) below which the inputs are considered unchanged.
+        The max reuse is the number of frames a cached output can be reused for. The capacity limits
+        the number of cached outputs, the least recently used ones are evicted. The size is the width
+        and height of the downsampled images. The value threshold is the largest absolute difference between
+        the input values of two signatures for which the inputs are considered unchanged.
+        """
+        self.threshold = threshold
+        self.value_threshold = value_threshold
+        self.max_reuse = max_reuse
+        self.capacity = capacity
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # cached outputs and their reuse counts by entry id, the oldest first
+        self.next_id = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+
+
+    def get_signature(self, images, key=0, values=()):
+        """
+        Computes the signature of the input images and values. The key separates the inputs which must never
+        match each other (e.g. the faces from different streams). Returns None if some image or the values
+        are missing, so the outputs computed from placeholders are neither reused nor cached.
+        """
+        if values is None or any(image is None or image.size < 1 for image in images):
+            return None
+        small = [ cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (self.size, self.size),
+                             interpolation=cv2.INTER_AREA) for image in images ]
+        return key, np.stack(small).astype(np.float32), np.array(values, dtype=np.float32)
+
+
+    def lookup(self, signature):
+        """
+        Finds the output cached for the inputs similar to the signature. Returns a tuple. The first value
+        indicates whether the output has been found. The second item is the output.
+        """
+        with self.lock:
+            self.lookups += 1
+            entry_id = self._find(signature) if signature is not None else None
+            if entry_id is None:
+                return False, None
+
+            entry = self.entries[entry_id]
+            if entry[2] >= self.max_reuse:
+                return False, None  # the output is too old, it will be replaced by the new one
+
+            entry[2] += 1
+            self.entries.move_to_end(entry_id)
+            self.hits += 1
+            return True, entry[1]
+
+
+    def store(self, signature, output):
+        """
+        Caches the output computed for the inputs with the signature. The outputs cached for similar
+        inputs are replaced.
+        """
+        if signature is None:
+            return
+
+        with self.lock:
+            while True:
+                entry_id = self._find(signature)
+                if entry_id is None:
+                    break
+                del self.entries[entry_id]
+
+            self.entries[self.next_id] = [ signature, output, 0 ]
+            self.next_id += 1
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def get_hit_rate(self):
+        """
+        Returns the share of lookups which found a cached output.
+        """
+        return self.hits / self.lookups if self.lookups > 0 else 0
+
+
+    def _find(self, signature):
+        """
+        Returns the id of the entry whose images are the closest to the specified ones among the entries
+        within the thresholds, or None if there is no such entry.
+        Private method, to be used by ResultCache only.
+        """
+        key, images, values = signature
+        best_id, best_difference = None, self.threshold
+        for entry_id, (entry_signature, _, _) in self.entries.items():
+            entry_key, entry_images, entry_values = entry_signature
+            if entry_key != key or entry_images.shape != images.shape or entry_values.shape != values.shape:
+                continue
+            if values.size and np.abs(entry_values - values).max() > self.value_threshold:
+                continue
+            difference = np.abs(entry_images - images).mean()
+            if difference < best_difference:
+                best_id, best_difference = entry_id, difference
+        return best_id
@@ -0,0 +1,441 @@
+from pipeline import FrameContext, SourceStage, ModelStage, Stage
+from recording import STAGES
+from collections import deque
+import threading
+import helpers
+import time
+
+
+class InputStage(SourceStage):
+    """
+    Reads frames from the input feeds. Several feeds (multi-stream mode) are read by their own source threads,
+    and the frames which are ready are taken in turn, so the streams are interleaved in the pipeline and share
+    the model requests, while a slow or stalled input doesn't hold back the other ones.
+    """
+
+    def __init__(self, *feeds):
+        """
+        Creates a stage reading frames from the input feeds. The stream number of a frame is the index of its feed.
+        """
+        super().__init__('input')
+        self.feeds = feeds
+        self.active_streams = list(range(len(feeds)))   # streams which haven't ended yet
+        self.ready = [ deque() for _ in feeds ]     # (frame, decoding start, frame time) read by the source threads
+        self.frames_ready = threading.Condition()
+        self.turn = 0
+        self.frame_count = 0
+
+
+    def start(self):
+        """
+        Starts the worker thread and, in the multi-stream mode, a source thread for each feed. The source threads
+        are not joined by the pipeline, since a stalled input may block them indefinitely.
+        """
+        super().start()
+        if len(self.feeds) > 1:
+            for stream in self.active_streams:
+                threading.Thread(target=self._read, args=(stream,), name=f'{self.name}-{stream}', daemon=True).start()
+
+
+    def produce(self):
+        """
+        Reads the next frame and wraps it into a frame context. Returns None at the end of all streams.
+        In the multi-stream mode waits until any of the streams has a frame ready.
+        """
+        if len(self.feeds) == 1:
+            feed = self.feeds[0]
+            frame = feed.read_next() if self.active_streams else None
+            if frame is None:
+                self.active_streams = []
+                return None
+            return self._make_context(0, frame, feed.frame_decode_start, feed.frame_time)
+
+        with self.frames_ready:
+            while self.active_streams and not self.pipeline.stopped:
+                for _ in range(len(self.active_streams)):
+                    self.turn %= len(self.active_streams)
+                    stream = self.active_streams[self.turn]
+                    if not self.ready[stream]:
+                        self.turn += 1
+                        continue
+
+                    frame, decode_start, frame_time = self.ready[stream].popleft()
+                    self.frames_ready.notify_all()
+                    if frame is None:
+                        del self.active_streams[self.turn]
+                        break
+                    self.turn += 1
+                    return self._make_context(stream, frame, decode_start, frame_time)
+                else:
+                    # The stop of the pipeline is not signalled, so it's polled
+                    self.frames_ready.wait(0.1)
+        return None
+
+
+    def _read(self, stream):
+        """
+        The source thread routine: reads the frames of the stream one by one. The next frame is read
+        once the previous one has been taken by produce.
+        Private method, to be used by InputStage only.
+        """
+        feed = self.feeds[stream]
+        try:
+            while not self.pipeline.stopped:
+                frame = feed.read_next()
+                with self.frames_ready:
+                    self.ready[stream].append((frame, feed.frame_decode_start, feed.frame_time))
+                    self.frames_ready.notify_all()
+                    while self.ready[stream] and not self.pipeline.stopped:
+                        self.frames_ready.wait(0.1)
+                if frame is None:
+                    break
+        except Exception as e:
+            self.pipeline.abort(e)
+
+
+    def _make_context(self, stream, frame, decode_start, frame_time):
+        """
+        Wraps the frame of the stream into a new frame context.
+        Private method, to be used by InputStage only.
+        """
+        ctx = FrameContext(self.frame_count, frame, on_release=self.feeds[stream].recycle, capture_time=frame_time,
+                           stream=stream)
+        ctx.trace('decode', decode_start, frame_time)
+        self.frame_count += 1
+        return ctx
+
+
+class FaceDetectionStage(ModelStage):
+    """
+    Detects the faces on the frame, selects the ones to process, and extracts the face images.
+    """
+
+    def __init__(self, face_detector, confidence, face_tracker=None, policy='confidence', max_faces=1, nms_threshold=0,
+                 keep_frames=True):
+        """
+        Creates a face detection stage. If the face tracker is specified, the detector runs only on some frames.
+        In the multi-stream mode the face tracker must be a list of trackers, one for each stream.
+        The policy selects the faces to process (see FaceDetector.select_faces). With the 'all' policy each of 
+        up to max_faces faces becomes a separate work item of the next stages. The NMS threshold enables
+        suppression of the overlapping detections (see FaceDetector.decode_detections). Unless the frames are kept
+        (e.g. for the display), they are detached from the contexts after face detection (see FrameContext.detach_frame).
+        """
+        super().__init__('face-detection', face_detector)
+        self.confidence = confidence
+        self.face_trackers = face_tracker if isinstance(face_tracker, list) else [ face_tracker ]
+        self.policy = policy
+        self.max_faces = max_faces
+        self.nms_threshold = nms_threshold
+        self.previous_boxes = {}    # the last selected face box (0..1) by stream, used by the 'nearest' policy
+        self.extra_faces = []       # the face images and boxes of the other faces of the collected frame
+        self.faces_detected = 0
+        self.keep_frames = keep_frames
+
+
+    def submit(self, ctx):
+        """
+        Feeds the frame to the face detector unless the face tracker decides to skip it.
+        """
+        face_tracker = self.face_trackers[ctx.stream]
+        if face_tracker and not face_tracker.need_detection():
+            self.model.feed_input(None)   # pass the frame through, its face box will be tracked
+        else:
+            self.model.feed_input(ctx.frame, stream=ctx.stream)
+
+
+    def collect(self, ctx):
+        """
+        Retrieves the face bounding boxes, selects the faces, and extracts the face images.
+        The faces other than the first one are passed on by split.
+        """
+        _, faces = self.model.consume_faces(confidence=self.confidence, wait=True, nms_threshold=self.nms_threshold)
+        if faces is not None:
+            self.faces_detected += len(faces)
+        face_boxes = self.model.select_faces(faces, self.policy, self.max_faces, self.previous_boxes.get(ctx.stream))
+        if face_boxes:
+            self.previous_boxes[ctx.stream] = face_boxes[0]
+            self.model.follow_face(face_boxes[0], stream=ctx.stream)   # the next search window follows the selected face
+
+        self.extra_faces = [ self.model.preprocess_output(face_box, frame=ctx.frame) for face_box in face_boxes[1:] ]
+        face_img, face_box = self.model.preprocess_output(face_boxes[0] if face_boxes else None, frame=ctx.frame)
+        face_tracker = self.face_trackers[ctx.stream]
+        if face_tracker:
+            # the tracker substitutes the face box on frames which skipped detection
+            face_box = face_tracker.update(ctx.frame, face_box)
+            face_img = helpers.crop(ctx.frame, face_box)
+        ctx.face_box = face_box
+        ctx.face_image = face_img
+
+
+    def split(self, ctx):
+        """
+        Forks the frame context for each of the other faces of the frame and detaches the frame
+        unless the frames are kept.
+        """
+        extra_faces, self.extra_faces = self.extra_faces, []
+        contexts = self.pipeline.fork(ctx, 1 + len(extra_faces))
+        for fork, (face_img, face_box) in zip(contexts[1:], extra_faces):
+            fork.face_image = face_img
+            fork.face_box = face_box
+        if not self.keep_frames:
+            for context in contexts:
+                context.detach_frame()
+        return contexts
+
+
+class LandmarksStage(ModelStage):
+    """
+    Finds facial landmarks and extracts the eye images.
+    """
+
+    def __init__(self, eye_detector):
+        """
+        Creates a facial landmarks detection stage.
+        """
+        super().__init__('landmarks', eye_detector)
+
+
+    def submit(self, ctx):
+        """
+        Feeds the face image to the eye detector.
+        """
+        self.model.feed_input(ctx.face_image)
+
+
+    def collect(self, ctx):
+        """
+        Retrieves the eye bounding boxes and extracts the eye images.
+        """
+        _, ctx.eye_boxes = self.model.consume_output(wait_needed=True)
+        ctx.eyes = self.model.preprocess_output(ctx.eye_boxes, face_image=ctx.face_image)
+
+
+class HeadPoseStage(ModelStage):
+    """
+    Estimates the head pose angles.
+    """
+
+    def __init__(self, head_pose_estimator, cache=None):
+        """
+        Creates a head pose estimation stage. The cache enables reusing the head pose while the face is still.
+        """
+        super().__init__('head-pose', head_pose_estimator, cache)
+
+
+    def submit(self, ctx):
+        """
+        Feeds the face image to the head pose estimator.
+        """
+        self.model.feed_input(ctx.face_image)
+
+
+    def collect(self, ctx):
+        """
+        Retrieves the yaw, pitch, and roll angles.
+        """
+        _, ctx.head_pose = self.model.consume_output(wait=True)
+
+
+    def get_gate_images(self, ctx):
+        """
+        The head pose is reused while the face image is almost unchanged.
+        """
+        return [ ctx.face_image ]
+
+
+    def get_output(self, ctx):
+        """
+        Returns the head pose angles.
+        """
+        return ctx.head_pose
+
+
+    def set_output(self, ctx, output):
+        """
+        Stores the head pose angles.
+        """
+        ctx.head_pose = output
+
+
+class GazeStage(ModelStage):
+    """
+    Estimates the gaze direction from the eye images and the head pose angles.
+    """
+
+    def __init__(self, gaze_estimator, cache=None):
+        """
+        Creates a gaze estimation stage. The cache enables reusing the gaze vector while the eyes and the head
+        are still.
+        """
+        super().__init__('gaze', gaze_estimator, cache)
+
+
+    def submit(self, ctx):
+        """
+        Feeds the eye images and the head pose angles to the gaze estimator.
+        """
+        left_eye, right_eye = ctx.eyes
+        self.model.feed_input(left_eye, right_eye, ctx.head_pose)
+
+
+    def collect(self, ctx):
+        """
+        Retrieves the gaze direction vector.
+        """
+        _, ctx.gaze_vector = self.model.consume_output(wait=True)
+
+
+    def get_gate_images(self, ctx):
+        """
+        The gaze vector is reused while both eye images are almost unchanged.
+        """
+        return list(ctx.eyes)
+
+
+    def get_gate_values(self, ctx):
+        """
+        The gaze vector also depends on the head pose angles, the cache compares them with its value threshold.
+        """
+        return list(ctx.head_pose) if ctx.head_pose is not None else None
+
+
+    def get_output(self, ctx):
+        """
+        Returns the gaze direction vector.
+        """
+        return ctx.gaze_vector
+
+
+    def set_output(self, ctx, output):
+        """
+        Stores the gaze direction vector.
+        """
+        ctx.gaze_vector = output
+
+
+class RecordStage(Stage):
+    """
+    Records the model outputs of every frame passing through the stage (see recording.Recorder).
+    """
+
+    def __init__(self, recorder):
+        """
+        Creates a stage which records the frames by means of the recorder.
+        """
+        super().__init__('record')
+        self.recorder = recorder
+
+
+    def process(self, ctx):
+        """
+        Records the frame and passes it to the next stage.
+        """
+        self.recorder.record(ctx)
+        self.emit(ctx)
+
+
+class ReplayStage(Stage):
+    """
+    Substitutes the model stages preceding the specified one: the outputs of these stages are loaded
+    from a recording instead of running inference (see recording.Recording).
+    """
+
+    def __init__(self, recording, start_stage, keep_frames=True):
+        """
+        Creates a replay stage. The start stage is the name of the first stage which is not replayed
+        ('landmarks', 'head-pose', 'gaze', or 'sink'). Face detection is always replayed, so unless
+        the frames are kept (e.g. for the display), they are detached from the contexts after the face
+        is cropped (see FrameContext.detach_frame).
+        """
+        super().__init__('replay')
+        self.recording = recording
+        self.keep_frames = keep_frames
+        self.replayed_stages = STAGES[:STAGES.index(start_stage)] if start_stage in STAGES else STAGES
+        self.frames_missing = 0
+
+
+    def process(self, ctx):
+        """
+        Restores the outputs of the replayed stages and the images cropped from the frame. The frames
+        which are missing in the recording are treated as frames without a face.
+        """
+        outputs = self.recording.get(ctx.index)
+        if outputs is None:
+            self.frames_missing += 1
+        elif outputs['face_box'] is not None:
+            ctx.face_box = tuple(int(v) for v in outputs['face_box'])
+            ctx.face_image = helpers.crop(ctx.frame, ctx.face_box)
+        # The eyes are cropped from the detached face image, so they don't refer to the frame either
+        if not self.keep_frames:
+            ctx.detach_frame()
+        if outputs is None:
+            self.emit(ctx)
+            return
+
+        if 'landmarks' in self.replayed_stages and outputs['eye_boxes'] is not None:
+            ctx.eye_boxes = tuple(tuple(box) for box in outputs['eye_boxes'])
+            if self.recording.has_eyes:
+                ctx.eyes = outputs['eyes']
+            elif ctx.face_image is not None and ctx.face_image.size > 0:
+                ctx.eyes = tuple(helpers.crop(ctx.face_image, helpers.fit(box, ctx.face_image)) for box in ctx.eye_boxes)
+
+        if 'head-pose' in self.replayed_stages and outputs['head_pose'] is not None:
+            ctx.head_pose = tuple(outputs['head_pose'])
+
+        if 'gaze' in self.replayed_stages and outputs['gaze_vector'] is not None:
+            ctx.gaze_vector = tuple(outputs['gaze_vector'])
+
+        self.emit(ctx)
+
+
+class SinkStage(Stage):
+    """
+    Moves the mouse pointer in the direction of the gaze and passes the frames to the display.
+    In the silent mode the results are just counted. When several faces of a frame are processed,
+    the mouse follows the gaze of the first one.
+    """
+
+    def __init__(self, window_name, mouse_controller, silent, clean, display=None):
+        """
+        Creates the final stage of the pipeline. The window name is used for the video output.
+        The display (see display.Display) shows the output video, there is no video output without it.
+        """
+        super().__init__('sink')
+        self.window_name = window_name
+        self.mouse_controller = mouse_controller
+        self.silent = silent
+        self.clean = clean
+        self.display = display
+        self.frame_count = 0
+        self.face_count = 0
+
+
+    def process(self, ctx):
+        """
+        Moves the mouse pointer and queues the frame for showing. The display runs in the main thread,
+        so the sink never waits for the GUI.
+        """
+        self.face_count += 1
+        if ctx.face == 0:
+            self.frame_count += 1
+
+        start = time.perf_counter()
+        if not self.silent and ctx.face == 0: # the silent mode is used only for measurements
+            self._move_mouse(ctx)
+        ctx.trace('sink', start, time.perf_counter())
+
+        self.pipeline.complete(ctx)
+        if self.display is not None and not self.silent:
+            self.display.show(self.window_name, ctx, self.clean)   # the display releases the context
+        else:
+            ctx.release()
+
+
+    def _move_mouse(self, ctx):
+        """
+        Moves the mouse pointer in the direction of the gaze.
+        Private method, to be used by SinkStage only.
+        """
+        if ctx.gaze_vector:
+            gx, gy, _ = ctx.gaze_vector
+            self.mouse_controller.move(gx, gy)